@@ -0,0 +1,139 @@
+##############################################################################
+# - Benchmarks the throughput of full-column reads from the basic-cleaned
+#   catalogue of each field under different HDF5 storage layouts, using the
+#   columns that are read by make_maps_from_catalogue.py.
+# - NOTE: Each layout is read several times and the fastest read is reported,
+#   so results mostly reflect chunk and filter overheads rather than disk
+#   speed (which is hidden by the page cache after the first read).
+##############################################################################
+
+import os
+import sys
+import time
+import h5py
+import numpy as np
+from configuration import PipelineConfig as PC
+from output_utils import colour_string, hdf_storage_kwargs
+
+# SETTINGS #
+config_file = sys.argv[1]
+cf = PC(config_file, stage='makeMapsFromCat')
+
+# Storage layouts to compare (see output_utils.hdf_storage_kwargs)
+layouts = {
+    'append': {'layout': 'append'},
+    'read': {'layout': 'read'},
+    'read+lzf': {'layout': 'read', 'compression': 'lzf'},
+    'read+lzf+shuffle': {'layout': 'read', 'compression': 'lzf',
+                         'shuffle': True},
+    'read+gzip4+shuffle': {'layout': 'read', 'compression': 'gzip',
+                           'compression_opts': 4, 'shuffle': True}
+}
+# Number of times to read each layout
+nrepeats = 3
+
+
+###################
+#    FUNCTIONS    #
+###################
+
+def get_map_columns():
+    '''
+    Returns the names of the columns read from the basic-cleaned catalogue
+    when making maps with make_maps_from_catalogue.py.
+
+    Returns
+    -------
+    cols: list[str]
+        Names of the columns.
+    '''
+    cols = ['ra', 'dec', 'is_star', f'{cf.bands.primary}_cmodel_fluxerr']
+    cols += [f'a_{b}' for b in cf.bands.all]
+    cols += cf.flags.brightstar
+    for fl in cf.flags_to_mask:
+        cols += cf.flags[fl]
+    # Remove duplicates while preserving the order
+    return list(dict.fromkeys(cols))
+
+
+def copy_columns(cat, cols, fname, layout_kwargs):
+    '''
+    Copies the specified columns from a catalogue to a new file using the
+    specified storage layout.
+
+    Parameters
+    ----------
+    cat: h5py Dataset or Group
+        Catalogue containing the columns.
+
+    cols: list[str]
+        Names of the columns to copy.
+
+    fname: str
+        Path to the output file.
+
+    layout_kwargs: dict
+        Settings for the storage layout (see hdf_storage_kwargs).
+    '''
+    with h5py.File(fname, 'w') as hf:
+        g = hf.create_group('photometry')
+        for col in cols:
+            data = cat[col][:]
+            g.create_dataset(col, data=data,
+                             **hdf_storage_kwargs(data.dtype, len(data),
+                                                  **layout_kwargs))
+
+
+def time_reads(fname, cols):
+    '''
+    Times full-column reads of the specified columns from a file.
+
+    Parameters
+    ----------
+    fname: str
+        Path to the file.
+
+    cols: list[str]
+        Names of the columns to read.
+
+    Returns
+    -------
+    t_best: float
+        Shortest time (in seconds) taken to read all columns.
+
+    nbytes: int
+        Total number of bytes read.
+    '''
+    t_best = np.inf
+    for _ in range(nrepeats):
+        nbytes = 0
+        t0 = time.perf_counter()
+        with h5py.File(fname, 'r') as hf:
+            for col in cols:
+                nbytes += hf[f'photometry/{col}'][:].nbytes
+        t_best = min(t_best, time.perf_counter() - t0)
+    return t_best, nbytes
+
+
+#######################################################
+#                  START OF SCRIPT                    #
+#######################################################
+
+# Cycle through each of the fields
+for fd in cf.fields:
+    print(colour_string(fd.upper(), 'orange'))
+    # Output directory for this field
+    OUT = cf.paths.out + fd
+    with h5py.File(f'{OUT}/{cf.cats.basic}', 'r') as hf:
+        cat_basic = hf['photometry']
+        cols = [c for c in get_map_columns() if c in cat_basic]
+        print(f'Reading {len(cols)} columns of {len(cat_basic["ra"])} rows.')
+
+        for name, kw in layouts.items():
+            fname = f'{OUT}/benchmark_{name}.hdf5'
+            copy_columns(cat_basic, cols, fname, kw)
+            t_best, nbytes = time_reads(fname, cols)
+            size = os.path.getsize(fname)
+            print(f'{name:>20s}: {nbytes / t_best / 2**20:9.1f} MiB/s '
+                  f'({t_best:.3f} s; file size {size / 2**20:.1f} MiB)')
+            os.remove(fname)
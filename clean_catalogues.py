@@ -6,146 +6,221 @@
 
 import os
 import sys
-from astropy.table import Table, vstack
+from astropy.table import Table
 import numpy as np
 import pandas as pd
 import glob
 import h5py
+import healpy as hp
+import multiprocessing as mp
 from configuration import PipelineConfig as PC
 from output_utils import colour_string, write_output_hdf, \
-    h5py_dataset_iterator, error_message
+    error_message, merge_hdf_catalogues, open_catalogue, write_output_parquet
 
 # SETTINGS #
 config_file = sys.argv[1]
 cf = PC(config_file, stage='cleanCats')
+# Global settings used by the cuts, which are only read by the worker
+# processes if cleaning in parallel
+cf.track_settings('bands', 'depth_cut', 'flags', 'hpix_nside', 'key_cols',
+                  'sn_pri', 'sn_sec')
+# Names of the basic, main and star catalogues as written during cleaning
+# (the main catalogue is converted afterwards if it is to be stored as Parquet)
+cat_names = [cf.cats.basic, os.path.splitext(cf.cats.main)[0] + '.hdf5',
+             cf.cats.stars]
 
 
 ###################
 #    FUNCTIONS    #
 ###################
 
-def basic_clean(t):
+def any_in_columns(t, colnames, test=None, block_size=32):
     '''
-    Performs a basic clean of the input catalogue using pre-existing flags.
+    Identifies the rows of a table for which any of the specified columns
+    satisfy a given condition. The columns are evaluated in 2D blocks rather
+    than one at a time.
 
     Parameters
     ----------
     t: astropy.table.Table
         Input catalogue.
 
+    colnames: list[str]
+        Names of the columns to be evaluated.
+
+    test: callable or None
+        Function returning a boolean array when applied to a 2D block of
+        columns. If None, the columns are assumed to be boolean already.
+
+    block_size: int
+        Maximum number of columns to evaluate at once.
+
     Returns
     -------
-    t: astropy.table.Table
-        Catalogue after applying the cuts.
+    result: numpy.ndarray
+        Boolean array containing True for rows in which any of the columns
+        satisfy the condition.
     '''
+    result = np.zeros(len(t), dtype=bool)
+    for i in range(0, len(colnames), block_size):
+        block = np.column_stack([np.asarray(t[c])
+                                 for c in colnames[i:i+block_size]])
+        if test is not None:
+            block = test(block)
+        result |= block.any(axis=1)
+    return result
 
-    sel = np.ones(len(t), dtype=bool)
 
-    # Create an empty list to which column names with the 'is_null' suffix
-    # will be appended
-    isnull_names = []
+def basic_cuts(t, req_cols=None):
+    '''
+    Identifies the sources that fail each of the basic cuts, which use
+    pre-existing flags in the catalogue.
 
-    # See if file exists containing a list of required columns
-    if os.path.exists(cf.auxfiles.required_cols):
-        with open(cf.auxfiles.required_cols) as file:
-            req_cols = file.readlines()
-        # Remove newline escape sequences and delete any commented lines
-        req_cols = [c.replace('\n', '') for c in req_cols
-                    if not c.startswith('#')]
-    else:
-        req_cols = t.colnames
-    # Cycle through column names
-    for key in t.colnames:
-        if key.__contains__('isnull') and key in req_cols:
-            sel[t[key]] = 0
-            isnull_names.append(key)
-        else:
-            # Remove NaNs UNLESS they are photo-zs, SFRs, stellar masses
-            if not key.startswith('pz_') and not key.startswith('corr_') \
-                    and not key.startswith('mstar_') \
-                    and not key.startswith('sfr_'):
-                sel[np.isnan(t[key])] = 0
+    Parameters
+    ----------
+    t: astropy.table.Table
+        Input catalogue.
 
-    # Also remove any sources that are not primary detections
-    sel *= t['isprimary']
+    req_cols: list[str] or None
+        Names of the required columns (see get_required_columns). If None,
+        all columns are required.
+
+    Returns
+    -------
+    cuts: dict[numpy.ndarray]
+        Boolean arrays containing True for sources failing each cut.
 
+    isnull_names: list[str]
+        Names of the required columns with the 'isnull' suffix.
+    '''
+    # All columns are required if no list is provided
+    if req_cols is None:
+        req_cols = t.colnames
+    req_cols = set(req_cols)
+
+    # Identify the required 'isnull' columns, and the floating-point columns
+    # in which NaNs must be removed UNLESS they are photo-zs, SFRs, stellar
+    # masses or r/i corrections
+    isnull_names = [key for key in t.colnames
+                    if key.__contains__('isnull') and key in req_cols]
+    nan_names = [key for key in t.colnames
+                 if key not in isnull_names
+                 and t[key].dtype.kind == 'f'
+                 and not key.startswith(('pz_', 'corr_', 'mstar_', 'sfr_'))]
+
+    cuts = {}
+    cuts['isnull'] = any_in_columns(t, isnull_names)
+    cuts['nan'] = any_in_columns(t, nan_names, test=np.isnan)
+    # Also remove any sources that are not primary detections
+    cuts['not_primary'] = ~np.asarray(t['isprimary'], dtype=bool)
     # If told to apply 'main' and 'strict'  cuts at this stage, do so
     if len(cf.remove_if_flagged) > 0:
         import itertools
-        to_remove = cf.combine_flags(
+        cuts['flagged'] = cf.combine_flags(
                         t,
                         list(itertools.chain(*[cf.flags[k] for k in cf.flags
                                                if k in cf.remove_if_flagged])),
                         combine_type='or'
         )
-        sel *= ~to_remove
 
-    t.remove_columns(isnull_names)
-    t = t[sel]
+    return cuts, isnull_names
 
-    # Correct r/i-band magnitudes to r2/i2 using the appropriate corrections
-    if cf.correct_ri:
-        for b in ['r', 'i']:
-            corr_mask = ~np.isnan(t[f'corr_{b}mag'])
-            t[f'{b}_cmodel_mag'][corr_mask] += t[f'corr_{b}mag'][corr_mask]
 
-    return t
+def photom_cuts(t):
+    '''
+    Identifies the sources that fail each of the photometric cuts.
 
+    Parameters
+    ----------
+    t: astropy.table.Table
+        Input catalogue.
 
-def photom_cuts(t):
+    Returns
+    -------
+    cuts: dict[numpy.ndarray]
+        Boolean arrays containing True for sources failing each cut.
     '''
-    Performs a photometric cuts on the catalogue.
+    pri = cf.bands.primary
+    cuts = {}
+    # Suppress warnings from sources with NaNs or zero flux errors, which
+    # will already have been removed by the basic cuts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Magnitude cut in primary band
+        cuts['maglim'] = (t[f'{pri}_cmodel_mag']
+                          - t[f'a_{pri}']) > cf.depth_cut
+        # Blending cut
+        cuts['blendedness'] = t[f'{pri}_blendedness_abs'] \
+            >= 10 ** cf.log_blend_cut
+        # S/N cut in primary band
+        cuts['sn_primary'] = (t[f'{pri}_cmodel_flux']
+                              / t[f'{pri}_cmodel_fluxerr']) < cf.sn_pri
+        # S/N cut in all other bands; source must be above the threshold in
+        # at least two of these bands
+        sn_sec = np.column_stack([np.asarray(t[f'{b}_cmodel_flux'])
+                                  / np.asarray(t[f'{b}_cmodel_fluxerr'])
+                                  for b in cf.bands.secondary])
+        cuts['sn_secondary'] = (~(sn_sec < cf.sn_sec)).sum(axis=1) < 2
+
+    return {k: np.asarray(v, dtype=bool) for k, v in cuts.items()}
+
+
+def apply_cuts(t, cutflow, req_cols=None):
+    '''
+    Evaluates all cuts for the input catalogue in one pass and applies them,
+    recording the number of sources rejected by each cut (in the order in
+    which they are applied). Also flags all stars in the catalogue.
 
     Parameters
     ----------
     t: astropy.table.Table
         Input catalogue.
 
+    cutflow: dict
+        Number of sources rejected by each cut so far. Updated in place.
+
+    req_cols: list[str] or None
+        Names of the required columns (see get_required_columns). If None,
+        all columns are required.
+
     Returns
     -------
     t: astropy.table.Table
-        Catalogue after applying the cuts.
+        Catalogue after applying the basic cuts.
+
+    sel_final: numpy.ndarray
+        Boolean array identifying the sources in the basic-cleaned catalogue
+        that also pass the photometric cuts.
     '''
+    cuts, isnull_names = basic_cuts(t, req_cols=req_cols)
+    basic_names = list(cuts)
+
+    # Correct r/i-band magnitudes to r2/i2 using the appropriate corrections
+    if cf.correct_ri:
+        for b in ['r', 'i']:
+            corr_mask = ~np.isnan(t[f'corr_{b}mag'])
+            t[f'{b}_cmodel_mag'][corr_mask] += t[f'corr_{b}mag'][corr_mask]
+    cuts.update(photom_cuts(t))
+
+    # Apply the cuts in order, counting the sources rejected by each one
+    sel = np.ones(len(t), dtype=bool)
+    for name, fail in cuts.items():
+        fail &= sel
+        cutflow[name] = cutflow.get(name, 0) + int(fail.sum())
+        sel &= ~fail
+        if name == basic_names[-1]:
+            sel_basic = sel.copy()
 
-    # Magnitude cut in primary band
-    sel_maglim = np.ones(len(t), dtype=bool)
-    maglim_mask = (t[f'{cf.bands.primary}_cmodel_mag']
-                   - t[f'a_{cf.bands.primary}']) > cf.depth_cut
-    sel_maglim[maglim_mask] = False
-
-    # Blending cut
-    sel_blend = np.ones(len(t), dtype=bool)
-    blend_mask = t[
-        f'{cf.bands.primary}_blendedness_abs'
-        ] >= 10 ** cf.log_blend_cut
-    sel_blend[blend_mask] = False
-
-    # S/N cut in primary band
-    sel_sn_pri = np.ones(len(t), dtype=bool)
-    sn_pri_mask = (t[f'{cf.bands.primary}_cmodel_flux']
-                   / t[f'{cf.bands.primary}_cmodel_fluxerr']) < cf.sn_pri
-    sel_sn_pri[sn_pri_mask] = False
-
-    # S/N cut in all other bands
-    sel_sn_sec = []
-    for b in cf.bands.secondary:
-        sel_sn_now = np.ones(len(t), dtype=bool)
-        sn_sec_mask = (t[f'{b}_cmodel_flux']
-                       / t[f'{b}_cmodel_fluxerr']) < cf.sn_sec
-        sel_sn_now[sn_sec_mask] = False
-        sel_sn_sec.append(sel_sn_now)
-    # Ensure that source is above threshold in at least two of these bands
-    sel_sn_sec = np.sum(sel_sn_sec, axis=0) >= 2
-
-    # Apply the cuts
-    t = t[sel_maglim * sel_blend * sel_sn_pri * sel_sn_sec]
-
-    return t
+    t.remove_columns(isnull_names)
+    t = t[sel_basic]
+    # Identify stars via their 'extendedness' in the primary band
+    t['is_star'] = t[f'{cf.bands.primary}_extendedness_value'] == 0.
+
+    return t, sel[sel_basic]
 
 
 def gal_cut(t):
     '''
-    Flags sources as stars or galaxies based on an 'extendedness' parameter.
+    Splits the catalogue into stars and galaxies using the 'is_star' column.
 
     Parameters
     ----------
@@ -160,32 +235,266 @@ def gal_cut(t):
     t_stars: astropy.table.Table
         Catalogue containing only the sources identified as stars.
     '''
+    star_mask = np.asarray(t['is_star'])
+    return t[~star_mask], t[star_mask]
 
-    # Identify stars via their 'extendedness' in the primary band
-    star_mask = t[f'{cf.bands.primary}_extendedness_value'] == 0.
 
-    # Split the catalogue into stars and galaxies
-    t_stars = t[star_mask]
-    t_gals = t[~star_mask]
+def get_required_columns():
+    '''
+    Determines which columns of the raw catalogues are needed by the pipeline.
+    Combines the columns listed in the file specified as
+    cf.auxfiles.required_cols with all flags, key columns, and the columns
+    used for the cuts applied in this stage.
+
+    Returns
+    -------
+    req_cols: list[str] or None
+        Names of all required columns. If no file listing the required
+        columns exists, returns None (i.e. all columns are required).
+    '''
+    # See if file exists containing a list of required columns
+    if not os.path.exists(cf.auxfiles.required_cols):
+        return None
+    with open(cf.auxfiles.required_cols) as file:
+        req_cols = file.readlines()
+    # Remove newline escape sequences and delete any commented lines
+    req_cols = [c.replace('\n', '') for c in req_cols
+                if not c.startswith('#')]
+
+    # Add the flags used for cleaning here and for masking in later stages
+    for k in cf.flags:
+        req_cols.extend(cf.flags[k])
+    # Add the key columns (both as provided and for each band)
+    for key in cf.key_cols:
+        req_cols.append(cf.key_cols[key])
+        req_cols.extend([f'{b}_{cf.key_cols[key]}' for b in cf.bands.all])
+    # Add the columns required for the cuts in each band
+    for b in cf.bands.all:
+        req_cols.extend([f'{b}_cmodel_mag', f'{b}_cmodel_flux',
+                         f'{b}_cmodel_fluxerr', f'a_{b}'])
+    req_cols.extend(['ra', 'dec', 'isprimary',
+                     f'{cf.bands.primary}_blendedness_abs',
+                     f'{cf.bands.primary}_extendedness_value'])
+    if cf.correct_ri:
+        req_cols.extend(['corr_rmag', 'corr_imag'])
 
-    return t_gals, t_stars
+    # Remove duplicates while preserving the order
+    return list(dict.fromkeys(req_cols))
 
 
-def flag_stars(t):
+def read_catalogue(fname, columns=None, chunk_size=None):
     '''
-    Adds a column to the provided table flagging all stars.
+    Reads a FITS catalogue, either in its entirety or in chunks containing a
+    fixed number of rows.
 
     Parameters
     ----------
+    fname: str
+        Path to the FITS catalogue.
+
+    columns: list[str] or None
+        Names of the columns to read. Any not present in the catalogue are
+        ignored. If None, reads all columns.
+
+    chunk_size: int or None
+        Maximum number of rows to read at once. If None, reads the whole
+        catalogue in one go.
+
+    Yields
+    ------
     t: astropy.table.Table
-        Input catalogue.
+        Table containing the current chunk of the catalogue.
+    '''
+    if chunk_size is None and columns is None:
+        yield Table.read(fname, format='fits')
+        return
+
+    import fitsio
+    with fitsio.FITS(fname) as hdul:
+        hdu = hdul[1]
+        nrows = hdu.get_nrows()
+        # Only read the requested columns that exist in the catalogue
+        if columns is not None:
+            columns = set(columns)
+            hdu = hdu[[c for c in hdu.get_colnames() if c in columns]]
+        if chunk_size is None:
+            chunk_size = max(nrows, 1)
+        # Read the rows in contiguous slices of length chunk_size (yielding
+        # an empty Table if the catalogue contains no rows)
+        for start in range(0, max(nrows, 1), chunk_size):
+            yield Table(hdu[start:start+chunk_size])
+
+
+def clean_streamed(cat_files, hdf_basic, hdf_full, hdf_stars,
+                   req_cols=None):
+    '''
+    Applies all cuts to the provided catalogues in chunks of rows (with the
+    size set by chunk_size in the config file; if None, each catalogue is
+    read in its entirety), appending the results for each chunk to the basic,
+    main and star catalogues. Sources are split into galaxies and stars before
+    being written, so that each output catalogue is written exactly once.
+    Peak memory usage therefore depends on the chunk size rather than the
+    catalogue size.
+
+    Parameters
+    ----------
+    cat_files: list[str]
+        Paths to the FITS catalogues belonging to the current subfield.
+
+    hdf_basic: str
+        Path to the output basic-cleaned catalogue.
+
+    hdf_full: str
+        Path to the output fully cleaned galaxy catalogue.
+
+    hdf_stars: str
+        Path to the output star catalogue.
+
+    req_cols: list[str] or None
+        Names of the required columns (see get_required_columns). If None,
+        all columns are required. Only these columns are read if told to in
+        the config file.
 
+    Returns
+    -------
+    counts: list[int]
+        Number of sources in the raw, basic-cleaned and fully cleaned data,
+        and the number of galaxies and stars in the fully cleaned data.
+
+    cutflow: dict
+        Number of sources rejected by each cut.
+    '''
+    # Remove outputs from previous runs, since all chunks will be appended
+    for f in [hdf_basic, hdf_full, hdf_stars]:
+        if os.path.exists(f):
+            os.remove(f)
+
+    # If told to, only read the required columns from each catalogue
+    columns = req_cols if cf.read_required_only else None
+    l_init = 0		# Counter for number of sources in raw data
+    l_bc = 0		# Counter for number of sources in basic-cleaned data
+    l_final = 0		# Counter for number of sources in final catalogue
+    l_gals = 0		# Counter for number of galaxies in final catalogue
+    l_stars = 0		# Counter for number of stars in final catalogue
+    # Number of sources rejected by each cut
+    cutflow = {}
+    for cat in cat_files:
+        print(f'Cleaning {os.path.basename(cat)}...')
+        for data in read_catalogue(cat, columns=columns,
+                                   chunk_size=cf.chunk_size):
+            l_init += len(data)
+            # Apply all cuts and append basic-cleaned data to HDF file
+            data, sel_final = apply_cuts(data, cutflow, req_cols=req_cols)
+            # Store the pixel ID of each source at the finest resolution used
+            if cf.hpix_nside is not None:
+                data[f'hpix_nest_{cf.hpix_nside}'] = hp.ang2pix(
+                    cf.hpix_nside, np.asarray(data['ra']),
+                    np.asarray(data['dec']), nest=True, lonlat=True)
+            write_output_hdf(data, hdf_basic, mode='a', group='photometry')
+            # If told to, only store the indices of each galaxy and star in
+            # the basic-cleaned catalogue
+            if cf.derived_cats:
+                data = Table({'row_index': l_bc + np.arange(len(data)),
+                              'is_star': data['is_star']})
+                colnames = ['row_index']
+            else:
+                colnames = None
+            l_bc += len(data)
+            # Apply photometric cuts and split into galaxies and stars
+            data = data[sel_final]
+            l_final += len(data)
+            data_gals, data_stars = gal_cut(data)
+            l_gals += len(data_gals)
+            l_stars += len(data_stars)
+            write_output_hdf(data_gals, hdf_full, colnames=colnames,
+                             mode='a', group='photometry')
+            write_output_hdf(data_stars, hdf_stars, colnames=colnames,
+                             mode='a', group='photometry')
+
+    # Identify the basic-cleaned catalogue as the parent of the derived ones
+    if cf.derived_cats:
+        for f in [hdf_full, hdf_stars]:
+            if os.path.exists(f):
+                with h5py.File(f, 'a') as hf:
+                    hf['photometry'].attrs['parent'] = \
+                        os.path.basename(hdf_basic)
+
+    return [l_init, l_bc, l_final, l_gals, l_stars], cutflow
+
+
+def clean_part(task):
     '''
+    Cleans a single raw catalogue and writes the results to its own basic,
+    main and star catalogues. For use with a multiprocessing Pool.
 
-    # Identify stars via their 'extendedness' in the primary band
-    star_mask = t[f'{cf.bands.primary}_extendedness_value'] == 0.
-    # Add this as a column to the Table
-    t['is_star'] = star_mask
+    Parameters
+    ----------
+    task: tuple
+        Path to the raw catalogue, a list containing the paths to the output
+        basic, main and star catalogues, and the names of the required
+        columns.
+
+    Returns
+    -------
+    counts: list[int]
+        Number of sources in the raw, basic-cleaned and fully cleaned data,
+        and the number of galaxies and stars in the fully cleaned data.
+
+    cutflow: dict
+        Number of sources rejected by each cut.
+    '''
+    cat, outputs, req_cols = task
+    return clean_streamed([cat], *outputs, req_cols=req_cols)
+
+
+def get_catalogue_files(fd):
+    '''
+    Identifies the raw catalogue(s) belonging to the specified subfield.
+
+    Parameters
+    ----------
+    fd: str
+        Name of the subfield.
+
+    Returns
+    -------
+    cat_files: list[str]
+        Paths to the raw catalogues for this subfield. Contains multiple
+        entries if the subfield was split into multiple parts, and is empty
+        if no catalogues are found.
+    '''
+    # See if the field has been split into multiple parts
+    fname = f'{cf.paths.data}{cf.dr.upper()}_{fd.upper()}'\
+            f'{get_data_suffix()}.fits'
+    if os.path.exists(fname):
+        cat_files = [fname]
+    else:
+        # See if catalogues exist for separate parts of the field
+        cat_files = sorted(glob.glob(f'{cf.paths.data}{cf.dr.upper()}'
+                                     f'_{fd.upper()}_part??'
+                                     f'{get_data_suffix()}.fits'))
+    return cat_files
+
+
+def get_output_files(out_dir, prefix=''):
+    '''
+    Returns the paths to the basic, main and star catalogues in the specified
+    directory.
+
+    Parameters
+    ----------
+    out_dir: str
+        Directory in which the catalogues are to be written.
+
+    prefix: str
+        Prefix to add to the filename of each catalogue.
+
+    Returns
+    -------
+    outputs: list[str]
+        Paths to the basic, main and star catalogues.
+    '''
+    return [f'{out_dir}/{prefix}{c}' for c in cat_names]
 
 
 def get_data_suffix():
@@ -215,6 +524,17 @@ catalogues = [
 # Get a dictionary of all fields being analysed and their respective subfields
 fields = cf.fields
 
+# Columns of the raw catalogues needed by the pipeline
+req_cols = get_required_columns()
+
+# Number of processes to use when cleaning subfields and parts in parallel
+ncores = max(1, min(mp.cpu_count()-1, cf.ncores))
+
+# Dictionary for the paths to the cleaned catalogues from each subfield
+intermediates = {}
+# Dictionary for the outputs and inputs of each field
+stage_files = {}
+
 # Cycle through each global field
 for g in fields:
     cf.fields = [g]
@@ -225,82 +545,72 @@ for g in fields:
     l_final_fd = 0 		# Counter for number of sources in final catalogue
     l_gals_fd = 0		# Counter for number of galaxies in final catalogue
     l_stars_fd = 0		# Counter for number of stars in final catalogue
+    cutflow_fd = {}		# Number of sources rejected by each cut
     print(colour_string(g.upper(), 'orange'))
-    # Cycle through each of the subfields
+    # Identify the catalogues belonging to each subfield
+    cat_files = {}
     for fd in cf.get_subfields():
+        files = get_catalogue_files(fd)
+        if len(files) == 0:
+            error_message('clean_catalogues',
+                          f'No catalogues found for field {fd.upper()}.')
+            continue
+        cat_files[fd] = files
+        # Create output directory for this subfield
+        OUT = f'{PATH_G}/{fd}'
+        if not os.path.exists(OUT):
+            os.system(f'mkdir -p {OUT}')
+
+    # Skip this field if its settings and inputs are unchanged
+    inputs = [f for fd in cat_files for f in cat_files[fd]]
+    inputs.append(cf.auxfiles.required_cols)
+    outputs = [f'{PATH_G}/{c}'
+               for c in [cf.cats.basic, cf.cats.main, cf.cats.stars,
+                         cf.clean_summary_file, cf.cutflow_file]]
+    if cf.outputs_unchanged(PATH_G, outputs, inputs):
+        print('Settings and inputs unchanged; skipping.')
+        continue
+    stage_files[g] = (outputs, inputs)
+
+    # Outputs from each subfield (or each of its parts if cleaning in
+    # parallel), to be consolidated once all fields have been cleaned
+    intermediates[g] = {}
+    # If using multiple cores, clean every part of every subfield in parallel
+    if ncores > 1:
+        for fd in cat_files:
+            intermediates[g][fd] = [
+                get_output_files(f'{PATH_G}/{fd}', prefix=f'part{i:02d}_')
+                for i in range(len(cat_files[fd]))
+            ]
+        tasks = [(cat, outputs, req_cols) for fd in cat_files
+                 for cat, outputs in zip(cat_files[fd], intermediates[g][fd])]
+        print(f'Cleaning {len(tasks)} catalogues using {ncores} processes...')
+        with mp.get_context('fork').Pool(ncores) as pool:
+            part_results = iter(pool.map(clean_part, tasks))
+
+    # Cycle through each of the subfields
+    for fd in cat_files:
         print(colour_string(fd, 'purple'))
 
-        # Create output directory for this field
+        # Output directory for this field
         OUT = f'{PATH_G}/{fd}'
         print(f'Output directory: {OUT}')
-        if not os.path.exists(OUT):
-            os.system(f'mkdir -p {OUT}')
 
-        # Filenames to be given to the HDF format output files
-        hdf_basic = f'{OUT}/{cf.cats.basic}'
-        hdf_full = f'{OUT}/{cf.cats.main}'
-        # See if the field has been split into multiple parts
-        fname = f'{cf.paths.data}{cf.dr.upper()}_{fd.upper()}'\
-                f'{get_data_suffix()}.fits'
-        # Initially enable 'write' mode for output files
-        mode = 'w'
-        if os.path.exists(fname):
-            data_all = Table.read(fname, format='fits')
-            l_init = len(data_all)
-            # Apply basic clean and write to HDF file
-            print('Applying basic clean...')
-            data_all = basic_clean(data_all)
-            flag_stars(data_all)
-            l_bc = len(data_all)
-            write_output_hdf(data_all, hdf_basic, mode=mode,
-                             group='photometry')
-            # Apply photometric cuts and write to HDF file
-            print('Applying photometric cuts...')
-            data_all = photom_cuts(data_all)
-            write_output_hdf(data_all, hdf_full, mode=mode, group='photometry')
-            l_final = len(data_all)
+        if ncores > 1:
+            # Sum the counters from each part
+            results = [next(part_results) for _ in cat_files[fd]]
+            counts = [sum(c) for c in zip(*[r[0] for r in results])]
+            cutflow = {}
+            for _, cf_part in results:
+                for k in cf_part:
+                    cutflow[k] = cutflow.get(k, 0) + cf_part[k]
         else:
-            # See if catalogues exist for separate parts of the field
-            parts = sorted(glob.glob(f'{cf.paths.data}{cf.dr.upper()}'
-                                     f'_{fd.upper()}_part??{get_data_suffix()}'
-                                     '.fits'))
-            if len(parts) >= 1:
-                # Set up a list to contain data from all catalogues associated
-                # with this field
-                data_all = []
-                l_init = 0		# Counter for number of sources in raw data
-                l_bc = 0		# Counter for number of sources in basic-cleaned data
-                l_final = 0		# Counter for number of sources in final catalogue
-                # Cycle through each catalogue
-                for i, cat in enumerate(parts):
-                    print(f'Cleaning part {i+1}...')
-                    data = Table.read(cat, format='fits')
-                    l_init += len(data)
-                    # Apply basic clean and write to HDF file
-                    print('Applying basic clean...')
-                    data = basic_clean(data)
-                    flag_stars(data)
-                    l_bc += len(data)
-                    write_output_hdf(data, hdf_basic, mode=mode,
-                                     group='photometry')
-                    # Apply photometric cuts and write to HDF file
-                    print('Applying photometric cuts...')
-                    data = photom_cuts(data)
-                    write_output_hdf(data, hdf_full, mode=mode,
-                                     group='photometry')
-                    data_all.append(data)
-                    l_final += len(data)
-                    try:
-                        assert mode == 'a'
-                    except AssertionError:
-                        mode = 'a'
-                # Stack the data from each part
-                data_all = vstack(data_all)
-
-            else:
-                error_message(cf.__name__,
-                              f'No catalogues found for field {fd.upper()}.')
-                continue
+            # Stream the data through all cuts, writing each output once
+            intermediates[g][fd] = [get_output_files(OUT)]
+            counts, cutflow = clean_streamed(cat_files[fd],
+                                             *intermediates[g][fd][0],
+                                             req_cols=req_cols)
+        l_init, l_bc, l_final, l_gals, l_stars = counts
 
         print(colour_string(f'Began with {l_init} sources.', 'green'))
         print(colour_string(f'{l_bc} remained after basic cleaning.', 'green'))
@@ -308,25 +618,16 @@ for g in fields:
             colour_string(f'{l_final} sources remaining after full cleaning.',
                           'green')
             )
-
-        # Split catalogue into stars and galaxies
-        data_gals, data_stars = gal_cut(data_all)
-        l_gals = len(data_gals)
-        l_stars = len(data_stars)
         print(colour_string(f'{l_gals} galaxies; {l_stars} stars.', 'green'))
 
-        # Write the catalogues to output files
-        print('Writing outputs...')
-        hdf_stars = f'{OUT}/{cf.cats.stars}'
-        write_output_hdf(data_gals, hdf_full, mode='w', group='photometry')
-        write_output_hdf(data_stars, hdf_stars, mode='w', group='photometry')
-
         # Add to the relevant counters
         l_init_fd += l_init
         l_bc_fd += l_bc
         l_final_fd += l_final
         l_gals_fd += l_gals
         l_stars_fd += l_stars
+        for k in cutflow:
+            cutflow_fd[k] = cutflow_fd.get(k, 0) + cutflow[k]
 
     print(colour_string(f'SUMMARY: {g.upper()}', 'orange'))
     print(colour_string(f'Began with {l_init_fd} sources.', 'green'))
@@ -347,35 +648,54 @@ for g in fields:
     summary = pd.DataFrame(data=summary)
     summary.to_csv(f'{PATH_G}/{cf.clean_summary_file}', sep='\t', index=False)
 
+    # Write the number of sources rejected by each cut to file
+    cutflow = {'Cut': list(cutflow_fd),
+               'N_rejected': list(cutflow_fd.values()),
+               'N_remaining': l_init_fd - np.cumsum(list(cutflow_fd.values()),
+                                                    dtype=int)}
+    cutflow = pd.DataFrame(data=cutflow)
+    cutflow.to_csv(f'{PATH_G}/{cf.cutflow_file}', sep='\t', index=False)
+
 print('Consolidating catalogues from subfields...')
-cats = [cf.cats.basic, cf.cats.main, cf.cats.stars]
-for g in fields:
-    cf.fields = [g]
+for g in intermediates:
     print(colour_string(g.upper(), 'orange'))
+    # Number of rows in each basic-cleaned catalogue, used for offsetting the
+    # row indices in any derived catalogues
+    basic_lengths = []
+    for fd in intermediates[g]:
+        for outputs in intermediates[g][fd]:
+            if not os.path.exists(outputs[0]):
+                basic_lengths.append(0)
+                continue
+            with h5py.File(outputs[0], 'r') as hf:
+                basic_lengths.append(len(hf['photometry/ra']))
+    index_offsets = np.cumsum([0] + basic_lengths[:-1])
     # Cycle through the catalogue types
-    for cat in cats:
+    for i, cat in enumerate(cat_names):
         print(colour_string(cat, 'cyan'))
         fname = f'{cf.paths.out}{g}/{cat}'
-        with h5py.File(fname, 'w') as fmain:
-            for fd in cf.get_subfields():
-                print(f'Adding data from subfield {fd}...')
-                cat_now = f'{cf.paths.out}{g}/{fd}/{cat}'
-                with h5py.File(cat_now, 'r') as fnow:
-                    # Check the current structure of the main file
-                    paths_current = [p for p, _
-                                     in h5py_dataset_iterator(fmain)]
-                    # Iterate through each branch of the file tree
-                    for (path, dset) in h5py_dataset_iterator(fnow):
-                        N = len(dset)
-                        dt = dset.dtype
-                        if path in paths_current:
-                            dset_main = fmain[path]
-                            dset_main.resize((len(dset_main)+N,))
-                            dset_main[-N:] = dset[:]
-                        else:
-                            dset = fmain.create_dataset(path, shape=(N,),
-                                                        data=dset[:],
-                                                        maxshape=(None,),
-                                                        dtype=dt)
-                if cf.remove_intermediate:
-                    os.system(f'rm -f {cat_now}')
+        cats_sub = [outputs[i] for fd in intermediates[g]
+                    for outputs in intermediates[g][fd]]
+        print(f'Adding data from subfields {", ".join(intermediates[g])}'
+              '...')
+        # Use the storage layout specified in the config file
+        merge_hdf_catalogues(cats_sub, fname, index_offsets=index_offsets,
+                             **cf.hdf_layout)
+        # Identify the parent of any derived catalogue
+        if cf.derived_cats and i > 0:
+            with h5py.File(fname, 'a') as hf:
+                hf.require_group('photometry').attrs['parent'] = cf.cats.basic
+        if cf.remove_intermediate:
+            for cat_now in cats_sub:
+                os.system(f'rm -f {cat_now}')
+    # Convert the main catalogue to Parquet if specified
+    if cf.cat_format == 'parquet':
+        print(colour_string(cf.cats.main, 'cyan'))
+        fname = f'{cf.paths.out}{g}/{cat_names[1]}'
+        with open_catalogue(fname) as cat_main:
+            write_output_parquet(cat_main,
+                                 f'{cf.paths.out}{g}/{cf.cats.main}',
+                                 row_group_size=cf.parquet_row_group_size)
+        os.remove(fname)
+    # Record the settings and inputs used for this field
+    cf.record_fingerprint(f'{cf.paths.out}{g}', *stage_files[g])
@@ -56,24 +56,26 @@ def combine_maps(map_name, fields):
     # Check if these maps are single maps or recarrays of multiple maps
     ndtype = len(maps[0].dtype)
     if ndtype > 0:
-        # Cycle through the individual maps and combine from each field
-        unions_indiv = [hsp.operations.sum_union([m[m.dtype.names[i]]
-                                                  for m in maps])
-                        for i in range(ndtype)]
+        names = maps[0].dtype.names
+        # Identify the pixels occupied by the first map in any field
+        pixels = reduce(mu.PixelSet.union,
+                        [mu.PixelSet.from_map(m[names[0]]) for m in maps])
         # Initialise a recarray for the output
         union, _, px_data_u = mu.initialiseRecMap(
-            unions_indiv[0].nside_coverage,
-            unions_indiv[0].nside_sparse,
-            maps[0].dtype.names,
-            pixels=unions_indiv[0].valid_pixels,
+            maps[0].nside_coverage,
+            maps[0].nside_sparse,
+            names,
+            pixels=pixels.pix,
             dtypes=str(maps[0].dtype[0])
             )
-        # Populate the maps
-        for i in range(ndtype):
-            union[union.dtype.names[i]].update_values_pix(
-                px_data_u,
-                unions_indiv[i][px_data_u]
-                )
+        # Cycle through the individual maps and sum the values from each
+        # field in which the pixels are valid
+        for name in names:
+            values = np.zeros(len(px_data_u), dtype=maps[0].dtype[name])
+            for m in maps:
+                valid = m[name].get_values_pix(px_data_u, valid_mask=True)
+                values[valid] += m[name].get_values_pix(px_data_u[valid])
+            union[name].update_values_pix(px_data_u, values)
     else:
         union = hsp.operations.sum_union(maps)
     return union
@@ -205,6 +205,24 @@ for fd in cf.fields:
     PATH_CACHE = PATH_FD + 'cache/'
     wsp_path = PATH_CACHE + cf.cache_files.workspaces.wsp
     covwsp_path = PATH_CACHE + cf.cache_files.workspaces.covwsp
+
+    # Maps and n(z) distributions used for this field, and the SACC outputs
+    if cf.use_dir:
+        nofz_info = cf.nofz_files.nz_dir
+    else:
+        nofz_info = f'{PATH_FD}{cf.nofz_files.nz_mc}'
+    inputs = [PATH_FD + m for m in [cf.maps.survey_mask, cf.maps.deltag_maps,
+                                    cf.maps.ngal_maps]]
+    inputs += sorted(glob.glob(f'{PATH_FD}systmaps/*_nside{cf.nside_hi}*.hsp'))
+    inputs.append(nofz_info)
+    outputs = [PATH_FD + cf.sacc_files[k]
+               for k in ['main', 'nodeproj', 'noise', 'bias']]
+    # Skip this field if its settings and inputs are unchanged
+    if cf.outputs_unchanged(PATH_FD, outputs, inputs):
+        if rank == 0:
+            print(colour_string(fd.upper(), 'orange'))
+            print('Settings and inputs unchanged; skipping.')
+        continue
     # Set up NmtWorkspace and NmtCovarianceWorkspace
     w = nmt.NmtWorkspace()
     cw = nmt.NmtCovarianceWorkspace()
@@ -571,10 +589,6 @@ for fd in cf.fields:
         s_bias = sacc.Sacc()		# deprojection bias
 
         # Get the n(z) distributions
-        if cf.use_dir:
-            nofz_info = cf.nofz_files.nz_dir
-        else:
-            nofz_info = f'{PATH_FD}{cf.nofz_files.nz_mc}'
         with h5py.File(nofz_info, 'r') as hf:
             # Get the redshifts at which n(z) distributions are defined
             z = hf['z'][:]
@@ -652,3 +666,6 @@ for fd in cf.fields:
                           overwrite=True)
         s_bias.save_fits(f'{PATH_FD}{cf.sacc_files.bias}',
                          overwrite=True)
+
+        # Record the settings and inputs used for this field
+        cf.record_fingerprint(PATH_FD, outputs, inputs)
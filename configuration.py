@@ -2,6 +2,7 @@
 # Configuration class for the various stages of the GC-HSC3 pipeline.
 ##############################################################################
 
+import ast
 import yaml
 
 
@@ -17,23 +18,75 @@ class DictAsMember(dict):
         return value
 
 
+class SampleColumns(ast.NodeTransformer):
+    '''
+    Rewrites a sample definition so that references to catalogue columns
+    (either the name of a key column or cat["col"][:]) become lookups in a
+    dictionary of columns that have already been read, and records the names
+    of the columns referenced.
+    '''
+    def __init__(self, key_cols):
+        self.key_cols = key_cols
+        self.columns = []
+
+    def _lookup(self, col):
+        if col not in self.columns:
+            self.columns.append(col)
+        return ast.Subscript(value=ast.Name(id='_columns', ctx=ast.Load()),
+                             slice=ast.Constant(value=col), ctx=ast.Load())
+
+    @staticmethod
+    def _is_column(node):
+        return (isinstance(node, ast.Subscript)
+                and isinstance(node.value, ast.Name)
+                and node.value.id == 'cat'
+                and isinstance(node.slice, ast.Constant)
+                and isinstance(node.slice.value, str))
+
+    def visit_Name(self, node):
+        if node.id in self.key_cols:
+            return self._lookup(self.key_cols[node.id])
+        return node
+
+    def visit_Subscript(self, node):
+        # Full-column reads, i.e. cat["col"][:]
+        sl = node.slice
+        if (self._is_column(node.value) and isinstance(sl, ast.Slice)
+                and sl.lower is None and sl.upper is None and sl.step is None):
+            return self._lookup(node.value.slice.value)
+        if self._is_column(node):
+            return self._lookup(node.slice.value)
+        return self.generic_visit(node)
+
+
 class PipelineConfig():
     '''
     A class for identifying and defining the settings for the pipeline,
     both globally and at the specified stage.
     '''
 
+    # Settings that do not affect the outputs of a stage, and are therefore
+    # excluded from its fingerprint
+    _untracked = ['fields', 'config_file', 'platform', 'ncores',
+                  'skip_unchanged', 'fingerprint_file']
+
     def __init__(self, config_file, stage=None):
         '''
         Loads the contents of a YAML file and uses it to define
         properties representing settings for the pipeline.
         '''
+        # Names of the settings read by the stage (see fingerprint)
+        self._accessed = set()
+        self.stage = stage
 
         with open(config_file) as f:
             config_all = yaml.safe_load(f)
             self.config_dict = config_all['global']
+            # Settings specific to the stage, all of which are tracked
+            self._stage_keys = set()
             if stage is not None:
                 self.config_dict = {**self.config_dict, **config_all[stage]}
+                self._stage_keys = set(config_all[stage])
 
         # Define a new property containing all bands
         self.config_dict['bands']['all'] = [self.bands.primary] + \
@@ -41,6 +94,8 @@ class PipelineConfig():
 
         # Get the number of samples and set it as a property
         self.config_dict['nsamples'] = len(self.samples)
+        # Sample definitions are compiled when first needed
+        self._sample_code = None
 
         # Store the path of the config file
         self.config_dict['config_file'] = config_file
@@ -50,6 +105,8 @@ class PipelineConfig():
         self._set_platform()
         # Identify the various flags to be applied when removing sources
         self._set_flags()
+        # Only track the settings read from here on
+        self._accessed = set()
 
     def __getattr__(self, name):
         '''
@@ -57,6 +114,7 @@ class PipelineConfig():
         rather than dictionary entries.
         '''
         value = self.config_dict[name]
+        self._accessed.add(name)
         if isinstance(value, dict):
             value = DictAsMember(value)
         return value
@@ -69,18 +127,14 @@ class PipelineConfig():
         # HDF5 catalogues
         for key in self.cats:
             self.config_dict['cats'][key] = self.cats[key] + '.hdf5'
+        # The fully cleaned galaxy catalogue can instead be stored as Parquet
+        if self.cat_format == 'parquet':
+            self.config_dict['cats']['main'] = \
+                self.cats.main[:-len('.hdf5')] + '.parquet'
 
-        # Healsparse maps
-        for key in self.maps:
-            # If dustmaps, replace name with list of names for all bands
-            if key == 'dustmaps':
-                self.config_dict['maps'][key] = [self.maps[key] +
-                                                 f'_{b}_nside{self.nside_hi}' +
-                                                 f'{self.suffix}.hsp'
-                                                 for b in self.bands.all]
-            else:
-                self.config_dict['maps'][key] = self.maps[key] + \
-                    f'_nside{self.nside_hi}{self.suffix}.hsp'
+        # Healsparse maps (see get_map_names for other resolutions)
+        self._map_bases = dict(self.maps)
+        self.config_dict['maps'] = self.get_map_names(self.nside_hi)
 
         # Data files
         for key in self.data_files:
@@ -186,10 +240,76 @@ class PipelineConfig():
 
         return subfields
 
-    def get_samples(self, cat):
+    def get_map_names(self, nside):
+        '''
+        Returns the names of the HealSparse map files at the specified
+        resolution (the names at nside_hi are also given by the maps
+        property).
+
+        Parameters
+        ----------
+        nside: int
+            NSIDE of the maps.
+
+        Returns
+        -------
+        maps: DictAsMember
+            Name of each map file (a list of names for each band in the case
+            of the dust maps).
+        '''
+        maps = DictAsMember()
+        for key, base in self._map_bases.items():
+            # If dustmaps, replace name with list of names for all bands
+            if key == 'dustmaps':
+                maps[key] = [f'{base}_{b}_nside{nside}{self.suffix}.hsp'
+                             for b in self.bands.all]
+            else:
+                maps[key] = f'{base}_nside{nside}{self.suffix}.hsp'
+        return maps
+
+    def get_nside_levels(self):
+        '''
+        Returns the resolutions at which maps are made: nside_hi, followed by
+        any coarser levels of the map pyramid specified in the config file
+        (from finest to coarsest).
+
+        Returns
+        -------
+        levels: list[int]
+            NSIDE of each level.
+        '''
+        levels = sorted(set(self.pyramid_nsides or []), reverse=True)
+        for nside in levels:
+            if (nside >= self.nside_hi) or (nside < self.nside_lo) or \
+                    (nside & (nside - 1)):
+                raise ValueError('pyramid_nsides must only contain powers of '
+                                 '2 from nside_lo up to (but excluding) '
+                                 'nside_hi.')
+        return [self.nside_hi] + levels
+
+    def _compile_samples(self):
+        '''
+        Parses the sample definitions into compiled expressions, and
+        identifies the catalogue columns referenced by them.
+        '''
+        self._sample_code = {}
+        self._sample_columns = {}
+        for s in self.samples:
+            columns = SampleColumns(self.key_cols)
+            # Each term (separated by semicolons) is compiled separately
+            self._sample_code[s] = []
+            for ex in self.samples[s].split(';'):
+                tree = columns.visit(ast.parse(ex.strip(), mode='eval'))
+                tree = ast.fix_missing_locations(tree)
+                self._sample_code[s].append(
+                    compile(tree, f'<sample {s}>', 'eval'))
+            self._sample_columns[s] = columns.columns
+
+    def get_samples(self, cat, chunk_size=None, samples=None):
         '''
         Returns masks to apply to the input catalogue in order to select
-        sources belonging to each sample.
+        sources belonging to each sample. Each column referenced by the
+        sample definitions is read once and used to evaluate all samples.
 
         Parameters
         ----------
@@ -197,6 +317,13 @@ class PipelineConfig():
             The input catalogue or Group. Must contain the relevant Datasets
             needed to define the cuts.
 
+        chunk_size: int or None
+            Number of rows to read and evaluate at a time. If None, reads
+            each column in full.
+
+        samples: list[str] or None
+            Names of the samples to evaluate. If None, evaluates all samples.
+
         Returns
         -------
         sample_masks: dict[numpy.array]
@@ -205,22 +332,304 @@ class PipelineConfig():
         '''
         import numpy as np
 
-        sample_masks = {}
-        for s in self.samples:
-            samp = self.samples[s]
-            # Replace any references to key columns with their actual names
-            for key in self.key_cols:
-                samp = samp.replace(key, f'cat["{self.key_cols[key]}"][:]')
-            # Split the expression at any semicolons and evaluate each term
-            samp = samp.split(';')
-
-            samp_mask = np.ones_like(cat[next(iter(cat.keys()))][:],
-                                     dtype=bool)
-            for ex in samp:
-                samp_mask *= eval(ex)
-            sample_masks[s] = samp_mask
+        if self._sample_code is None:
+            self._compile_samples()
+        if samples is None:
+            samples = list(self._sample_code)
+        # Columns referenced by any of the samples being evaluated
+        columns = list(dict.fromkeys(c for s in samples
+                                     for c in self._sample_columns[s]))
+        N = len(cat[columns[0] if columns else next(iter(cat.keys()))])
+        if chunk_size is None:
+            chunk_size = max(N, 1)
+
+        sample_masks = {s: np.ones(N, dtype=bool) for s in samples}
+        for i0 in range(0, N, chunk_size):
+            i1 = min(i0 + chunk_size, N)
+            # Read each referenced column once for this chunk
+            data = {c: np.asarray(cat[c][i0:i1]) for c in columns}
+            for s in samples:
+                for ex in self._sample_code[s]:
+                    sample_masks[s][i0:i1] &= eval(
+                        ex, {'np': np}, {'_columns': data, 'cat': cat})
         return sample_masks
 
+    def pack_samples(self, sample_masks, outliers=None):
+        '''
+        Packs the masks for each sample into a single bitmask array, in which
+        bit i is set for sources belonging to the ith sample in the config
+        file, and bit nsamples is set for sources flagged as photo-z outliers.
+
+        Parameters
+        ----------
+        sample_masks: dict[numpy.array]
+            Dictionary of boolean arrays identifying which sources belong to
+            each sample (as returned by get_samples).
+
+        outliers: numpy.array or None
+            Boolean array identifying photo-z outliers. If None, no sources
+            are flagged.
+
+        Returns
+        -------
+        bits: numpy.array
+            Bitmask array, using the smallest unsigned integer type with
+            enough bits.
+        '''
+        import numpy as np
+
+        nbits = self.nsamples + 1
+        dtypes = [np.dtype(dt) for dt in ['u1', 'u2', 'u4', 'u8']]
+        dtypes = [dt for dt in dtypes if 8 * dt.itemsize >= nbits]
+        if len(dtypes) == 0:
+            raise ValueError(f'Cannot pack {self.nsamples} samples into a '
+                             'bitmask.')
+        N = len(next(iter(sample_masks.values())))
+        bits = np.zeros(N, dtype=dtypes[0])
+        for i, s in enumerate(self.samples):
+            bits |= sample_masks[s].astype(bits.dtype) << i
+        if outliers is not None:
+            bits |= outliers.astype(bits.dtype) << self.nsamples
+        return bits
+
+    def unpack_samples(self, bits, samples=None):
+        '''
+        Decodes a bitmask array produced by pack_samples into masks for each
+        sample.
+
+        Parameters
+        ----------
+        bits: numpy.array
+            Bitmask array.
+
+        samples: list[str] or None
+            Names of the samples in the order in which they were packed. If
+            None, uses the samples in the config file.
+
+        Returns
+        -------
+        sample_masks: dict[numpy.array]
+            Dictionary of boolean arrays identifying which sources belong to
+            each sample.
+        '''
+        import numpy as np
+        if samples is None:
+            samples = list(self.samples)
+        return {s: np.bitwise_and(bits, 1 << i) != 0
+                for i, s in enumerate(samples)}
+
+    def unpack_outliers(self, bits, nsamples=None):
+        '''
+        Decodes a bitmask array produced by pack_samples to identify sources
+        flagged as photo-z outliers.
+
+        Parameters
+        ----------
+        bits: numpy.array
+            Bitmask array.
+
+        nsamples: int or None
+            Number of samples packed into the bitmask. If None, uses the
+            number of samples in the config file.
+
+        Returns
+        -------
+        outliers: numpy.array
+            Boolean array identifying photo-z outliers.
+        '''
+        import numpy as np
+        if nsamples is None:
+            nsamples = self.nsamples
+        return np.bitwise_and(bits, 1 << nsamples) != 0
+
+    def get_sample_hashes(self, extra=None):
+        '''
+        Returns a hash of the definition of each sample, i.e. its expression
+        and the key columns to which it may refer.
+
+        Parameters
+        ----------
+        extra: object
+            Any other (JSON-serialisable) settings affecting the samples, to
+            be included in every hash.
+
+        Returns
+        -------
+        hashes: dict[str]
+            Hash of the definition of each sample.
+        '''
+        import hashlib
+        import json
+        hashes = {}
+        for s in self.samples:
+            d = json.dumps([self.samples[s], self.key_cols, extra],
+                           sort_keys=True)
+            hashes[s] = hashlib.sha256(d.encode()).hexdigest()
+        return hashes
+
+    def track_settings(self, *names):
+        '''
+        Marks global settings as used by the stage, so that they are
+        included in its fingerprint even if never read through this object
+        in the current process (e.g. those only read by worker processes,
+        whose reads are not seen here). Settings in the section of the
+        config file for the stage are always included.
+
+        Parameters
+        ----------
+        names: str
+            Names of the settings.
+        '''
+        self._accessed.update(names)
+
+    def tracked_settings(self):
+        '''
+        Returns the names of the settings included in the fingerprint of the
+        stage: every setting in its own section of the config file, and the
+        global settings read or marked as used so far (see track_settings),
+        except those in _untracked.
+
+        Returns
+        -------
+        keys: list[str]
+            Names of the settings.
+        '''
+        keys = (self._accessed | self._stage_keys) - set(self._untracked)
+        return sorted(keys)
+
+    def fingerprint(self, keys=None, inputs=(), record=None):
+        '''
+        Computes a hash of the values of the specified settings and the
+        identities of the specified input files (see output_utils.
+        file_identity).
+
+        Parameters
+        ----------
+        keys: list[str] or None
+            Names of the settings to include. If None, uses those returned by
+            tracked_settings.
+
+        inputs: list[str]
+            Paths to the input files.
+
+        record: dict or None
+            Record of fingerprints identifying any inputs made by earlier
+            stages (see output_utils.read_fingerprint_record).
+
+        Returns
+        -------
+        fp: str
+            The fingerprint.
+
+        keys: list[str]
+            Names of the settings included.
+        '''
+        import hashlib
+        import json
+        from output_utils import file_identity
+
+        if keys is None:
+            keys = self.tracked_settings()
+        keys = sorted(keys)
+        values = {k: self.config_dict.get(k) for k in keys}
+        ids = [file_identity(f, record=record, exclude=self.stage)
+               for f in inputs]
+        s = json.dumps([values, ids], sort_keys=True, default=str)
+        return hashlib.sha256(s.encode()).hexdigest(), keys
+
+    def outputs_unchanged(self, out_dir, outputs, inputs=()):
+        '''
+        Determines whether the outputs of the stage in a given directory can
+        be reused, i.e. whether skip_unchanged is set, the settings of the
+        stage and the inputs used when they were made are unchanged, and
+        every output still exists unchanged since it was recorded as made by
+        that run.
+
+        Parameters
+        ----------
+        out_dir: str
+            Directory containing the record of fingerprints (fingerprint_file).
+
+        outputs: list[str]
+            Paths to the outputs of the stage.
+
+        inputs: list[str]
+            Paths to the inputs of the stage.
+
+        Returns
+        -------
+        unchanged: bool
+            Whether the outputs can be reused.
+        '''
+        import os
+        from output_utils import read_fingerprint_record, file_stat
+
+        if not self.skip_unchanged:
+            return False
+        record = read_fingerprint_record(f'{out_dir}/{self.fingerprint_file}')
+        if self.stage not in record:
+            return False
+        # Include any settings tracked now but not when the record was made
+        keys = set(record[self.stage]['keys']) | set(self.tracked_settings())
+        fp, _ = self.fingerprint(keys=keys, inputs=inputs, record=record)
+        if fp != record[self.stage]['fingerprint']:
+            return False
+        files = record.get('_files', {})
+        for o in outputs:
+            entry = files.get(os.path.abspath(o))
+            if (entry is None) or (entry['stat'] != file_stat(o)) or \
+                    (entry['fingerprints'].get(self.stage) != fp):
+                return False
+        return True
+
+    def record_fingerprint(self, out_dir, outputs, inputs=()):
+        '''
+        Computes the fingerprint of the stage from its settings (see
+        tracked_settings), and records it (along with the names of the
+        settings) in the fingerprint_file in the specified directory. The
+        size and modification time of each output are recorded alongside it,
+        so the outputs themselves are never modified. Outputs that are also
+        inputs (i.e. modified in place) keep the fingerprints of earlier
+        stages.
+
+        Parameters
+        ----------
+        out_dir: str
+            Directory in which to record the fingerprint.
+
+        outputs: list[str]
+            Paths to the outputs of the stage.
+
+        inputs: list[str]
+            Paths to the inputs of the stage.
+
+        Returns
+        -------
+        fp: str
+            The fingerprint.
+        '''
+        import os
+        from output_utils import read_fingerprint_record, \
+            write_fingerprint_record, file_stat
+
+        record_file = f'{out_dir}/{self.fingerprint_file}'
+        record = read_fingerprint_record(record_file)
+        files = record.setdefault('_files', {})
+        for o in outputs:
+            key = os.path.abspath(o)
+            fps = {}
+            # Files modified in place still derive from the earlier stages
+            if (o in inputs) and (key in files):
+                fps = files[key]['fingerprints']
+            fps.pop(self.stage, None)
+            files[key] = {'stat': file_stat(o), 'fingerprints': fps}
+        fp, keys = self.fingerprint(inputs=inputs, record=record)
+        record[self.stage] = {'fingerprint': fp, 'keys': keys}
+        for o in outputs:
+            files[os.path.abspath(o)]['fingerprints'][self.stage] = fp
+        write_fingerprint_record(record_file, record)
+        return fp
+
     @staticmethod
     def get_field_boundaries(field):
         '''
@@ -256,9 +665,13 @@ class PipelineConfig():
         return bounds
 
     @staticmethod
-    def combine_flags(dataset, flagcols, combine_type='or'):
+    def combine_flags(dataset, flagcols, combine_type='or',
+                      chunk_size=1000000):
         '''
         Combines flag columns with the specified operation ('and' or 'or').
+        The flags are read and combined in place one chunk of rows at a time,
+        and the remaining flags are skipped for any chunk whose result is
+        already determined.
 
         Parameters
         ----------
@@ -271,26 +684,41 @@ class PipelineConfig():
         combine_type: str
             Operation to be used to combine the flags ('and' or 'or').
 
+        chunk_size: int
+            Number of rows to read and combine at a time.
+
         Returns
         -------
         flags_comb: array-like
             The result of combining the flags.
         '''
+        import numpy as np
 
         # See if valid combine_type has been chosen
         combine_type = combine_type.lower()
         if combine_type not in ['or', 'and']:
             raise TypeError('combine_type must be either "and" or "or" '
                             '(capital letters allowed).')
+        if len(flagcols) == 0:
+            raise ValueError('No flag columns provided.')
 
-        def combine(x, y):
-            if combine_type == 'or':
-                return x + y
-            else:
-                return x * y
-
-        flags_comb = [dataset[fl][:] for fl in flagcols]
-        from functools import reduce
-        flags_comb = reduce(combine, flags_comb)
+        if combine_type == 'or':
+            combine = np.logical_or
+        else:
+            combine = np.logical_and
+
+        N = len(dataset[flagcols[0]])
+        flags_comb = np.empty(N, dtype=bool)
+        for i0 in range(0, N, chunk_size):
+            flags_chunk = flags_comb[i0:i0+chunk_size]
+            flags_chunk[:] = dataset[flagcols[0]][i0:i0+chunk_size]
+            for fl in flagcols[1:]:
+                # Stop if every row is already flagged (or unflagged for AND)
+                if combine_type == 'or' and flags_chunk.all():
+                    break
+                if combine_type == 'and' and not flags_chunk.any():
+                    break
+                combine(flags_chunk, dataset[fl][i0:i0+chunk_size],
+                        out=flags_chunk)
 
         return flags_comb
@@ -20,6 +20,7 @@ from astropy.coordinates import SkyCoord
 from astropy.table import Table, hstack
 from sklearn.neighbors import NearestNeighbors
 import scipy.spatial as spatial
+from output_utils import open_catalogue
 
 # SETTINGS #
 config_file = sys.argv[1]
@@ -35,8 +36,7 @@ print('Loading data...')
 # see if a catalogue containing HSC phtoometry in the COSMOS field exists
 if os.path.exists(cf.hsc_cosmos_cat):
     # Load the data and convert to an astropy Table
-    with h5py.File(cf.hsc_cosmos_cat, 'r') as hf:
-        gp = hf['photometry']
+    with open_catalogue(cf.hsc_cosmos_cat) as gp:
         # Columns to include in the Table
         cols_hsc = ['ra', 'dec']
         cols_hsc += [f'{b}_cmodel_mag' for b in cf.bands.all]
@@ -6,9 +6,8 @@ import sys
 from configuration import PipelineConfig as PC
 import healsparse as hsp
 import numpy as np
-from output_utils import colour_string
+from output_utils import colour_string, open_catalogue
 import map_utils as mu
-import h5py
 
 # SETTINGS #
 config_file = sys.argv[1]
@@ -19,18 +18,42 @@ cf = PC(config_file, stage='makeGalaxyMaps')
 #    FUNCTIONS    #
 ###################
 
-def makeNgalMaps(cat, footprint):
+def countGalaxies(cat):
     '''
-    Creates galaxy count maps for each tomographic bin.
+    Counts the galaxies from every sample in each pixel at nside_hi.
 
     Parameters
     ----------
-    cat: h5py.File object
-        Catalogue containing (at least): RAs, Decs, and dust attenuation
-        values at each of these coordinates in each of the specified bands.
+    cat: HDFCatalogue or ParquetCatalogue
+        Catalogue containing (at least): RAs and Decs (or pixel IDs), and the
+        bitmask identifying the samples to which each source belongs.
+
+    Returns
+    -------
+    ngal: PixelStatistics
+        Number of galaxies from each sample in each occupied pixel.
+    '''
+    print('Counting galaxies...')
+    labels = [k for k in cf.samples]
+    # Count the galaxies from every sample in each pixel, reading the pixel
+    # IDs and the membership of every sample one chunk of rows at a time
+    ngal = mu.PixelStatistics(labels, stats=['sum'])
+    cat = mu.PixelCache(cat, hpix_nside=cf.hpix_nside)
+    for chunk in cat.chunks(cf.chunk_size):
+        sample_masks = cf.unpack_samples(chunk[cf.sample_bitmask][:])
+        ngal.add(chunk.pix(cf.nside_hi), [sample_masks[k] for k in labels])
+    return ngal
+
 
-    group: str
-        Group within which the relevant data are expected to reside.
+def makeNgalMaps(ngal, footprint):
+    '''
+    Creates galaxy count maps for each tomographic bin.
+
+    Parameters
+    ----------
+    ngal: PixelStatistics
+        Number of galaxies from each sample in each occupied pixel, at the
+        resolution of the footprint.
 
     footprint: HealSparseMap
         HealSparse map identifying the pixels in which sources reside.
@@ -45,18 +68,21 @@ def makeNgalMaps(cat, footprint):
     print('Creating galaxy count maps...')
     # Initialise a recarray to contain the maps for each band
     labels = [k for k in cf.samples]
-    ngal_maps, _, _ = mu.initialiseRecMap(cf.nside_lo, cf.nside_hi, labels,
+    ngal_maps, _, _ = mu.initialiseRecMap(cf.nside_lo, footprint.nside_sparse,
+                                          labels,
                                           pixels=footprint.valid_pixels,
                                           dtypes='f8')
-
-    # Cycle through the sample definitions and count the galaxies in each pixel
-    for k in cf.samples:
-        sel = cat[k][:]
-        _, ngal = mu.countsInPixels(cat['ra'][sel], cat['dec'][sel],
-                                    cf.nside_lo, cf.nside_hi,
-                                    footprint.valid_pixels,
-                                    return_vals=True)
-        ngal_maps[k][footprint.valid_pixels] = np.asarray(ngal, dtype='f8')
+    # Locate each pixel of the footprint among the occupied pixels (-1 for
+    # those containing no galaxies)
+    vpix = footprint.valid_pixels
+    rows = mu.valuesAtPixels(ngal.pix, np.arange(len(ngal.pix)), vpix,
+                             fill=-1)
+    found = rows >= 0
+    # Fill the maps for all samples in a single update
+    values = np.zeros(len(vpix), dtype=ngal_maps.dtype)
+    for j, k in enumerate(labels):
+        values[k][found] = ngal.sum[rows[found], j]
+    ngal_maps.update_values_pix(vpix, values)
 
     return ngal_maps
 
@@ -92,7 +118,7 @@ def makeDensityMaps(ngal_maps, mask):
     # Initialise a recarray to contain the maps for each band
     labels = [k for k in cf.samples]
     # Make a copy of the inputted recarray
-    deltag_maps, *_ = mu.initialiseRecMap(cf.nside_lo, cf.nside_hi, labels,
+    deltag_maps, *_ = mu.initialiseRecMap(cf.nside_lo, mask.nside, labels,
                                           pixels=mask.vpix_nest, dtypes='f8')
     for k in cf.samples:
         # Calculate mean galaxy counts and mean weight for pixels being kept
@@ -115,18 +141,47 @@ for fd in cf.fields:
     print(colour_string(fd.upper(), 'orange'))
     # Output directory for this field
     OUT = cf.paths.out + fd
-    # Load the fully cleaned galaxy catalogue for this field
-    cat_main = h5py.File(f'{OUT}/{cf.cats.main}', 'r')['photometry']
-    # Load the survey footprint and mask
-    footprint = hsp.HealSparseMap.read(f'{OUT}/footprint_{cf.nside_hi}.hsp')
-    survey_mask = mu.MaskData(f'{OUT}/{cf.maps.survey_mask}')
-
-    # Make galaxy count maps in each redsift bin and store in a single recarray
-    ngal_maps = makeNgalMaps(cat_main, footprint)
-    # Write to a file
-    ngal_maps.write(f'{OUT}/{cf.maps.ngal_maps}', clobber=True)
-
-    # Make the delta_g maps in each redsift bin and store in a single recarray
-    deltag_maps = makeDensityMaps(ngal_maps, survey_mask)
-    # Write to a file
-    deltag_maps.write(f'{OUT}/{cf.maps.deltag_maps}', clobber=True)
+    # Names of the maps at each resolution
+    names = {nside: cf.get_map_names(nside)
+             for nside in cf.get_nside_levels()}
+    inputs = [f'{OUT}/{cf.cats.main}']
+    outputs = []
+    for mp_names in names.values():
+        inputs += [f'{OUT}/{mp_names.footprint}',
+                   f'{OUT}/{mp_names.survey_mask}']
+        outputs += [f'{OUT}/{mp_names.ngal_maps}',
+                    f'{OUT}/{mp_names.deltag_maps}']
+    # Skip this field if its settings and inputs are unchanged
+    if cf.outputs_unchanged(OUT, outputs, inputs):
+        print('Settings and inputs unchanged; skipping.')
+        continue
+    # Count the galaxies in the fully cleaned catalogue for this field
+    cat_main = open_catalogue(f'{OUT}/{cf.cats.main}')
+    ngal_hi = countGalaxies(cat_main)
+    cat_main.close()
+
+    # Cycle through the resolutions (from finest to coarsest)
+    for nside, mp_names in names.items():
+        if nside != cf.nside_hi:
+            print(f'Making maps at NSIDE {nside}...')
+            ngal = ngal_hi.degrade(cf.nside_hi, nside)
+        else:
+            ngal = ngal_hi
+        # Load the survey footprint and mask
+        footprint = hsp.HealSparseMap.read(f'{OUT}/{mp_names.footprint}')
+        survey_mask = mu.MaskData(f'{OUT}/{mp_names.survey_mask}')
+
+        # Make galaxy count maps in each redsift bin and store in a single
+        # recarray
+        ngal_maps = makeNgalMaps(ngal, footprint)
+        # Write to a file
+        ngal_maps.write(f'{OUT}/{mp_names.ngal_maps}', clobber=True)
+
+        # Make the delta_g maps in each redsift bin and store in a single
+        # recarray
+        deltag_maps = makeDensityMaps(ngal_maps, survey_mask)
+        # Write to a file
+        deltag_maps.write(f'{OUT}/{mp_names.deltag_maps}', clobber=True)
+
+    # Record the settings and inputs used for this field
+    cf.record_fingerprint(OUT, outputs, inputs)
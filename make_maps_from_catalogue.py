@@ -6,37 +6,193 @@
 #    - masked fraction map
 #    - depth map
 #    - survey mask
+# - The per-pixel statistics needed for every map are accumulated in a single
+#   pass over the catalogues. If chunk_size is set in the config file, they
+#   are read in blocks of rows, and per-pixel totals from each block are
+#   merged as they are read. If ncores > 1, the blocks are processed in
+#   parallel, with the totals held in shared memory.
+# - If pyramid_nsides is set in the config file, every map is also made at
+#   each of the coarser resolutions, from totals obtained by aggregating the
+#   per-pixel statistics at nside_hi (no further pass over the catalogues).
 ##############################################################################
 
 import os
 import sys
+import multiprocessing as mp
 from configuration import PipelineConfig as PC
 import healpy as hp
 import healsparse as hsp
 import numpy as np
-from output_utils import colour_string
+from output_utils import colour_string, catalogue_view
 import map_utils as mu
 import h5py
 
 # SETTINGS #
 config_file = sys.argv[1]
 cf = PC(config_file, stage='makeMapsFromCat')
-npix = hp.nside2npix(cf.nside_hi)
+# Number of processes to use when accumulating the statistics for each map
+ncores = max(1, min(mp.cpu_count()-1, cf.ncores))
 
 ###################
 #    FUNCTIONS    #
 ###################
 
 
-def makeFootprint(cat, nside):
+def accumulateStats(OUT):
+    '''
+    Accumulates the statistics needed for every map in each pixel, reading
+    each chunk of rows from the catalogues only once. If using multiple
+    cores, the chunks are processed in parallel by a pool of processes, each
+    of which adds its results to accumulators held in shared memory.
+
+    Parameters
+    ----------
+    OUT: str
+        Output directory for the current field.
+
+    Returns
+    -------
+    stats: dict[PixelStatistics]
+        Accumulated statistics for the footprint ('footprint'), dust maps
+        ('dust'), bright object mask ('bo_mask'), masked fraction map
+        ('masked_frac'), star counts map ('stars') and depth map ('depth'),
+        as well as the masked fraction at the resolution used for the survey
+        mask ('masked_frac_mask').
+    '''
+    def open_basic():
+        return h5py.File(f'{OUT}/{cf.cats.basic}', 'r')['photometry']
+
+    def open_stars():
+        return catalogue_view(
+            h5py.File(f'{OUT}/{cf.cats.stars}', 'r')['photometry'])
+
+    # Resolution of the masked fraction map from which the survey mask is made
+    nside_mask = cf.nside_mask if cf.highres_first else cf.nside_hi
+    # Get the columns containing the flags to be incorporated in the mask
+    flags = []
+    for fl in cf.flags_to_mask:
+        flags.extend(cf.flags[fl])
+    dust_labels = [f'a_{b}' for b in cf.bands.all]
+
+    # If told to use stars only for the depth, use flags to identify them
+    stars_only = cf.stars_for_depth
+    if stars_only and ('is_star' not in open_basic()):
+        print(colour_string('Error: '),
+              'No dataset "is_star" found. Using all sources instead.')
+        stars_only = False
+    # Retrieve the SNR threshold
+    snr_thresh = int(cf.sn_pri)
+
+    def depth_quants(chunk):
+        # Get the pixel IDs and the flux error in the primary band for each
+        # source, multiplying the latter by the SNR threshold
+        pix = chunk.pix(cf.nside_hi)
+        fluxerr = chunk[f'{cf.bands.primary}_cmodel_fluxerr'][:]
+        if stars_only:
+            star_mask = chunk['is_star'][:]
+            pix = pix[star_mask]
+            fluxerr = fluxerr[star_mask]
+        return pix, [snr_thresh * fluxerr]
+
+    # Resolution, quantity labels, statistics and a function returning the
+    # pixel IDs and quantities for each chunk, for each set of statistics
+    specs = {
+        'footprint': (cf.nside_hi, [], ['count'],
+                      lambda c: (c.pix(cf.nside_hi), None)),
+        'dust': (cf.nside_hi, dust_labels, ['mean'],
+                 lambda c: (c.pix(cf.nside_hi),
+                            [c[lb][:] for lb in dust_labels])),
+        'bo_mask': (cf.nside_hi, ['flagged'], ['max'],
+                    lambda c: (c.pix(cf.nside_hi),
+                               [cf.combine_flags(c, cf.flags.brightstar)])),
+        'masked_frac': (cf.nside_hi, ['flagged'], ['mean'],
+                        lambda c: (c.pix(cf.nside_hi),
+                                   [cf.combine_flags(c, flags)])),
+        'depth': (cf.nside_hi, ['depth'], ['mean'], depth_quants)
+    }
+    if nside_mask != cf.nside_hi:
+        specs['masked_frac_mask'] = (nside_mask, ['flagged'], ['mean'],
+                                     lambda c: (c.pix(nside_mask),
+                                                [cf.combine_flags(c, flags)]))
+    star_spec = (cf.nside_hi, [], ['count'],
+                 lambda c: (c.pix(cf.nside_hi), None))
+
+    if ncores > 1:
+        print(f'Accumulating statistics using {ncores} processes...')
+        # Shared accumulators need the occupied pixels to be known in advance
+        # (the stars are a subset of the basic-cleaned sources). This costs
+        # an extra pass over the positions (or hpix column) of the basic
+        # catalogue, which the serial accumulators avoid by growing as
+        # chunks are added
+        occupied = mu.occupiedPixels(open_basic, {cf.nside_hi, nside_mask},
+                                     chunk_size=cf.chunk_size, ncores=ncores,
+                                     hpix_nside=cf.hpix_nside)
+
+        def new_stats(nside, labels, stats):
+            return mu.SharedPixelStatistics(occupied[nside], labels, stats,
+                                            nslots=ncores)
+    else:
+        print('Accumulating statistics...')
+
+        def new_stats(nside, labels, stats):
+            return mu.PixelStatistics(labels, stats)
+
+    accs = {}
+    for cat_open, cat_specs in [(open_basic, specs),
+                                (open_stars, {'stars': star_spec})]:
+        jobs = []
+        for key, (nside, labels, stats, quants) in cat_specs.items():
+            accs[key] = new_stats(nside, labels, stats)
+            jobs.append((accs[key], quants))
+        mu.accumulateChunks(cat_open, jobs, chunk_size=cf.chunk_size,
+                            ncores=ncores, hpix_nside=cf.hpix_nside)
+    if ncores > 1:
+        # Combine the totals from each process
+        accs = {key: accs[key].reduce() for key in accs}
+    accs.setdefault('masked_frac_mask', accs['masked_frac'])
+
+    return accs
+
+
+def degradeStats(stats, nside):
+    '''
+    Aggregates the per-pixel statistics accumulated at nside_hi to a coarser
+    resolution.
+
+    Parameters
+    ----------
+    stats: dict[PixelStatistics]
+        Statistics for each map, as returned by accumulateStats.
+
+    nside: int
+        Resolution to which the statistics are to be aggregated.
+
+    Returns
+    -------
+    stats_out: dict[PixelStatistics]
+        Statistics for each map at the new resolution.
+    '''
+    if nside == cf.nside_hi:
+        return stats
+    stats_out = {key: acc.degrade(cf.nside_hi, nside)
+                 for key, acc in stats.items() if key != 'masked_frac_mask'}
+    # The high-resolution masked fraction is used directly by makeSurveyMask
+    if cf.highres_first:
+        stats_out['masked_frac_mask'] = stats['masked_frac_mask']
+    else:
+        stats_out['masked_frac_mask'] = stats_out['masked_frac']
+    return stats_out
+
+
+def makeFootprint(occupied, nside):
     '''
     Defines the survey footprint as any pixel in a map of resolution NSIDE
     within which there are sources. Returns a boolean HealSparse map.
 
     Parameters
     ----------
-    cat: h5py Dataset or Group
-        Catalogue containing (at least): RAs, Decs.
+    occupied: PixelStatistics
+        Source counts in each pixel at this resolution.
 
     nside: int
         Determines the resolution of the footprint. (Left as an argument rather
@@ -50,55 +206,54 @@ def makeFootprint(cat, nside):
 
     print(f'Determining survey footprint at NSIDE={nside}...')
 
-    # Get the pixel IDs corresponding to each source
-    ipix_all = hp.ang2pix(nside, cat['ra'][:], cat['dec'][:],
-                          lonlat=True, nest=True)
-    # Identify pixels where sources exist
-    nall = np.bincount(ipix_all, minlength=npix)
-    footprint = nall > 0
     # Set up empty HealSparse boolean map
     footprint_hsp = hsp.HealSparseMap.make_empty(cf.nside_lo, nside, bool)
     # Fill the occupied pixels with True
-    footprint_hsp[np.where(footprint)[0]] = True
+    footprint_hsp[occupied.pix] = True
 
     return footprint_hsp
 
 
-def makeDustMap(cat, band='i'):
+def makeDustMap(dust, nside, bands=['i']):
     '''
     Creates dust maps for each of the specified bands.
 
     Parameters
     ---------
-    cat: h5py Dataset or Group
-        Catalogue containing (at least): RAs, Decs, and dust attenuation
-        values at each of these coordinates in each of the specified bands.
+    dust: PixelStatistics
+        Mean dust attenuation in each pixel in each of the specified bands
+        (labels 'a_<band>').
+
+    nside: int
+        Resolution of the maps.
+
+    bands: list[str]
+        Bands for which to make dust maps.
 
     Returns
     -------
     dust_maps: recarray
         recarray for which each entry is a dust attenuation map in each of
-        the specified bands.
+        the specified bands (fields 'a_<band>_mean').
     '''
 
-    print(f'Creating dust map (band {band})...')
-
-    # Cycle through bands and calculate mean dust attenuation in each pixel
-    dust_map, _ = mu.createMeanStdMap(cat['ra'][:], cat['dec'][:],
-                                      cat[f'a_{band}'][:], cf.nside_lo,
-                                      cf.nside_hi)
+    print(f'Creating dust maps (bands {", ".join(bands)})...')
+    dust_maps = dust.get_map(cf.nside_lo, nside)
 
-    return dust_map
+    return dust_maps
 
 
-def makeBOMask(cat):
+def makeBOMask(flagged, nside):
     '''
     Creates bright object mask.
 
     Parameters
     ---------
-    cat: h5py Dataset or Group
-        Catalogue containing (at least): RAs, Decs.
+    flagged: PixelStatistics
+        Maximum of the combined bright-object flags in each pixel.
+
+    nside: int
+        Resolution of the mask.
 
     Returns
     -------
@@ -108,27 +263,23 @@ def makeBOMask(cat):
     '''
 
     print('Creating bright object mask...')
-    # Get the RAs and Decs of all sources in the catalogue
-    ra = cat['ra'][:]
-    dec = cat['dec'][:]
-    # Get the columns containing bright-object flags
-    flags = cf.flags.brightstar
-    flags = [cat[flag][:] for flag in flags]
-
-    bo_mask = mu.createMask(ra, dec, flags, cf.nside_lo, cf.nside_hi)
+    # Set pixels containing sources to 1, or 0 if any sources are flagged
+    bo_mask = hsp.HealSparseMap.make_empty(cf.nside_lo, nside, np.int32)
+    bo_mask[flagged.pix] = (flagged.max[:, 0] == 0).astype(np.int32)
 
     return bo_mask
 
 
-def makeMaskedFrac(cat, nside):
+def makeMaskedFrac(flagged, nside):
     '''
     Creates a map showing the fraction of each pixel that is maske by the
     bright object criteria.
 
     Parameters
     ---------
-    cat: h5py Dataset or Group
-        Catalogue containing (at least): RAs, Decs.
+    flagged: PixelStatistics
+        Mean of the combined flags to be masked in each pixel at this
+        resolution.
 
     nside: int
         Determines the resolution of the map. (Left as an argument rather
@@ -141,45 +292,24 @@ def makeMaskedFrac(cat, nside):
     '''
 
     print('Creating masked fraction map...')
-    # Get the RAs and Decs of all sources in the catalogue
-    ra = cat['ra'][:]
-    dec = cat['dec'][:]
-    # Get the columns containing the flags to be incorporated in the mask
-    flags = []
-    for fl in cf.flags_to_mask:
-        flags.extend(cf.flags[fl])
-    # Combine the flags (OR operation)
-    flagged = cf.combine_flags(cat, flags)
-
-    # Get the valid pixels at the desired resolution
-    vpix = makeFootprint(cat, nside).valid_pixels
-
-    # Create counts map of all sources
-    Ntotal_map = mu.countsInPixels(ra, dec, cf.nside_lo, nside, vpix)
-    # Create counts map of flagged sources
-    Nflagged_map = mu.countsInPixels(ra[flagged], dec[flagged], cf.nside_lo,
-                                     nside, vpix)
-    # Calculate the fraction of masked sources in each pixel
-    mf_map = hsp.HealSparseMap.make_empty(cf.nside_lo, nside, dtype=np.float64)
-    mf_map[vpix] = Nflagged_map[vpix] / Ntotal_map[vpix]
+    mf_map = flagged.get_map(cf.nside_lo, nside)
+    mf_map = mf_map.get_single('flagged_mean', copy=True)
 
     return mf_map
 
 
-def makeStarMap(cat, footprint):
+def makeStarMap(stars, footprint):
     '''
     Creates map showing the number of stars in each pixel.
 
     Parameters
     ---------
-    cat: h5py Dataset or Group
-        Catalogue containing (at least): RAs and Decs of each star detected in
-        the field.
+    stars: PixelStatistics
+        Number of stars in each pixel.
 
-    footprint: HealSparseMap or None
-        If provided, must be a Healpsarse boolean map identifying pixels
-        belonging to the survey footprint. If not provided, will make from
-        scratch using the catalogue.
+    footprint: HealSparseMap
+        Healpsarse boolean map identifying pixels belonging to the survey
+        footprint (at the same resolution as the star counts).
 
     Returns
     -------
@@ -187,30 +317,28 @@ def makeStarMap(cat, footprint):
         HealSparse map containing the number of stars in each pixel.
     '''
     print('Creating star counts map...')
-    # Get the RAs and Decs of all sources in the catalogue
-    ra = cat['ra'][:]
-    dec = cat['dec'][:]
-
     # Identify pixels in the survey footprint
     vpix = footprint.valid_pixels
-    # Count the stars in each pixel
-    star_map = mu.countsInPixels(ra, dec, cf.nside_lo, cf.nside_hi, vpix)
+    star_map = hsp.HealSparseMap.make_empty(cf.nside_lo,
+                                            footprint.nside_sparse, np.int32)
+    star_map[vpix] = mu.valuesAtPixels(stars.pix, stars.count,
+                                       vpix).astype(np.int32)
 
     return star_map
 
 
-def makeDepthMap(cat, stars_only=True, min_sources=0, footprint=None):
+def makeDepthMap(depth, nside, min_sources=0, footprint=None):
     '''
     Creates map showing the number of stars in each pixel.
 
     Parameters
     ---------
-    cat: h5py Dataset or Group
-        Catalogue containing (at least): RAs and Decs of each star detected in
-        the field.
+    depth: PixelStatistics
+        Mean flux error in the primary band multiplied by the SNR threshold
+        in each pixel (label 'depth').
 
-    stars_only: bool
-        Whether to just use stars for the calculation of the depth.
+    nside: int
+        Resolution of the map.
 
     min_sources: int
         Minimum number of sources required in a pixel for depth to be
@@ -230,45 +358,23 @@ def makeDepthMap(cat, stars_only=True, min_sources=0, footprint=None):
     '''
     print('Creating depth map...')
 
-    # If told to use stars only, use flags to identify which sources are stars
-    if stars_only:
-        try:
-            star_mask = cat['is_star'][:]
-        except KeyError:
-            print(colour_string('Error: '),
-                  'No dataset "is_star" found. Using all sources instead.')
-            star_mask = np.full(len(cat['ra']), True)
-    else:
-        star_mask = np.full(len(cat['ra']), True)
-
-    # Get the RAs and Decs of all sources in the catalogue
-    ra = cat['ra'][star_mask]
-    dec = cat['dec'][star_mask]
-
-    # Retrieve the flux error in the primary band for each source
-    fluxerr = cat[f'{cf.bands.primary}_cmodel_fluxerr'][star_mask]
-    # Retrieve the SNR threshold
-    snr_thresh = int(cf.sn_pri)
-
     # Create a map containing the mean fluxerr multiplied by the SNR threshold
-    depth_map, _ = mu.createMeanStdMap(ra, dec, snr_thresh * fluxerr,
-                                       cf.nside_lo, cf.nside_hi)
+    stats_map = depth.get_map(cf.nside_lo, nside)
+    depth_map = stats_map.get_single('depth_mean', copy=True)
 
     # If a minimum number of sources is required, use interpolation to fill in
     # the values for pixels with fewer sources
     if min_sources > 0:
+        # Number of sources in each pixel (0 outside the occupied pixels)
+        counts = stats_map.get_single('count', copy=True)
         if footprint:
             vpix_fp = footprint.valid_pixels
-            counts = mu.countsInPixels(ra, dec, cf.nside_lo,
-                                       cf.nside_hi, vpix_fp)
         else:
-            counts = mu.pixelCountsFromCoords(ra, dec,
-                                              cf.nside_lo, cf.nside_hi)
             vpix_fp = counts.valid_pixels
         # Identify valid pixels with fewer sources than the limit
         pix_few = vpix_fp[counts[vpix_fp] < min_sources]
         # Get the coordinates of these pixels
-        ra_few, dec_few = hp.pix2ang(cf.nside_hi, pix_few,
+        ra_few, dec_few = hp.pix2ang(nside, pix_few,
                                      nest=True, lonlat=True)
         # Get values of these pixels through nearest-neighbour interpolation
         pix_new_vals = depth_map.interpolate_pos(ra_few, dec_few, lonlat=True,
@@ -283,16 +389,39 @@ def makeDepthMap(cat, stars_only=True, min_sources=0, footprint=None):
     return depth_map
 
 
-def makeSurveyMask(cat, depth_map=None):
+def nexpPaths(nside):
+    '''
+    Returns the paths of the N_exp maps made by decasu in each band at the
+    specified resolution for the current field.
+
+    Parameters
+    ----------
+    nside: int
+        Resolution of the maps.
+
+    Returns
+    -------
+    paths: list[str]
+        Path of the map in each band.
+    '''
+    return [f'{PATH_SYST}/decasu_nside{nside}_{b}_nexp_sum.hsp'
+            for b in cf.bands.all]
+
+
+def makeSurveyMask(flagged, nside, depth_map=None):
     '''
     Creates a binary mask from the masked fraction map by applying a threshold
     for the masked fraction.
 
     Parameters
     ----------
-    cat: h5py Dataset or Group
-        Catalogue containing (at least): RAs and Decs of each star detected in
-        the field.
+    flagged: PixelStatistics
+        Mean of the combined flags to be masked in each pixel, at NSIDE
+        nside_mask if told to make the mask at high resolution first in the
+        config file (otherwise at the resolution of the mask).
+
+    nside: int
+        Resolution of the mask.
 
     depth_map: HealSparseMap or None
         (Optional) Map of the survey depth. If provided, will additionally set
@@ -308,31 +437,19 @@ def makeSurveyMask(cat, depth_map=None):
 
     # Create the masked fraction map using flags from the catalogue
     if cf.highres_first:
-        # If initially making the mask at high resolution the process becomes
-        # somewhat convoluted, as one needs to identify pixels with 0 galaxies
-        # that also lie within the footprint...
-        nside = cf.nside_mask
-        # First the footprint must be defined at the resolution of the maps,
-        # then upgraded to high resolution (HealSparse format)
-        fp = makeFootprint(cat, cf.nside_hi).upgrade(nside)
-        # Then the masked fraction must be computed at high resolution
-        # (HealSparse format)
-        mask = makeMaskedFrac(cat, nside)
-        vpix = mask.valid_pixels
-        # Fill valid pixels using the masked fraction map
-        mask[vpix] = 1. - mask[vpix]
-        # Identify valid pixels in the footprint
-        vpix_fp = fp.valid_pixels
-        # Identify which of these pixels weren't valid in masked fraction map
-        vpix_empty = list(set(vpix_fp) - set(vpix))
-        # Set these pixels equal to 0
-        mask[vpix_empty] = 0.
-        # Degrade the mask to the final resolution
-        mask = mask.degrade(cf.nside_hi)
+        # If initially making the mask at high resolution, the unmasked
+        # fraction of each occupied high-resolution pixel is averaged over
+        # the subpixels of each pixel at the final resolution, with empty
+        # subpixels (within the footprint) counting as fully masked
+        unmasked = 1. - flagged.sum[:, 0] / flagged.count
+        pix, frac = mu.degradePixels(flagged.pix, unmasked, cf.nside_mask,
+                                     nside, reduction='mean')
+        mask = hsp.HealSparseMap.make_empty(cf.nside_lo, nside, np.float64)
+        mask[pix] = frac
         vpix = mask.valid_pixels
     else:
         # Otherwise, define the mask simply as 1-masked_fraction
-        mask = makeMaskedFrac(cat, cf.nside_hi)
+        mask = makeMaskedFrac(flagged, nside)
         vpix = mask.valid_pixels
         mask[vpix] = 1. - mask[vpix]
 
@@ -345,33 +462,54 @@ def makeSurveyMask(cat, depth_map=None):
         vpix_shallow = vpix_dm[depth_map[vpix_dm] < cf.depth_cut]
         mask[vpix_shallow] = hp.UNSEEN
 
-        # Create a full-sky binary version of the depth map
-        depth_bin = depth_map[:] >= cf.depth_cut
-        # Smooth it with a Guassian kernel
-        depth_bin = hp.smoothing(depth_bin, np.radians(cf.r_smooth), nest=True)
+        # Create a binary version of the depth map and smooth it with a
+        # Gaussian kernel (evaluating the result at the valid pixels only)
+        depth_bin = depth_map[vpix_dm] >= cf.depth_cut
+        depth_bin = mu.smoothSparse(vpix_dm, depth_bin, nside,
+                                    np.radians(cf.r_smooth), pix_out=vpix,
+                                    nside_work=cf.smooth_nside_work)
         # Identify valid pixels below 0.5 in the smoothed version
-        vpix_shallow = np.where(depth_bin[vpix] < 0.7)[0]
+        vpix_shallow = np.where(depth_bin < 0.7)[0]
         mask[vpix[vpix_shallow]] = hp.UNSEEN
 
     if cf.use_nexp_maps:
+        # Use the N_exp maps made by decasu at this resolution if they exist
+        # (see make_maps_from_metadata.py); otherwise approximate them from
+        # those at nside_hi
+        nside_nexp = nside
+        if not all(os.path.exists(f) for f in nexpPaths(nside)):
+            print(f'No N_exp maps at NSIDE {nside}; approximating from the '
+                  f'fraction of each pixel with exposures at NSIDE '
+                  f'{cf.nside_hi}.')
+            nside_nexp = cf.nside_hi
         # Set up a list of maps to be combined into a binary map
         nexp_bin = []
         # Load the N_exp maps for each band
-        for b in cf.bands.all:
-            nexp = hsp.HealSparseMap.read(f'{PATH_SYST}/decasu_nside'
-                                          f'{cf.nside_hi}_{b}_nexp_sum.hsp')
+        for fname in nexpPaths(nside_nexp):
+            nexp = hsp.HealSparseMap.read(fname)
             # Set all pixels with n_exp > 1 equal to 1
             nexp[nexp.valid_pixels] = 1
             nexp_bin.append(nexp)
         # Identify all pixels with exposures in all frames
         nexp_bin = hsp.operations.and_union(nexp_bin)
-        # Convert this to a healpix map and set all UNSEEN to 0
-        nexp_bin = nexp_bin.generate_healpix_map(nest=True)
-        nexp_bin[nexp_bin < 0] = 0
-        # Smooth with a Gaussian kernel
-        nexp_bin = hp.smoothing(nexp_bin, np.radians(cf.r_smooth), nest=True)
+        vpix_nexp = nexp_bin.valid_pixels
+        nexp_bin = nexp_bin[vpix_nexp]
+        # Without maps at this resolution, use the fraction of each pixel
+        # with exposures in all bands at nside_hi. This is not the same as
+        # the binary map at this resolution (in which a pixel counts if it
+        # has any exposures in each band), so the mask can differ from that
+        # of a separate run at this NSIDE near the edges of the footprint
+        if nside_nexp != nside:
+            vpix_nexp, nexp_bin = mu.degradePixels(vpix_nexp, nexp_bin,
+                                                   nside_nexp, nside,
+                                                   reduction='mean')
+        # Smooth with a Gaussian kernel (evaluating the result at the valid
+        # pixels only)
+        nexp_bin = mu.smoothSparse(vpix_nexp, nexp_bin, nside,
+                                   np.radians(cf.r_smooth), pix_out=vpix,
+                                   nside_work=cf.smooth_nside_work)
         # Identify valid pixels below 0.6
-        vpix_noexp = np.where(nexp_bin[vpix] < 0.7)[0]
+        vpix_noexp = np.where(nexp_bin < 0.7)[0]
         mask[vpix[vpix_noexp]] = hp.UNSEEN
 
     return mask
@@ -391,46 +529,77 @@ for fd in cf.fields:
     if not os.path.exists(PATH_SYST):
         os.system(f'mkdir -p {PATH_SYST}')
 
-    # Load the basic and fully cleaned galaxy/star catalogues for this field
-    cat_basic = h5py.File(f'{OUT}/{cf.cats.basic}', 'r')['photometry']
-    cat_main = h5py.File(f'{OUT}/{cf.cats.main}', 'r')['photometry']
-    cat_stars = h5py.File(f'{OUT}/{cf.cats.stars}', 'r')['photometry']
+    inputs = [f'{OUT}/{cf.cats.basic}', f'{OUT}/{cf.cats.stars}']
+    if cf.use_nexp_maps:
+        inputs += nexpPaths(cf.nside_hi)
+        # Include the N_exp maps at coarser resolutions where they exist
+        for nside in cf.get_nside_levels()[1:]:
+            if all(os.path.exists(f) for f in nexpPaths(nside)):
+                inputs += nexpPaths(nside)
+    # Names of the maps at each resolution
+    names = {nside: cf.get_map_names(nside)
+             for nside in cf.get_nside_levels()}
+    outputs = []
+    for mp_names in names.values():
+        outputs += [f'{OUT}/{m}'
+                    for m in [mp_names.footprint, mp_names.bo_mask,
+                              mp_names.masked_frac, mp_names.depth_map,
+                              mp_names.survey_mask]]
+        outputs += [f'{PATH_SYST}/{m}'
+                    for m in mp_names.dustmaps + [mp_names.star_map]]
+    # Skip this field if its settings and inputs are unchanged
+    if cf.outputs_unchanged(OUT, outputs, inputs):
+        print('Settings and inputs unchanged; skipping.')
+        continue
+
+    # Accumulate the statistics needed for every map from the catalogues
+    stats_hi = accumulateStats(OUT)
+
+    # Cycle through the resolutions (from finest to coarsest)
+    for nside, mp_names in names.items():
+        if nside != cf.nside_hi:
+            print(f'Making maps at NSIDE {nside}...')
+        stats = degradeStats(stats_hi, nside)
+
+        # Make the footprint for the current field
+        footprint = makeFootprint(stats['footprint'], nside)
+        # Write to a file
+        footprint.write(f'{OUT}/{mp_names.footprint}', clobber=True)
+
+        # Make the dust maps in all bands
+        dust_maps = makeDustMap(stats['dust'], nside, bands=cf.bands.all)
+        for b, dm in zip(cf.bands.all, mp_names.dustmaps):
+            # Write the map in the current band to a file
+            dust_maps.get_single(f'a_{b}_mean', copy=True).write(
+                f'{PATH_SYST}/{dm}', clobber=True)
 
-    # Make the footprint for the current field
-    footprint = makeFootprint(cat_basic, cf.nside_hi)
-    # Write to a file
-    footprint.write(f'{OUT}/{cf.maps.footprint}', clobber=True)
-    # Retrieve the IDs of the occupied pixels
-    vpix = footprint.valid_pixels
+        # Make the bright object mask
+        bo_mask = makeBOMask(stats['bo_mask'], nside)
+        # Write to a file
+        bo_mask.write(f'{OUT}/{mp_names.bo_mask}', clobber=True)
+
+        # Make the masked fraction map
+        mf_map = makeMaskedFrac(stats['masked_frac'], nside)
+        # Write to a file
+        mf_map.write(f'{OUT}/{mp_names.masked_frac}', clobber=True)
 
-    for b, dm in zip(cf.bands.all, cf.maps.dustmaps):
-        # Make the dust maps in the current band
-        dust_map = makeDustMap(cat_basic, band=b)
+        # Make the star counts map
+        star_map = makeStarMap(stats['stars'], footprint)
         # Write to a file
-        dust_map.write(f'{PATH_SYST}/{dm}', clobber=True)
-
-    # Make the bright object mask
-    bo_mask = makeBOMask(cat_basic)
-    # Write to a file
-    bo_mask.write(f'{OUT}/{cf.maps.bo_mask}', clobber=True)
-
-    # Make the masked fraction map
-    mf_map = makeMaskedFrac(cat_basic, cf.nside_hi)
-    # Write to a file
-    mf_map.write(f'{OUT}/{cf.maps.masked_frac}', clobber=True)
-
-    # Make the star counts map
-    star_map = makeStarMap(cat_stars, footprint)
-    # Write to a file
-    star_map.write(f'{PATH_SYST}/{cf.maps.star_map}', clobber=True)
-
-    # Make the depth map
-    depth_map = makeDepthMap(cat_basic, stars_only=cf.stars_for_depth,
-                             min_sources=cf.min_sources, footprint=footprint)
-    # Write to a file
-    depth_map.write(f'{OUT}/{cf.maps.depth_map}', clobber=True)
-
-    # Make a survey mask by applying a masked fraction threshold
-    survey_mask = makeSurveyMask(cat_basic, depth_map=depth_map)
-    # Write to a file
-    survey_mask.write(f'{OUT}/{cf.maps.survey_mask}', clobber=True)
+        star_map.write(f'{PATH_SYST}/{mp_names.star_map}', clobber=True)
+
+        # Make the depth map
+        depth_map = makeDepthMap(stats['depth'], nside,
+                                 min_sources=cf.min_sources,
+                                 footprint=footprint)
+        # Write to a file
+        depth_map.write(f'{OUT}/{mp_names.depth_map}', clobber=True)
+
+        # Make a survey mask by applying a masked fraction threshold
+        survey_mask = makeSurveyMask(stats['masked_frac_mask'], nside,
+                                     depth_map=depth_map)
+        # Write to a file
+        survey_mask.write(f'{OUT}/{mp_names.survey_mask}', clobber=True)
+
+    # Record the settings and inputs used for this field
+    cf.record_fingerprint(OUT, outputs, inputs)
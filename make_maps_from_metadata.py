@@ -21,16 +21,20 @@ cf = PC(config_file, stage='makeMapsFromMetadata')
 
 # Retrieve the path of the Decasu config file
 configfile = cf.auxfiles.decasu_config
-# Create Configuration object for Decasu
-CONF = Configuration.load_yaml(configfile)
-
-# Overwrite the output file basenames and NSIDE to match pipeline config
-CONF.outbase = f'decasu_nside{cf.nside_hi}'
-CONF.nside = cf.nside_hi
-# Do the same with replacements for band names
-for k in cf.bands.altnames:
-    for j in cf.bands.altnames[k]:
-        CONF.band_replacement[j] = k
+# Create a Configuration object for Decasu at each resolution at which maps
+# are made (nside_hi and any levels of the map pyramid), since quantities
+# such as N_exp cannot be derived exactly from the maps at nside_hi
+CONFS = {}
+for nside in cf.get_nside_levels():
+    CONF = Configuration.load_yaml(configfile)
+    # Overwrite the output file basenames and NSIDE to match pipeline config
+    CONF.outbase = f'decasu_nside{nside}'
+    CONF.nside = nside
+    # Do the same with replacements for band names
+    for k in cf.bands.altnames:
+        for j in cf.bands.altnames[k]:
+            CONF.band_replacement[j] = k
+    CONFS[nside] = CONF
 
 # Rest of script now depends on whether it is being run locally or on glamdring
 if cf.platform == 'local':
@@ -44,21 +48,23 @@ if cf.platform == 'local':
         OUT = cf.paths.out + fd + '/'
         PATH_SYST = OUT + 'systmaps/'
 
-        # Set up Decasu mapper
-        mapper = MultiHealpixMapper(CONF, PATH_SYST, ncores=ncores)
+        for CONF in CONFS.values():
+            # Set up Decasu mapper
+            mapper = MultiHealpixMapper(CONF, PATH_SYST, ncores=ncores)
 
-        # Check if metadata was split by filter
-        if cf.split_by_band:
-            for b in cf.bands:
+            # Check if metadata was split by filter
+            if cf.split_by_band:
+                for b in cf.bands:
+                    infile = f'{cf.path.data}'\
+                             f'{cf.data_files.metadata[:-5]}_{fd}_{b}.fits'
+                    # Run the Decasu mapper for each band individually
+                    mapper(infile, bands=b, clear_intermediate_files=True)
+            else:
                 infile = f'{cf.path.data}'\
-                         f'{cf.data_files.metadata[:-5]}_{fd}_{b}.fits'
-                # Run the Decasu mapper for each band individually
+                         f'{cf.data_files.metadata[:-5]}_{fd}.fits'
+                bands = ','.join(cf.bands)
+                # Run the Decasu mapper for all bands
                 mapper(infile, bands=b, clear_intermediate_files=True)
-        else:
-            infile = f'{cf.path.data}{cf.data_files.metadata[:-5]}_{fd}.fits'
-            bands = ','.join(cf.bands)
-            # Run the Decasu mapper for all bands
-            mapper(infile, bands=b, clear_intermediate_files=True)
 
 else:
     # Retrieve band for which the script is being run from the system arguments
@@ -76,8 +82,8 @@ else:
         OUT = cf.paths.out + fd + '/'
         PATH_SYST = OUT + 'systmaps/'
 
-        # Set up Decasu mapper
-        mapper = MultiHealpixMapper(CONF, PATH_SYST, ncores=ncores)
-
         infile = f'{cf.path.data}{cf.data_files.metadata[:-5]}_{fd}_{b}.fits'
-        mapper(infile, bands=b, clear_intermediate_files=True)
+        for CONF in CONFS.values():
+            # Set up Decasu mapper
+            mapper = MultiHealpixMapper(CONF, PATH_SYST, ncores=ncores)
+            mapper(infile, bands=b, clear_intermediate_files=True)
@@ -12,6 +12,7 @@ import healsparse as hsp
 import numpy as np
 import map_utils as mu
 import glob
+from output_utils import open_catalogue
 
 
 # SETTINGS #
@@ -32,7 +33,7 @@ def make_tomography_cat(cat, fname):
 
     Parameters
     ----------
-    cat: h5py Dataset or Group
+    cat: HDFCatalogue or ParquetCatalogue
         Catalogue of galaxies, previously sorted into tomographic bins.
 
     fname: str
@@ -43,13 +44,15 @@ def make_tomography_cat(cat, fname):
     # Create an array to contain the counts in each bin
     counts = np.zeros(cf.nsamples, dtype='i8')
 
+    # Read the membership of every sample from the bitmask column at once
+    sample_masks = cf.unpack_samples(cat[cf.sample_bitmask][:])
     # Create a 1D array where galaxies can be flagged with integers if
     # belonging to a bin
-    nsources = len(cat[cat.keys()[0]][:])
+    nsources = len(sample_masks[next(iter(sample_masks))])
     zbin_flags = np.full(nsources, -1).astype(int)
     # Cycle through the redshift bins
     for i, samp in enumerate(cf.samples):
-        zmask = cat[samp][:]
+        zmask = sample_masks[samp]
         zbin_flags[zmask] = i
         counts[i] = zmask.sum()
 
@@ -122,11 +125,8 @@ for fd in cf.fields:
             fname = f'{PATH_TX}{bn[:-4]}.fits'
             mu.healsparseToFITS(hsp_map, fname, nest=False)
 
-    # Load the cleaned galaxy catalogue
-    galcat = f'{OUT}{cf.cats.main}'
-    with h5py.File(galcat, 'r') as hf:
-        # Retrieve the tomographic bin labels
-        zbin_flags = galcat['photometry/zbin'][:]
-    # Save relevant data to a tomographic catalogue
+    # Load the cleaned galaxy catalogue and save the relevant data to a
+    # tomographic catalogue
     tomo_out = PATH_TX + cf.cats.tomography
-    make_tomography_cat(zbin_flags, tomo_out)
+    with open_catalogue(f'{OUT}{cf.cats.main}') as galcat:
+        make_tomography_cat(galcat, tomo_out)
@@ -2,6 +2,7 @@
 # Functions for the creation of HealPIX/HealSparse maps.
 ##############################################################################
 
+import multiprocessing as mp
 import numpy as np
 import healpy as hp
 import healsparse as hsp
@@ -99,8 +100,443 @@ def initialiseRecMap(nside_cover, nside_sparse, labels, pixels=None, ra=None,
     return all_maps, pixels, pixels_u
 
 
+class PixelCache:
+    '''
+    Wrapper around a catalogue which caches the pixel IDs (NESTED ordering)
+    of its sources at each requested NSIDE, so that every map made from the
+    catalogue at a given resolution shares a single calculation. If the
+    catalogue contains the pixel IDs at a finer resolution (in the column
+    hpix_nest_<hpix_nside>), these are converted to coarser resolutions with
+    bit shifts; otherwise the coordinates of the sources are read once and
+    converted with ang2pix. All other columns are read from the catalogue as
+    usual. If rows is provided, only those rows of the catalogue are used,
+    and columns are returned as arrays (see chunks).
+    '''
+
+    def __init__(self, cat, hpix_nside=None, rows=None):
+        self.cat = cat
+        self.hpix_nside = hpix_nside
+        self.rows = rows
+        self._columns = {}
+        self._pix = {}
+
+    def __getitem__(self, key):
+        if key in ['ra', 'dec']:
+            if key not in self._columns:
+                self._columns[key] = self._read(key)
+            return self._columns[key]
+        if self.rows is not None:
+            return self._read(key)
+        return self.cat[key]
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(range(*self.rows.indices(len(self.cat['ra']))))
+        return len(self.cat['ra'])
+
+    def _read(self, key):
+        if self.rows is None:
+            return self.cat[key][:]
+        return self.cat[key][self.rows]
+
+    def chunks(self, chunk_size=None):
+        '''
+        Iterates over contiguous blocks of rows in the catalogue, so that
+        maps can be made without reading any column in its entirety.
+
+        Parameters
+        ----------
+        chunk_size: int or None
+            Maximum number of rows in each block. If None, the whole
+            catalogue is returned as a single block (sharing this cache).
+
+        Yields
+        ------
+        chunk: PixelCache
+            Cache for the current block of rows.
+        '''
+        if chunk_size is None:
+            yield self
+            return
+        for start in range(0, len(self), chunk_size):
+            yield PixelCache(self.cat, hpix_nside=self.hpix_nside,
+                             rows=slice(start, start + chunk_size))
+
+    def __contains__(self, key):
+        return key in self.cat
+
+    @property
+    def ra(self):
+        return self['ra']
+
+    @property
+    def dec(self):
+        return self['dec']
+
+    def pix(self, nside):
+        '''
+        Returns the pixel ID of each source at the specified resolution.
+
+        Parameters
+        ----------
+        nside: int
+            Resolution of the map.
+
+        Returns
+        -------
+        pix: numpy.array
+            Pixel IDs (NESTED ordering) of each source.
+        '''
+        if nside in self._pix:
+            return self._pix[nside]
+        col = f'hpix_nest_{self.hpix_nside}'
+        if (self.hpix_nside is not None) and (nside <= self.hpix_nside) \
+                and (col in self.cat):
+            # Each NESTED pixel contains the 4 pixels at twice its NSIDE with
+            # the same IDs bar the last 2 bits
+            shift = 2 * (int(self.hpix_nside // nside).bit_length() - 1)
+            if self.hpix_nside not in self._pix:
+                self._pix[self.hpix_nside] = self._read(col)
+            pix = self._pix[self.hpix_nside] >> shift
+        else:
+            pix = hp.ang2pix(nside, self.ra, self.dec, nest=True, lonlat=True)
+        self._pix[nside] = pix
+        return pix
+
+
+def pixelCounts(pix, pix_ids=None):
+    '''
+    Counts the number of objects in each pixel by sorting their pixel IDs, so
+    that the memory required scales with the number of objects and occupied
+    pixels rather than with the number of pixels in the full-sky map.
+
+    Parameters
+    ----------
+    pix: array-like
+        Pixel IDs of each object.
+
+    pix_ids: array-like or None
+        IDs of the pixels in which to count objects (which need not all be
+        occupied). If None, counts objects in every occupied pixel.
+
+    Returns
+    -------
+    pix_u: numpy.array
+        IDs of the pixels for which counts are returned (pix_ids if provided,
+        otherwise the sorted IDs of the occupied pixels).
+
+    counts: numpy.array
+        Number of objects in each pixel.
+    '''
+    pix_u, counts = np.unique(pix, return_counts=True)
+    if pix_ids is None:
+        return pix_u, counts
+    pix_ids = np.asarray(pix_ids)
+    return pix_ids, valuesAtPixels(pix_u, counts, pix_ids)
+
+
+def valuesAtPixels(pix_u, vals, pix_ids, fill=0):
+    '''
+    Retrieves the values at the specified pixels from a sparse set of pixel
+    values, using a binary search of the sorted pixel IDs.
+
+    Parameters
+    ----------
+    pix_u: numpy.array
+        Sorted, unique IDs of the pixels for which values exist.
+
+    vals: numpy.array
+        Value at each of these pixels.
+
+    pix_ids: array-like
+        IDs of the pixels at which to retrieve values.
+
+    fill: scalar
+        Value to return for pixels that are not in pix_u.
+
+    Returns
+    -------
+    vals_out: numpy.array
+        Value at each pixel in pix_ids.
+    '''
+    pix_ids = np.asarray(pix_ids)
+    vals_out = np.full(len(pix_ids), fill, dtype=vals.dtype)
+    if len(pix_u) == 0:
+        return vals_out
+    idx = np.searchsorted(pix_u, pix_ids)
+    idx[idx == len(pix_u)] = 0
+    found = pix_u[idx] == pix_ids
+    vals_out[found] = vals[idx[found]]
+    return vals_out
+
+
+def _nsideShift(nside_a, nside_b):
+    '''
+    Returns the number of bits by which NESTED pixel IDs must be shifted to
+    convert between two resolutions (each pixel contains the 4 pixels at
+    twice its NSIDE with the same IDs bar the last 2 bits).
+    '''
+    return 2 * abs(int(nside_a).bit_length() - int(nside_b).bit_length())
+
+
+class PixelSet:
+    '''
+    Set of pixels (NESTED ordering) at a given NSIDE, held as a sorted array
+    of unique pixel IDs so that set operations are vectorised rather than
+    performed on Python integers. Operands at different resolutions are
+    converted to the finer of the two before being combined. The coverage
+    blocks (pixels at nside_cover) occupied by the set are tracked so that
+    membership tests only search for pixels within occupied blocks, and
+    HealSparse maps can be used as operands directly, in which case their own
+    coverage index is used to look up membership.
+    '''
+
+    def __init__(self, pix, nside, nside_cover=None):
+        pix = np.asarray(pix, dtype=np.int64)
+        # Sort and remove duplicates unless already done
+        if np.any(pix[1:] <= pix[:-1]):
+            pix = np.unique(pix)
+        self.pix = pix
+        self.nside = nside
+        if nside_cover is None:
+            nside_cover = min(nside, 32)
+        self.nside_cover = min(nside, nside_cover)
+        self._coverage = None
+
+    @classmethod
+    def from_map(cls, hsp_map):
+        '''
+        Creates a set containing the valid pixels of a HealSparse map.
+
+        Parameters
+        ----------
+        hsp_map: HealSparseMap
+            Map whose valid pixels are to be included.
+
+        Returns
+        -------
+        pix_set: PixelSet
+            Set of pixels at the resolution of the map.
+        '''
+        return cls(hsp_map.valid_pixels, hsp_map.nside_sparse,
+                   nside_cover=hsp_map.nside_coverage)
+
+    def __len__(self):
+        return len(self.pix)
+
+    def coverage(self):
+        '''
+        Identifies the coverage blocks occupied by the set.
+
+        Returns
+        -------
+        cov: numpy.array
+            Boolean array identifying which pixels at NSIDE nside_cover
+            contain pixels in the set.
+        '''
+        if self._coverage is None:
+            shift = _nsideShift(self.nside, self.nside_cover)
+            self._coverage = np.zeros(12 * self.nside_cover ** 2, dtype=bool)
+            self._coverage[self.pix >> shift] = True
+        return self._coverage
+
+    def to_nside(self, nside):
+        '''
+        Converts the set to another resolution. When degrading, a pixel is in
+        the new set if any of its subpixels are in this set; when upgrading,
+        every subpixel of each pixel in this set is included.
+
+        Parameters
+        ----------
+        nside: int
+            Resolution of the new set.
+
+        Returns
+        -------
+        pix_set: PixelSet
+            Set of pixels at the new resolution.
+        '''
+        if nside == self.nside:
+            return self
+        shift = _nsideShift(self.nside, nside)
+        if nside < self.nside:
+            # Parents of sorted pixels are sorted, so duplicates are adjacent
+            pix = self.pix >> shift
+            pix = pix[np.r_[True, pix[1:] != pix[:-1]][:len(pix)]]
+        else:
+            pix = ((self.pix[:, None] << shift)
+                   + np.arange(1 << shift, dtype=np.int64)).ravel()
+        return PixelSet(pix, nside, nside_cover=self.nside_cover)
+
+    def contains(self, pix, nside=None):
+        '''
+        Tests whether each of the specified pixels is in the set.
+
+        Parameters
+        ----------
+        pix: array-like
+            Pixel IDs (NESTED ordering) to test.
+
+        nside: int or None
+            Resolution of the pixels to test, if different from that of the
+            set. Pixels at a coarser resolution are in the set if any of
+            their subpixels are.
+
+        Returns
+        -------
+        found: numpy.array
+            Boolean array identifying which pixels are in the set.
+        '''
+        pix = np.asarray(pix, dtype=np.int64)
+        if nside is None:
+            nside = self.nside
+        if nside < self.nside:
+            return self.to_nside(nside).contains(pix)
+        pix = pix >> _nsideShift(nside, self.nside)
+        found = np.zeros(len(pix), dtype=bool)
+        # Only search for the pixels in coverage blocks occupied by the set
+        shift = _nsideShift(self.nside, self.nside_cover)
+        sel = np.where(self.coverage()[pix >> shift])[0]
+        if len(sel) > 0:
+            idx = np.searchsorted(self.pix, pix[sel])
+            idx[idx == len(self.pix)] = 0
+            found[sel] = self.pix[idx] == pix[sel]
+        return found
+
+    def _membership(self, other):
+        '''
+        Converts the set to the finer resolution of itself and another set
+        (or HealSparse map), and tests which of its pixels are in the other.
+        '''
+        if isinstance(other, hsp.HealSparseMap):
+            if other.nside_sparse <= self.nside:
+                # Use the coverage index of the map to look up the pixels
+                nside = None
+                if other.nside_sparse < self.nside:
+                    nside = self.nside
+                return self, other.get_values_pix(self.pix, valid_mask=True,
+                                                  nside=nside)
+            other = PixelSet.from_map(other)
+        a = self.to_nside(max(self.nside, other.nside))
+        return a, other.contains(a.pix, nside=a.nside)
+
+    def union(self, other):
+        '''
+        Returns the pixels in either this set or another.
+
+        Parameters
+        ----------
+        other: PixelSet or HealSparseMap
+            Other set of pixels (or map whose valid pixels form the set).
+
+        Returns
+        -------
+        pix_set: PixelSet
+            Union of the two sets, at the finer of their resolutions.
+        '''
+        if isinstance(other, hsp.HealSparseMap):
+            other = PixelSet.from_map(other)
+        nside = max(self.nside, other.nside)
+        a = self.to_nside(nside)
+        return PixelSet(np.union1d(a.pix, other.to_nside(nside).pix), nside,
+                        nside_cover=self.nside_cover)
+
+    def intersection(self, other):
+        '''
+        Returns the pixels in both this set and another.
+
+        Parameters
+        ----------
+        other: PixelSet or HealSparseMap
+            Other set of pixels (or map whose valid pixels form the set).
+
+        Returns
+        -------
+        pix_set: PixelSet
+            Intersection of the two sets, at the finer of their resolutions.
+        '''
+        a, found = self._membership(other)
+        return PixelSet(a.pix[found], a.nside, nside_cover=self.nside_cover)
+
+    def difference(self, other):
+        '''
+        Returns the pixels in this set that are not in another.
+
+        Parameters
+        ----------
+        other: PixelSet or HealSparseMap
+            Other set of pixels (or map whose valid pixels form the set).
+
+        Returns
+        -------
+        pix_set: PixelSet
+            Pixels in this set but not the other, at the finer of their
+            resolutions.
+        '''
+        a, found = self._membership(other)
+        return PixelSet(a.pix[~found], a.nside, nside_cover=self.nside_cover)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+
+def degradePixels(pix, vals, nside, nside_out, reduction='sum'):
+    '''
+    Aggregates values in a sparse set of pixels to a coarser resolution,
+    grouping the subpixels of each coarse pixel by shifting their (NESTED)
+    IDs rather than creating maps at either resolution.
+
+    Parameters
+    ----------
+    pix: array-like
+        Pixel IDs (NESTED ordering) for which values exist.
+
+    vals: array-like
+        Value(s) in each of these pixels, either as a 1D array or as a 2D
+        array with one row per pixel.
+
+    nside: int
+        Resolution of the pixels.
+
+    nside_out: int
+        Resolution to which the values are aggregated (must not exceed nside).
+
+    reduction: str
+        How to combine the subpixels of each coarse pixel: 'sum', 'mean'
+        (over all subpixels, counting those without values as 0), 'min' or
+        'max'.
+
+    Returns
+    -------
+    pix_out: numpy.array
+        Sorted IDs of the coarse pixels containing any of the pixels.
+
+    vals_out: numpy.array
+        Aggregated value(s) in each coarse pixel.
+    '''
+    if reduction not in ['sum', 'mean', 'min', 'max']:
+        raise ValueError('reduction must be one of sum, mean, min or max.')
+    vals = np.asarray(vals)
+    shift = _nsideShift(nside, nside_out)
+    pix_out, inv = np.unique(np.asarray(pix) >> shift, return_inverse=True)
+    if reduction in ['min', 'max']:
+        func = np.minimum if reduction == 'min' else np.maximum
+        order = np.argsort(inv, kind='stable')
+        starts = np.searchsorted(inv[order], np.arange(len(pix_out)))
+        return pix_out, func.reduceat(vals[order], starts, axis=0)
+    cols = vals.reshape(len(vals), -1).T
+    vals_out = np.zeros((len(cols), len(pix_out)))
+    for j, v in enumerate(cols):
+        vals_out[j] = np.bincount(inv, weights=v, minlength=len(pix_out))
+    vals_out = vals_out.T.reshape((len(pix_out),) + vals.shape[1:])
+    if reduction == 'mean':
+        vals_out /= 1 << shift
+    return pix_out, vals_out
+
+
 def pixelCountsFromCoords(ra, dec, nside_cover, nside_sparse,
-                          return_pix_and_vals=False):
+                          return_pix_and_vals=False, pix=None):
     '''
     Given sets of coordinates (RA and Dec.), counts the number of objects in
     each pixel of a HealPIX map with the specified NSIDE.
@@ -123,6 +559,10 @@ def pixelCountsFromCoords(ra, dec, nside_cover, nside_sparse,
         If True, also returns the IDs and corresponding values for occupied
         pixels.
 
+    pix: array-like or None
+        Pixel IDs (NESTED ordering, at resolution nside_sparse) of each
+        object. If provided, ra and dec are not used.
+
     Returns
     -------
     counts_map: HealSparseMap
@@ -133,26 +573,25 @@ def pixelCountsFromCoords(ra, dec, nside_cover, nside_sparse,
                                               nside_sparse,
                                               np.int32)
     # Convert the provided coordinates into pixel IDs
-    px_data = hp.ang2pix(nside_sparse,
-                         np.radians(90.-dec), np.radians(ra), nest=True)
-    # Get the unique pixel IDs
-    px_data_u = np.unique(px_data)
-
-    # Count the number of sources in each pixel (going from 0 to max(px_data))
-    N = np.bincount(px_data).astype(np.int32)
-    # Identify all pixels containing at least one source
-    good = N > 0
+    if pix is None:
+        px_data = hp.ang2pix(nside_sparse,
+                             np.radians(90.-dec), np.radians(ra), nest=True)
+    else:
+        px_data = pix
+    # Count the number of sources in each occupied pixel
+    px_data_u, N = pixelCounts(px_data)
+    N = N.astype(np.int32)
     # Fill the map at these positions with the number of sources in the pixel
-    counts_map[px_data_u] = N[good]
+    counts_map[px_data_u] = N
 
     if return_pix_and_vals:
-        return counts_map, px_data_u, N[good]
+        return counts_map, px_data_u, N
     else:
         return counts_map
 
 
 def countsInPixels(ra, dec, nside_cover, nside_sparse, pix_ids,
-                   return_vals=False):
+                   return_vals=False, pix=None):
     '''
     Given sets of coordinates (RA and Dec.), counts the number of objects in
     pixels with the provided IDs in a HealPIX map.
@@ -175,6 +614,10 @@ def countsInPixels(ra, dec, nside_cover, nside_sparse, pix_ids,
         If True, also returns the IDs and corresponding values for occupied
         pixels.
 
+    pix: array-like or None
+        Pixel IDs (NESTED ordering, at resolution nside_sparse) of each
+        object. If provided, ra and dec are not used.
+
     Returns
     -------
     counts_map: HealSparseMap
@@ -185,21 +628,18 @@ def countsInPixels(ra, dec, nside_cover, nside_sparse, pix_ids,
                                               nside_sparse,
                                               np.int32)
     # Convert the provided coordinates into pixel IDs
-    px_data = hp.ang2pix(nside_sparse, ra, dec, nest=True, lonlat=True)
-    # Make an array of weights for counting galaxies in each pixel
-    weights = np.zeros_like(px_data)
-    # Give specified pixels a weight of 1
-    weights[np.in1d(px_data, pix_ids)] = 1
-
-    # Count the number of sources in each pixel (going from 0 to max(px_data))
-    N = np.bincount(px_data,
-                    weights=weights,
-                    minlength=hp.nside2npix(nside_sparse)).astype(np.int32)
+    if pix is None:
+        px_data = hp.ang2pix(nside_sparse, ra, dec, nest=True, lonlat=True)
+    else:
+        px_data = pix
+    # Count the number of sources in each of the specified pixels
+    _, N = pixelCounts(px_data, pix_ids)
+    N = N.astype(np.int32)
     # Fill the map at these positions with the number of sources in the pixel
-    counts_map[pix_ids] = N[pix_ids]
+    counts_map[pix_ids] = N
 
     if return_vals:
-        return counts_map, N[pix_ids]
+        return counts_map, N
     return counts_map
 
 
@@ -229,25 +669,28 @@ def pixelMeanStd(quant, pix, remove_zeros=True):
         Standard deviation of the quantity at each pixel.
     '''
 
-    # Count the number of values of quant associated with each pixel
-    N = np.bincount(pix)
-    # Calculate the sum and the sum of the squares of the quantity per pix
-    qsum = np.bincount(pix, weights=quant)
-    qsqsum = np.bincount(pix, weights=quant**2.)
-
     if remove_zeros:
-        # Identify pixels in which at least one value of the quantity exists
-        good = (N > 0)
-        # Calculate mean and variance of the quantity at each 'good' pixel
-        qmean = qsum[good] / N[good]
+        # Group the values by pixel, only keeping track of occupied pixels so
+        # that memory scales with the number of occupied pixels
+        _, inv, N = np.unique(pix, return_inverse=True, return_counts=True)
+        # Calculate the sum and the sum of the squares of the quantity per pix
+        qsum = np.bincount(inv, weights=quant)
+        qsqsum = np.bincount(inv, weights=quant**2.)
+        # Calculate mean and variance of the quantity at each occupied pixel
+        qmean = qsum / N
         qmeansq = qmean ** 2.
-        qvar = (qsqsum[good] - (2 * qmean * qsum[good])) / N[good] + qmeansq
+        qvar = (qsqsum - (2 * qmean * qsum)) / N + qmeansq
         # Identify pixels for which the variance is negative (arises from
         # rounding errors)
         nve_var = qvar < 0.
         qvar[nve_var] = 0.
         qstd = np.sqrt(qvar)
     else:
+        # Count the number of values of quant associated with each pixel
+        N = np.bincount(pix)
+        # Calculate the sum and the sum of the squares of the quantity per pix
+        qsum = np.bincount(pix, weights=quant)
+        qsqsum = np.bincount(pix, weights=quant**2.)
         # Suppress numpy DivideByZero warnings
         with np.errstate(divide='ignore', invalid='ignore'):
             # Calculate mean and std of the quantity at all pixels
@@ -257,7 +700,7 @@ def pixelMeanStd(quant, pix, remove_zeros=True):
     return qmean, qstd
 
 
-def createMeanStdMap(ra, dec, quant, nside_cover, nside_sparse):
+def createMeanStdMap(ra, dec, quant, nside_cover, nside_sparse, pix=None):
     '''
     Creates maps containing the mean and standard deviation of a given
     quantity in each pixel.
@@ -282,6 +725,10 @@ def createMeanStdMap(ra, dec, quant, nside_cover, nside_sparse):
         NSIDE parameter definining the high-resolution regions of the map
         (where data exist).
 
+    pix: array-like or None
+        Pixel IDs (NESTED ordering, at resolution nside_sparse) of each
+        object. If provided, ra and dec are not used.
+
     Returns
     -------
     mean_map: HealSparseMap
@@ -301,7 +748,10 @@ def createMeanStdMap(ra, dec, quant, nside_cover, nside_sparse):
                                            np.float64)
 
     # Convert coordinates into pixel coordinates in the high-resolution map
-    px_data = hp.ang2pix(nside_sparse, ra, dec, nest=True, lonlat=True)
+    if pix is None:
+        px_data = hp.ang2pix(nside_sparse, ra, dec, nest=True, lonlat=True)
+    else:
+        px_data = pix
     px_data_u = np.unique(px_data)
 
     # Calculate mean and std of the quantity at each pixel and populate maps
@@ -312,7 +762,623 @@ def createMeanStdMap(ra, dec, quant, nside_cover, nside_sparse):
     return mean_map, std_map
 
 
-def createMask(ra, dec, flags, nside_cover, nside_sparse):
+def _chunkTotals(pix, quants, nq, stats):
+    '''
+    Groups a chunk of objects by pixel and computes the totals needed for the
+    requested statistics of each quantity in each occupied pixel (see
+    PixelStatistics).
+
+    Parameters
+    ----------
+    pix: array-like
+        Pixel IDs (NESTED ordering) of each object.
+
+    quants: array-like or list of array-likes or None
+        Values of each quantity for each object (see PixelStatistics.add).
+
+    nq: int
+        Number of quantities.
+
+    stats: list[str]
+        Statistics being accumulated.
+
+    Returns
+    -------
+    pix_c: numpy.array
+        Sorted IDs of the occupied pixels.
+
+    N: numpy.array
+        Number of objects in each occupied pixel.
+
+    totals: dict
+        Sum, sum of squares, minimum and maximum of each quantity in each
+        occupied pixel (2D arrays with one column per quantity), or None for
+        any that are not needed.
+    '''
+    if nq == 0:
+        quants = np.zeros((len(pix), 0))
+    elif isinstance(quants, (list, tuple)):
+        quants = np.column_stack(quants)
+    quants = np.asarray(quants, dtype=np.float64).reshape(len(pix), nq)
+
+    pix_c, inv, N = np.unique(pix, return_inverse=True, return_counts=True)
+    totals = {'sum': None, 'sumsq': None, 'min': None, 'max': None}
+    if any(st in ['sum', 'mean', 'std'] for st in stats):
+        totals['sum'] = np.zeros((len(pix_c), nq))
+    if 'std' in stats:
+        totals['sumsq'] = np.zeros((len(pix_c), nq))
+    if ('min' in stats) or ('max' in stats):
+        # Indices of the objects sorted by pixel and the first in each
+        order = np.argsort(inv, kind='stable')
+        starts = np.cumsum(N) - N
+        totals['min'] = np.zeros((len(pix_c), nq))
+        totals['max'] = np.zeros((len(pix_c), nq))
+    for j in range(nq):
+        q = quants[:, j]
+        if totals['sum'] is not None:
+            totals['sum'][:, j] = np.bincount(inv, weights=q,
+                                              minlength=len(pix_c))
+        if totals['sumsq'] is not None:
+            totals['sumsq'][:, j] = np.bincount(inv, weights=q**2.,
+                                                minlength=len(pix_c))
+        if totals['min'] is not None:
+            qs = q[order]
+            totals['min'][:, j] = np.minimum.reduceat(qs, starts)
+            totals['max'][:, j] = np.maximum.reduceat(qs, starts)
+
+    return pix_c, N, totals
+
+
+def _mergedTotals(name):
+    '''
+    Returns a property giving access to the running totals of a
+    PixelStatistics accumulator, merging any pending chunks first.
+    '''
+    def get(self):
+        self._merge()
+        return self.__dict__[f'_{name}']
+
+    def set(self, value):
+        self.__dict__[f'_{name}'] = value
+
+    return property(get, set)
+
+
+class PixelStatistics:
+    '''
+    Accumulates statistics of several quantities in each pixel from
+    successive chunks of objects, so that maps can be made from catalogues
+    that are too large to be read in their entirety. Only totals for the
+    occupied pixels are kept. The partial results from each chunk are held
+    until the totals are needed (or until they outnumber the pixels merged
+    so far), and are then merged in a single pass.
+    '''
+
+    allowed = ['count', 'sum', 'mean', 'std', 'min', 'max']
+    # Minimum number of pending pixel totals before merging them
+    merge_size = 1000000
+
+    # Sorted IDs of the occupied pixels and the totals in each
+    pix = _mergedTotals('pix')
+    count = _mergedTotals('count')
+    sum = _mergedTotals('sum')
+    sumsq = _mergedTotals('sumsq')
+    min = _mergedTotals('min')
+    max = _mergedTotals('max')
+
+    def __init__(self, labels, stats=['mean']):
+        for st in stats:
+            if st not in self.allowed:
+                raise ValueError('stats must only contain '
+                                 f'{", ".join(self.allowed)}.')
+        self.labels = list(labels)
+        self.stats = [st for st in stats if st != 'count']
+        nq = len(self.labels)
+        # Partial results from the chunks added since the last merge
+        self._pending = []
+        self._npending = 0
+        self.pix = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros((0, nq))
+        self.sumsq = np.zeros((0, nq))
+        self.min = np.zeros((0, nq))
+        self.max = np.zeros((0, nq))
+
+    def add(self, pix, quants=None):
+        '''
+        Adds a chunk of objects to the running totals.
+
+        Parameters
+        ----------
+        pix: array-like
+            Pixel IDs (NESTED ordering) of each object.
+
+        quants: array-like or list of array-likes or None
+            Values of each quantity for each object, either as a 2D array
+            with one column per quantity or as a list of 1D arrays. Can be
+            None if no quantities are being accumulated.
+        '''
+        nq = len(self.labels)
+        # Group the objects in this chunk by pixel
+        pix_c, N, chunk = _chunkTotals(pix, quants, nq, self.stats)
+        self._pending.append((pix_c, N, chunk))
+        self._npending += len(pix_c)
+        if self._npending > max(len(self._pix), self.merge_size):
+            self._merge()
+
+    def _merge(self):
+        '''
+        Merges the partial results from all pending chunks with the totals in
+        a single pass. The sums for each pixel are added in the order in
+        which the chunks were added.
+        '''
+        if len(self._pending) == 0:
+            return
+        nq = len(self.labels)
+        pending = [(self._pix, self._count,
+                    {'sum': self._sum, 'sumsq': self._sumsq,
+                     'min': self._min, 'max': self._max})] + self._pending
+        self._pending = []
+        self._npending = 0
+        pix_u, inv = np.unique(np.concatenate([p for p, _, _ in pending]),
+                               return_inverse=True)
+        npix = len(pix_u)
+        self._pix = pix_u
+        self._count = np.bincount(
+            inv, weights=np.concatenate([N for _, N, _ in pending]),
+            minlength=npix).astype(np.int64)
+        for name in ['sum', 'sumsq']:
+            vals = np.concatenate([
+                c[name] if c[name] is not None else np.zeros((len(p), nq))
+                for p, _, c in pending])
+            totals = np.zeros((npix, nq))
+            for j in range(nq):
+                totals[:, j] = np.bincount(inv, weights=vals[:, j],
+                                           minlength=npix)
+            self.__dict__[f'_{name}'] = totals
+        for name, func in [('min', np.minimum), ('max', np.maximum)]:
+            fill = np.inf if name == 'min' else -np.inf
+            vals = np.concatenate([
+                c[name] if c[name] is not None
+                else np.full((len(p), nq), fill)
+                for p, _, c in pending])
+            totals = np.full((npix, nq), fill)
+            func.at(totals, inv, vals)
+            self.__dict__[f'_{name}'] = totals
+
+    def degrade(self, nside, nside_out):
+        '''
+        Aggregates the running totals to a coarser resolution by combining
+        the totals in the subpixels of each pixel (see degradePixels), which
+        gives the same statistics as accumulating the objects at that
+        resolution.
+
+        Parameters
+        ----------
+        nside: int
+            Resolution at which the totals were accumulated.
+
+        nside_out: int
+            Resolution to which the totals are aggregated.
+
+        Returns
+        -------
+        acc: PixelStatistics
+            Accumulated statistics at the coarser resolution.
+        '''
+        acc = PixelStatistics(self.labels, self.stats)
+        if len(self.pix) == 0:
+            return acc
+        acc.pix, count = degradePixels(self.pix, self.count, nside, nside_out)
+        acc.count = np.rint(count).astype(np.int64)
+        _, acc.sum = degradePixels(self.pix, self.sum, nside, nside_out)
+        _, acc.sumsq = degradePixels(self.pix, self.sumsq, nside, nside_out)
+        _, acc.min = degradePixels(self.pix, self.min, nside, nside_out,
+                                   reduction='min')
+        _, acc.max = degradePixels(self.pix, self.max, nside, nside_out,
+                                   reduction='max')
+        return acc
+
+    def get_map(self, nside_cover, nside_sparse, extra={}):
+        '''
+        Creates a recarray of HealSparse maps containing the accumulated
+        statistics.
+
+        Parameters
+        ----------
+        nside_cover: int
+            NSIDE parameter definining the low-resolution regions of the map
+            (where no data exist).
+
+        nside_sparse: int
+            NSIDE parameter definining the high-resolution regions of the map
+            (where data exist).
+
+        extra: dict
+            Any additional fields to include in the recarray, with values
+            given at each pixel in self.pix.
+
+        Returns
+        -------
+        stats_map: recarray
+            Recarray of HealSparse maps containing the number of objects in
+            each pixel (field 'count', which is the primary map) and each of
+            the statistics for each quantity (fields '<label>_<stat>').
+        '''
+        fields = ['count'] + [f'{lb}_{st}' for lb in self.labels
+                              for st in self.stats] + list(extra)
+        dtypes = ['i8'] + ['f8'] * (len(fields) - 1)
+        stats_map, *_ = initialiseRecMap(nside_cover, nside_sparse, fields,
+                                         pixels=self.pix, dtypes=dtypes,
+                                         primary='count')
+        values = np.zeros(len(self.pix), dtype=stats_map.dtype)
+        values['count'] = self.count
+        N = self.count
+        for j, lb in enumerate(self.labels):
+            qsum = self.sum[:, j]
+            qmean = qsum / N
+            if 'sum' in self.stats:
+                values[f'{lb}_sum'] = qsum
+            if 'mean' in self.stats:
+                values[f'{lb}_mean'] = qmean
+            if 'std' in self.stats:
+                qvar = (self.sumsq[:, j] - (2 * qmean * qsum)) / N \
+                    + qmean ** 2.
+                # Negative variances can arise from rounding errors
+                qvar[qvar < 0.] = 0.
+                values[f'{lb}_std'] = np.sqrt(qvar)
+            if 'min' in self.stats:
+                values[f'{lb}_min'] = self.min[:, j]
+            if 'max' in self.stats:
+                values[f'{lb}_max'] = self.max[:, j]
+        for key in extra:
+            values[key] = extra[key]
+        stats_map.update_values_pix(self.pix, values)
+
+        return stats_map
+
+
+class SharedPixelStatistics:
+    '''
+    Accumulates statistics of several quantities in each of a fixed set of
+    pixels, with the totals held in shared memory so that processes forked
+    after its creation can add chunks of objects without copying any results
+    back to the parent process. Each process adds to its own slot (so no
+    locks are needed), and the slots are combined when the statistics are
+    retrieved. Every object added must lie in one of the pixels provided.
+    '''
+
+    def __init__(self, pix, labels, stats=['mean'], nslots=1):
+        for st in stats:
+            if st not in PixelStatistics.allowed:
+                raise ValueError('stats must only contain '
+                                 f'{", ".join(PixelStatistics.allowed)}.')
+        self.labels = list(labels)
+        self.stats = [st for st in stats if st != 'count']
+        # Sorted IDs of the pixels and the totals in each slot
+        self.pix = np.unique(pix)
+        shape = (nslots, len(self.pix), len(self.labels))
+        self.count = self._shared(shape[:2], np.int64, 0)
+        self.sum = None
+        self.sumsq = None
+        self.min = None
+        self.max = None
+        if any(st in ['sum', 'mean', 'std'] for st in self.stats):
+            self.sum = self._shared(shape, np.float64, 0.)
+        if 'std' in self.stats:
+            self.sumsq = self._shared(shape, np.float64, 0.)
+        if ('min' in self.stats) or ('max' in self.stats):
+            self.min = self._shared(shape, np.float64, np.inf)
+            self.max = self._shared(shape, np.float64, -np.inf)
+
+    @staticmethod
+    def _shared(shape, dtype, fill):
+        n = int(np.prod(shape))
+        buf = mp.RawArray('b', max(1, n * np.dtype(dtype).itemsize))
+        arr = np.frombuffer(buf, dtype=dtype, count=n).reshape(shape)
+        arr[...] = fill
+        return arr
+
+    def add(self, pix, quants=None, slot=0):
+        '''
+        Adds a chunk of objects to the totals in one slot.
+
+        Parameters
+        ----------
+        pix: array-like
+            Pixel IDs (NESTED ordering) of each object.
+
+        quants: array-like or list of array-likes or None
+            Values of each quantity for each object (see PixelStatistics.add).
+
+        slot: int
+            Slot to which the totals are added. Processes adding chunks at
+            the same time must use different slots.
+        '''
+        pix_c, N, chunk = _chunkTotals(pix, quants, len(self.labels),
+                                       self.stats)
+        idx = np.searchsorted(self.pix, pix_c)
+        self.count[slot, idx] += N
+        if self.sum is not None:
+            self.sum[slot, idx] += chunk['sum']
+        if self.sumsq is not None:
+            self.sumsq[slot, idx] += chunk['sumsq']
+        if self.min is not None:
+            self.min[slot, idx] = np.minimum(self.min[slot, idx],
+                                             chunk['min'])
+            self.max[slot, idx] = np.maximum(self.max[slot, idx],
+                                             chunk['max'])
+
+    def reduce(self):
+        '''
+        Combines the totals from every slot.
+
+        Returns
+        -------
+        acc: PixelStatistics
+            Accumulated statistics in the pixels containing objects.
+        '''
+        count = self.count.sum(axis=0)
+        occ = count > 0
+        nq = len(self.labels)
+        acc = PixelStatistics(self.labels, self.stats)
+        acc.pix = self.pix[occ]
+        acc.count = count[occ]
+        acc.sum = np.zeros((occ.sum(), nq))
+        acc.sumsq = np.zeros((occ.sum(), nq))
+        acc.min = np.full((occ.sum(), nq), np.inf)
+        acc.max = np.full((occ.sum(), nq), -np.inf)
+        if self.sum is not None:
+            acc.sum = self.sum.sum(axis=0)[occ]
+        if self.sumsq is not None:
+            acc.sumsq = self.sumsq.sum(axis=0)[occ]
+        if self.min is not None:
+            acc.min = self.min.min(axis=0)[occ]
+            acc.max = self.max.max(axis=0)[occ]
+        return acc
+
+    def get_map(self, nside_cover, nside_sparse):
+        '''
+        Creates a recarray of HealSparse maps containing the accumulated
+        statistics (see PixelStatistics.get_map).
+
+        Parameters
+        ----------
+        nside_cover: int
+            NSIDE parameter definining the low-resolution regions of the map
+            (where no data exist).
+
+        nside_sparse: int
+            NSIDE parameter definining the high-resolution regions of the map
+            (where data exist).
+
+        Returns
+        -------
+        stats_map: recarray
+            Recarray of HealSparse maps containing the number of objects in
+            each pixel (field 'count') and each of the statistics for each
+            quantity (fields '<label>_<stat>').
+        '''
+        return self.reduce().get_map(nside_cover, nside_sparse)
+
+
+# Catalogue, accumulators and slot used by the processes forked by
+# accumulateChunks and occupiedPixels
+_pool_state = {}
+
+
+def _initWorker(counter):
+    '''
+    Opens the catalogue and claims an accumulator slot in each process of a
+    pool created by _runPool.
+    '''
+    with counter.get_lock():
+        _pool_state['slot'] = counter.value
+        counter.value += 1
+    _pool_state['cat'] = _pool_state['open_cat']()
+
+
+def _workerChunk(rows):
+    '''
+    Returns the specified rows of the catalogue opened by _initWorker.
+    '''
+    return PixelCache(_pool_state['cat'], hpix_nside=_pool_state['hpix_nside'],
+                      rows=rows)
+
+
+def _accumulateChunk(rows):
+    '''
+    Adds a chunk of rows to the accumulators for each job (see
+    accumulateChunks). For use with a multiprocessing Pool.
+    '''
+    chunk = _workerChunk(rows)
+    for acc, quants in _pool_state['jobs']:
+        acc.add(*quants(chunk), slot=_pool_state['slot'])
+
+
+def _occupiedChunk(rows):
+    '''
+    Returns the occupied pixels in a chunk of rows at the NSIDE given as the
+    job (see occupiedPixels). For use with a multiprocessing Pool.
+    '''
+    return np.unique(_workerChunk(rows).pix(_pool_state['jobs']))
+
+
+def _runPool(open_cat, func, jobs, chunk_size, ncores, hpix_nside):
+    '''
+    Applies a function to each chunk of rows in a catalogue using a pool of
+    forked processes. If chunk_size is None, the catalogue is split into one
+    chunk per process.
+    '''
+    nrows = len(PixelCache(open_cat()))
+    if chunk_size is None:
+        chunk_size = max(1, -(-nrows // ncores))
+    rows = [slice(start, start + chunk_size)
+            for start in range(0, nrows, chunk_size)]
+    # Processes inherit the state (including shared memory) when forked
+    _pool_state.update(open_cat=open_cat, jobs=jobs, hpix_nside=hpix_nside)
+    ctx = mp.get_context('fork')
+    counter = ctx.Value('i', 0)
+    try:
+        with ctx.Pool(ncores, initializer=_initWorker,
+                      initargs=(counter,)) as pool:
+            results = pool.map(func, rows)
+    finally:
+        _pool_state.clear()
+    return results
+
+
+def occupiedPixels(open_cat, nsides, chunk_size=None, ncores=1,
+                   hpix_nside=None):
+    '''
+    Identifies the pixels containing sources in a catalogue at each of the
+    specified resolutions, e.g. for defining the pixels of a
+    SharedPixelStatistics accumulator. This costs one extra pass over the
+    catalogue, reading only the pixel IDs (if hpix_nside is given) or the
+    coordinates, which are converted with ang2pix at the finest of the
+    resolutions only; the coarser ones are derived from the occupied pixels
+    with bit shifts.
+
+    Parameters
+    ----------
+    open_cat: callable
+        Function taking no arguments that returns the catalogue. Called
+        once in each process, since open HDF5 files cannot be shared
+        between processes.
+
+    nsides: list[int]
+        Resolutions at which to identify the occupied pixels.
+
+    chunk_size: int or None
+        Maximum number of rows to read at once (see PixelCache.chunks).
+
+    ncores: int
+        Number of processes to use.
+
+    hpix_nside: int or None
+        NSIDE of the pixel IDs stored in the catalogue, if any (see
+        PixelCache).
+
+    Returns
+    -------
+    occupied: dict[numpy.array]
+        Sorted IDs (NESTED ordering) of the occupied pixels at each NSIDE.
+    '''
+    nside_max = max(nsides)
+    if ncores > 1:
+        results = _runPool(open_cat, _occupiedChunk, nside_max,
+                           chunk_size, ncores, hpix_nside)
+    else:
+        cat = PixelCache(open_cat(), hpix_nside=hpix_nside)
+        results = [np.unique(chunk.pix(nside_max))
+                   for chunk in cat.chunks(chunk_size)]
+    occupied = np.unique(np.concatenate(results))
+    return {nside: np.unique(occupied >> _nsideShift(nside_max, nside))
+            for nside in nsides}
+
+
+def accumulateChunks(open_cat, jobs, chunk_size=None, ncores=1,
+                     hpix_nside=None):
+    '''
+    Adds every chunk of rows in a catalogue to the accumulators of several
+    maps, reading each chunk only once. If ncores > 1, the chunks are
+    processed in parallel by a pool of forked processes, in which case the
+    accumulators must be SharedPixelStatistics with at least ncores slots.
+
+    Parameters
+    ----------
+    open_cat: callable
+        Function taking no arguments that returns the catalogue. Called
+        once in each process, since open HDF5 files cannot be shared
+        between processes.
+
+    jobs: list[tuple]
+        Accumulator (PixelStatistics or SharedPixelStatistics) for each map,
+        paired with a function taking a chunk (PixelCache) and returning the
+        pixel IDs and quantities to add to it (see PixelStatistics.add).
+
+    chunk_size: int or None
+        Maximum number of rows to read at once (see PixelCache.chunks). If
+        None and ncores > 1, the catalogue is split into one chunk per
+        process.
+
+    ncores: int
+        Number of processes to use.
+
+    hpix_nside: int or None
+        NSIDE of the pixel IDs stored in the catalogue, if any (see
+        PixelCache).
+    '''
+    if ncores > 1:
+        _runPool(open_cat, _accumulateChunk, jobs, chunk_size, ncores,
+                 hpix_nside)
+        return
+    cat = PixelCache(open_cat(), hpix_nside=hpix_nside)
+    for chunk in cat.chunks(chunk_size):
+        for acc, quants in jobs:
+            acc.add(*quants(chunk))
+
+
+def createStatsMap(pix, quants, labels, nside_cover, nside_sparse,
+                   stats=['mean']):
+    '''
+    Computes statistics of several quantities in each occupied pixel in a
+    single grouped pass, i.e. the objects are grouped by pixel once and the
+    grouping is shared by every quantity and statistic.
+
+    Parameters
+    ----------
+    pix: array-like
+        Pixel IDs (NESTED ordering, at resolution nside_sparse) of each
+        object.
+
+    quants: array-like or list of array-likes
+        Values of each quantity for each object, either as a 2D array with
+        one column per quantity or as a list of 1D arrays.
+
+    labels: list[str]
+        Label for each quantity.
+
+    nside_cover: int
+        NSIDE parameter definining the low-resolution regions of the map
+        (where no data exist).
+
+    nside_sparse: int
+        NSIDE parameter definining the high-resolution regions of the map
+        (where data exist).
+
+    stats: list[str]
+        Statistics to compute for each quantity. Can contain any of 'count',
+        'sum', 'mean', 'std', 'min', 'max' and 'median'.
+
+    Returns
+    -------
+    stats_map: recarray
+        Recarray of HealSparse maps containing the number of objects in each
+        pixel (field 'count', which is the primary map) and each of the
+        requested statistics for each quantity (fields '<label>_<stat>').
+    '''
+    if isinstance(quants, (list, tuple)):
+        quants = np.column_stack(quants)
+    quants = np.asarray(quants, dtype=np.float64).reshape(len(pix), -1)
+    # All statistics other than the median can be accumulated
+    acc = PixelStatistics(labels, [st for st in stats if st != 'median'])
+    acc.add(pix, quants)
+
+    medians = {}
+    if 'median' in stats:
+        _, inv, N = np.unique(pix, return_inverse=True, return_counts=True)
+        starts = np.cumsum(N) - N
+        for lb, q in zip(labels, quants.T):
+            # Sort by value within each pixel and average the middle values
+            qsorted = q[np.lexsort((q, inv))]
+            medians[f'{lb}_median'] = (qsorted[starts + (N - 1) // 2]
+                                       + qsorted[starts + N // 2]) / 2.
+
+    return acc.get_map(nside_cover, nside_sparse, extra=medians)
+
+
+def createMask(ra, dec, flags, nside_cover, nside_sparse, pix=None):
     '''
     Creates a mask using a set of flags defined at the provided coordinates.
 
@@ -336,35 +1402,41 @@ def createMask(ra, dec, flags, nside_cover, nside_sparse):
         NSIDE parameter definining the high-resolution regions of the map
         (where data exist).
 
+    pix: array-like or None
+        Pixel IDs (NESTED ordering, at resolution nside_sparse) of each
+        object. If provided, ra and dec are not used.
+
     Returns
     -------
     mask: HealSparseMap
         Map containing 0s at masked positions and 1s elsewhere.
     '''
 
-    # Begin by counting sources in each pixel, since pixels with zero sources
-    # will be masked
-    counts_map = pixelCountsFromCoords(ra, dec, nside_cover, nside_sparse)
+    # Convert the provided RAs and Decs to pixel IDs in the new-resolution mask
+    if pix is None:
+        px_data = hp.ang2pix(nside_sparse,
+                             np.radians(90.-dec),
+                             np.radians(ra),
+                             nest=True)
+    else:
+        px_data = pix
+
+    # Identify the occupied pixels, since pixels with zero sources will be
+    # masked
+    occupied = PixelSet(px_data, nside_sparse, nside_cover=nside_cover)
 
-    # Initialise a mask with the same NSIDE parameters as the counts map
+    # Initialise a mask with the specified NSIDE parameters
     mask = hsp.HealSparseMap.make_empty(nside_cover, nside_sparse, np.int32)
     # Fill any occupied pixels with a 1
-    mask[counts_map.valid_pixels] = 1
-
-    # Convert the provided RAs and Decs to pixel IDs in the new-resolution mask
-    px_data = hp.ang2pix(nside_sparse,
-                         np.radians(90.-dec),
-                         np.radians(ra),
-                         nest=True)
+    mask[occupied.pix] = 1
 
     if type(flags) is not list:
         flags = [flags]
     # Cycle through the flags
     for flag in flags:
-        # Identify where the flag=True
-        px_to_mask = px_data[flag]
-        px_u = np.unique(px_to_mask)
-        mask[px_u] = 0
+        # Identify the pixels containing sources where the flag=True
+        px_to_mask = PixelSet(px_data[flag], nside_sparse)
+        mask[px_to_mask.pix] = 0
 
     return mask
 
@@ -405,6 +1477,167 @@ def maskAreaSkyCoverage(mask, thresh=0.):
     return A, f_sky
 
 
+def gaussianKernel(theta, fwhm, lmax):
+    '''
+    Computes the real-space kernel equivalent to smoothing a map with a
+    Gaussian beam in harmonic space up to a maximum multipole (as done by
+    healpy.smoothing), i.e. the Legendre series of the beam window function.
+
+    Parameters
+    ----------
+    theta: numpy.array
+        Angular separations (in radians) at which to evaluate the kernel.
+
+    fwhm: float
+        Full width at half maximum (in radians) of the Gaussian beam.
+
+    lmax: int
+        Maximum multipole of the smoothing.
+
+    Returns
+    -------
+    kernel: numpy.array
+        Value of the kernel (per steradian) at each separation.
+    '''
+    bl = hp.gauss_beam(fwhm, lmax=lmax)
+    x = np.cos(theta)
+    # Sum the series using the recurrence relation for Legendre polynomials
+    p_prev = np.ones_like(x)
+    p = x.copy()
+    kernel = bl[0] * p_prev
+    if lmax > 0:
+        kernel += 3. * bl[1] * p
+    for ell in range(2, lmax + 1):
+        p_prev, p = p, ((2 * ell - 1) * x * p - (ell - 1) * p_prev) / ell
+        kernel += (2 * ell + 1) * bl[ell] * p
+    return kernel / (4. * np.pi)
+
+
+def smoothSparse(pix, vals, nside, fwhm, pix_out=None, nside_work=None,
+                 truncate=5., max_pairs=4000000):
+    '''
+    Smooths a sparse map with a Gaussian kernel by convolution in real space,
+    such that the result matches healpy.smoothing (with its default maximum
+    multipole of 3*NSIDE-1) applied to the full-sky map that is zero outside
+    the provided pixels. Only the provided pixels and those at which the
+    result is requested are used, so no full-sky maps or harmonic transforms
+    are needed. The kernel is truncated at the specified number of standard
+    deviations. By default the map is convolved at its own resolution; the
+    convolution can optionally be performed at a coarser working resolution
+    for speed, with each working pixel placed at the centroid of the pixels
+    it contains, at the cost of small errors in the result.
+
+    Parameters
+    ----------
+    pix: array-like
+        Pixel IDs (NESTED ordering) at which the map is nonzero.
+
+    vals: array-like
+        Value of the map in each of these pixels.
+
+    nside: int
+        Resolution of the map.
+
+    fwhm: float
+        Full width at half maximum (in radians) of the Gaussian kernel.
+
+    pix_out: array-like or None
+        Pixel IDs (NESTED ordering, at resolution nside) at which to
+        evaluate the smoothed map. If None, uses pix.
+
+    nside_work: int, str or None
+        Resolution at which to perform the convolution (capped at nside). If
+        None, uses nside. If 'auto', uses the coarsest resolution at which
+        pixels are at most a quarter of a standard deviation across.
+
+    truncate: float
+        Radius (in standard deviations of the kernel) beyond which the kernel
+        is set to zero.
+
+    max_pairs: int
+        Maximum number of pixel pairs for which to evaluate the kernel at
+        once (limits memory usage).
+
+    Returns
+    -------
+    smoothed: numpy.array
+        Smoothed map at each pixel in pix_out.
+    '''
+    pix = np.asarray(pix)
+    vals = np.asarray(vals, dtype=np.float64)
+    if pix_out is None:
+        pix_out = pix
+    pix_out = np.asarray(pix_out)
+    smoothed = np.zeros(len(pix_out))
+    nz = vals != 0
+    pix, vals = pix[nz], vals[nz]
+    if (len(pix) == 0) or (len(pix_out) == 0):
+        return smoothed
+
+    sigma = fwhm / np.sqrt(8. * np.log(2.))
+    r_max = truncate * sigma
+    if nside_work is None:
+        nside_work = nside
+    elif nside_work == 'auto':
+        nside_work = nside
+        while (nside_work > 1) and \
+                (hp.nside2resol(nside_work // 2) <= sigma / 4.):
+            nside_work //= 2
+    nside_work = min(nside_work, nside)
+    # Tabulate the kernel on a uniform grid in 1-cos(separation), so that it
+    # can be interpolated without computing the separations themselves
+    ngrid = 4096
+    du = (1. - np.cos(r_max)) / (ngrid - 1)
+    kernel = gaussianKernel(np.arccos(1. - du * np.arange(ngrid)), fwhm,
+                            3 * nside - 1)
+    kernel = np.r_[kernel, 0., 0.]
+
+    # Integrate the map over each working pixel, placing each at the
+    # centroid of its subpixels
+    pix_w, inv = np.unique(pix >> _nsideShift(nside, nside_work),
+                           return_inverse=True)
+    w = vals * hp.nside2pixarea(nside)
+    w_src = np.bincount(inv, weights=w, minlength=len(pix_w))
+    vec = np.array(hp.pix2vec(nside, pix, nest=True))
+    vec_src = np.array([np.bincount(inv, weights=np.abs(w) * v,
+                                    minlength=len(pix_w)) for v in vec])
+    vec_src /= np.linalg.norm(vec_src, axis=0)
+
+    # Group the output pixels into cells a fraction of the width of the
+    # kernel, and find the working pixels within reach of each cell
+    nside_cell = nside
+    while (nside_cell > 1) and \
+            (hp.nside2resol(nside_cell // 2) <= r_max / 4.):
+        nside_cell //= 2
+    r_query = r_max + hp.max_pixrad(nside_cell) + hp.max_pixrad(nside_work)
+    cells = pix_out >> _nsideShift(nside, nside_cell)
+    order = np.argsort(cells, kind='stable')
+    cells_u, starts = np.unique(cells[order], return_index=True)
+    ends = np.r_[starts[1:], len(order)]
+    vec_out = np.array(hp.pix2vec(nside, pix_out, nest=True))
+    for cell, i0, i1 in zip(cells_u, starts, ends):
+        cand = hp.query_disc(nside_work,
+                             hp.pix2vec(nside_cell, cell, nest=True),
+                             r_query, inclusive=True, nest=True)
+        src = np.searchsorted(pix_w, cand)
+        src[src == len(pix_w)] = 0
+        src = src[pix_w[src] == cand]
+        if len(src) == 0:
+            continue
+        # Evaluate the kernel for blocks of output pixels in this cell
+        step = max(1, max_pairs // len(src))
+        for j0 in range(i0, i1, step):
+            idx = order[j0:min(j0 + step, i1)]
+            u = (1. - vec_out[:, idx].T @ vec_src[:, src]) / du
+            u = np.clip(u, 0., ngrid)
+            i = u.astype(np.int64)
+            u -= i
+            k = (1. - u) * kernel[i] + u * kernel[i + 1]
+            smoothed[idx] = k @ w_src[src]
+
+    return smoothed
+
+
 def healsparseToHDF(hsp_map, fname, pix_scheme='ring', group='',
                     metadata=None):
     '''
@@ -620,8 +1853,9 @@ def load_tomographic_maps(map_path, fullsky=True, apply_mask=False, mask=None,
             map_now = hsp_map[d].generate_healpix_map(nest=False)
             map_now[map_now == hp.UNSEEN] = 0.
         else:
-            # Otherwise, just retrieve the relevant HealSparseMap
-            map_now = hsp_map[d]
+            # Otherwise, just retrieve the relevant HealSparseMap (copying it
+            # if pixels outside the map are to be filled by the mask)
+            map_now = hsp_map.get_single(d, copy=apply_mask)
 
         # Multiply by the mask if told to do so
         if apply_mask:
@@ -629,10 +1863,13 @@ def load_tomographic_maps(map_path, fullsky=True, apply_mask=False, mask=None,
                 if fullsky:
                     map_now *= mask.mask_full
                 else:
-                    vpix_map = map_now.valid_pixels
                     vpix_mask = mask.vpix_nest
-                    vpix_diff = np.array(list(set(vpix_mask) - set(vpix_map)))
-                    map_now[vpix_diff] = 0
+                    # Pixels in the mask that are not valid in the map
+                    vpix_diff = PixelSet(vpix_mask, mask.nside,
+                                         nside_cover=mask.nside_cover)
+                    vpix_diff = vpix_diff - map_now
+                    map_now[vpix_diff.pix] = np.zeros(len(vpix_diff),
+                                                      dtype=map_now.dtype)
                     map_now[vpix_mask] *= mask.mask_hsp[vpix_mask]
             else:
                 print('Could not apply mask to map; no MaskData provided.')
@@ -168,7 +168,77 @@ def write_output(t, fname, **kwargs):
     hdul.writeto(fname, overwrite=True)
 
 
-def write_output_hdf(t, fname, colnames=None, group=None, mode='a'):
+def hdf_storage_kwargs(dtype, N, layout='append', chunk_rows=None,
+                       compression=None, compression_opts=None,
+                       shuffle=False):
+    '''
+    Determines the keyword arguments to pass to h5py's create_dataset so that
+    a 1D dataset is stored with the desired layout.
+
+    Parameters
+    ----------
+    dtype: numpy.dtype
+        Data type of the dataset.
+
+    N: int
+        Initial length of the dataset.
+
+    layout: str
+        Either 'append' or 'read'. The 'append' layout uses small chunks
+        (~64 KiB), which suit datasets that are extended many times. The
+        'read' layout uses large chunks (~4 MiB), which minimise the overheads
+        when reading full columns. Both layouts allow datasets to be resized.
+
+    chunk_rows: int or None
+        Number of rows per chunk. If None, is determined from the layout.
+
+    compression: str or None
+        Compression filter to apply ('lzf' or 'gzip'). If None, the data are
+        not compressed.
+
+    compression_opts: int or None
+        Compression level (only used if compression='gzip').
+
+    shuffle: bool
+        Whether to apply the shuffle filter (can improve compression).
+
+    Returns
+    -------
+    kwargs: dict
+        Keyword arguments for h5py's create_dataset.
+    '''
+    import numpy as np
+
+    # Determine the chunk size (in rows) from the layout if not specified
+    if chunk_rows is None:
+        if layout == 'append':
+            chunk_bytes = 2 ** 16
+        elif layout == 'read':
+            chunk_bytes = 2 ** 22
+        else:
+            raise ValueError('layout must be either "append" or "read".')
+        chunk_rows = chunk_bytes // np.dtype(dtype).itemsize
+    # Chunks larger than the dataset are unnecessary unless it will be appended
+    if layout == 'read':
+        chunk_rows = min(chunk_rows, N)
+    chunk_rows = max(int(chunk_rows), 1)
+
+    kwargs = {
+        'chunks': (chunk_rows,),
+        'maxshape': (None,)
+    }
+    if compression is not None:
+        kwargs['compression'] = compression
+        if compression == 'gzip':
+            kwargs['compression_opts'] = compression_opts
+    if shuffle:
+        kwargs['shuffle'] = True
+
+    return kwargs
+
+
+def write_output_hdf(t, fname, colnames=None, group=None, mode='a',
+                     **layout_kwargs):
     '''
     Writes an astropy Table to a hdf5 file.
 
@@ -192,6 +262,10 @@ def write_output_hdf(t, fname, colnames=None, group=None, mode='a'):
     mode: str
         Mode in which to open the HDF file (e.g. 'w' for 'write', 'r' for
         'read', etc.)
+
+    **layout_kwargs
+        Settings for the storage layout of any new datasets (see
+        hdf_storage_kwargs).
     '''
     import h5py
 
@@ -227,8 +301,9 @@ def write_output_hdf(t, fname, colnames=None, group=None, mode='a'):
                 dset = hf.create_dataset(f'{group}/{col}',
                                          shape=(N,),
                                          data=t[col],
-                                         maxshape=(None,),
-                                         dtype=dt)
+                                         dtype=dt,
+                                         **hdf_storage_kwargs(dt, N,
+                                                              **layout_kwargs))
 
 
 def h5py_dataset_iterator(g, prefix=''):
@@ -239,3 +314,820 @@ def h5py_dataset_iterator(g, prefix=''):
             yield (path, item)
         elif isinstance(item, h5py.Group):  # Test for group (go down)
             yield from h5py_dataset_iterator(item, path)
+
+
+def merge_hdf_catalogues(in_files, fname, index_offsets=None,
+                         block_size=1000000, **layout_kwargs):
+    '''
+    Concatenates the datasets in several HDF5 catalogues (in the order in
+    which they are provided) and writes them to a single file. The total
+    length of each dataset is determined first, so that each output dataset
+    can be created at its full size and filled with bulk copies. Any input
+    files that do not exist are skipped.
+
+    Parameters
+    ----------
+    in_files: list[str]
+        Paths to the catalogues being merged.
+
+    fname: str
+        Path to the output file.
+
+    index_offsets: list[int] or None
+        For derived catalogues, offsets to add to the row indices from each
+        input file (i.e. the number of rows in the parent catalogues of all
+        preceding files).
+
+    block_size: int
+        Maximum number of rows to copy from an input dataset at once.
+
+    layout_kwargs:
+        Settings for the storage layout of the output datasets (see
+        hdf_storage_kwargs).
+    '''
+    import os
+    import h5py
+
+    if index_offsets is None:
+        index_offsets = [0] * len(in_files)
+    index_offsets = [o for f, o in zip(in_files, index_offsets)
+                     if os.path.exists(f)]
+    in_files = [f for f in in_files if os.path.exists(f)]
+
+    # First pass: determine the total length and dtype of each dataset
+    lengths = {}
+    dtypes = {}
+    for f in in_files:
+        with h5py.File(f, 'r') as fnow:
+            for (path, dset) in h5py_dataset_iterator(fnow):
+                lengths[path] = lengths.get(path, 0) + len(dset)
+                dtypes.setdefault(path, dset.dtype)
+
+    # Second pass: create the datasets at full size and copy the data
+    with h5py.File(fname, 'w') as fmain:
+        for path in lengths:
+            N = lengths[path]
+            fmain.create_dataset(path, shape=(N,), dtype=dtypes[path],
+                                 **hdf_storage_kwargs(dtypes[path], N,
+                                                      **layout_kwargs))
+        offsets = {path: 0 for path in lengths}
+        for f, index_offset in zip(in_files, index_offsets):
+            with h5py.File(f, 'r') as fnow:
+                for (path, dset) in h5py_dataset_iterator(fnow):
+                    dset_main = fmain[path]
+                    i0 = offsets[path]
+                    for start in range(0, len(dset), block_size):
+                        stop = min(start + block_size, len(dset))
+                        data = dset[start:stop]
+                        if path.endswith('/row_index'):
+                            data += index_offset
+                        dset_main[i0+start:i0+stop] = data
+                    offsets[path] += len(dset)
+
+
+class DerivedColumn:
+    '''
+    Lazy view of a column in a derived catalogue. Data are only read from the
+    parent catalogue when the column is indexed (e.g. col[:]).
+    '''
+
+    def __init__(self, dset, index):
+        # Dataset in the parent catalogue and the rows belonging to this one
+        self.dset = dset
+        self.index = index
+        self.dtype = dset.dtype
+        self.shape = (len(index),)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, sel):
+        import numpy as np
+        index = self.index[sel]
+        if np.size(index) == 0:
+            return np.zeros(np.shape(index), dtype=self.dtype)
+        # Only read the range of rows spanned by the selected indices
+        i0, i1 = index.min(), index.max() + 1
+        return self.dset[i0:i1][index - i0]
+
+
+class DerivedCatalogue:
+    '''
+    Lazy view of an HDF5 catalogue stored as the indices of rows in a parent
+    catalogue (identified by the 'parent' attribute of the group, relative to
+    the directory containing the file). Columns that are not stored in the
+    derived catalogue itself are read from the parent catalogue on access.
+    New datasets are written to the derived catalogue. The parent catalogue
+    remains open (read-only) until close is called.
+    '''
+
+    def __init__(self, group):
+        import os
+        import h5py
+        self.group = group
+        parent = os.path.join(os.path.dirname(group.file.filename),
+                              group.attrs['parent'])
+        self.parent_file = h5py.File(parent, 'r')
+        self.parent = self.parent_file[group.name]
+        self.index = group['row_index'][:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the parent catalogue (the file containing the derived
+        catalogue itself is left open).
+        '''
+        self.parent_file.close()
+
+    def __getitem__(self, key):
+        if key in self.group:
+            return self.group[key]
+        return DerivedColumn(self.parent[key], self.index)
+
+    def __contains__(self, key):
+        return (key in self.group) or (key in self.parent)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(self.parent.keys()) + [k for k in self.group.keys()
+                                           if k != 'row_index'
+                                           and k not in self.parent]
+
+    @property
+    def attrs(self):
+        return self.group.attrs
+
+    def create_dataset(self, *args, **kwargs):
+        return self.group.create_dataset(*args, **kwargs)
+
+    def require_dataset(self, *args, **kwargs):
+        return self.group.require_dataset(*args, **kwargs)
+
+    def __delitem__(self, key):
+        del self.group[key]
+
+
+def catalogue_view(group):
+    '''
+    Returns an object from which the columns of an HDF5 catalogue can be read
+    as cat['col'][:], regardless of whether the catalogue is stored in full or
+    as the indices of rows in a parent catalogue.
+
+    Parameters
+    ----------
+    group: h5py Group
+        Group containing the catalogue data.
+
+    Returns
+    -------
+    cat: h5py Group or DerivedCatalogue
+        The input Group if the catalogue is stored in full, or a lazy view of
+        the derived catalogue otherwise (whose close method must be called to
+        release the parent catalogue).
+    '''
+    if 'parent' in group.attrs:
+        return DerivedCatalogue(group)
+    return group
+
+
+def filter_mask(cat, filters):
+    '''
+    Evaluates a set of filters on the columns of a catalogue.
+
+    Parameters
+    ----------
+    cat: h5py Group, DerivedCatalogue or ParquetCatalogue
+        Catalogue containing the columns referenced by the filters.
+
+    filters: list[tuple] or list[list[tuple]]
+        Filters in the format used by pyarrow, i.e. (column, op, value) tuples
+        (where op is one of ==, !=, <, <=, >, >=, in or not in). A list of
+        tuples is combined with AND; a list of lists of tuples is combined as
+        an OR of ANDs.
+
+    Returns
+    -------
+    mask: numpy.array
+        Boolean array identifying the rows that pass the filters.
+    '''
+    import numpy as np
+
+    ops = {
+        '==': np.equal,
+        '=': np.equal,
+        '!=': np.not_equal,
+        '<': np.less,
+        '<=': np.less_equal,
+        '>': np.greater,
+        '>=': np.greater_equal,
+        'in': lambda x, v: np.isin(x, list(v)),
+        'not in': lambda x, v: ~np.isin(x, list(v))
+    }
+    # A flat list of conditions is treated as a single conjunction
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    mask = None
+    for conj in filters:
+        mask_conj = None
+        for col, op, val in conj:
+            m = ops[op](cat[col][:], val)
+            mask_conj = m if mask_conj is None else mask_conj & m
+        mask = mask_conj if mask is None else mask | mask_conj
+    return mask
+
+
+def write_output_parquet(cat, fname, colnames=None, row_group_size=1000000):
+    '''
+    Writes a catalogue to a Parquet file one row group at a time. The
+    minimum and maximum of each column are stored for every row group, so
+    that row groups can be skipped when reading with filters.
+
+    Parameters
+    ----------
+    cat: h5py Group, DerivedCatalogue or ParquetCatalogue
+        Catalogue to be written.
+
+    fname: str
+        Filename for the output.
+
+    colnames: list[str] or None
+        Names of the columns to write. If None, writes all columns.
+
+    row_group_size: int
+        Number of rows in each row group.
+    '''
+    import os
+    import shutil
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Remove any columns added to a previous version of the file (see
+    # ParquetCatalogue)
+    if os.path.isdir(f'{fname}.columns'):
+        shutil.rmtree(f'{fname}.columns')
+
+    if colnames is None:
+        colnames = list(cat.keys())
+    N = len(cat[colnames[0]])
+    writer = None
+    for i0 in range(0, max(N, 1), row_group_size):
+        # Arrow only supports data in native byte order
+        data = [cat[c][i0:i0+row_group_size] for c in colnames]
+        data = [d.astype(d.dtype.newbyteorder('=')) for d in data]
+        if writer is None:
+            # Record the numpy dtypes so that they can be restored on reading
+            schema = pa.schema([
+                pa.field(c, pa.from_numpy_dtype(d.dtype),
+                         metadata={'dtype': d.dtype.str})
+                for c, d in zip(colnames, data)
+            ])
+            writer = pq.ParquetWriter(fname, schema)
+        writer.write_table(pa.Table.from_arrays(data, schema=schema),
+                           row_group_size=row_group_size)
+    writer.close()
+
+
+class FilteredColumn:
+    '''
+    View of a column containing only the rows that pass a set of filters.
+    The column is read and filtered once, on first access.
+    '''
+
+    def __init__(self, col, mask):
+        self.col = col
+        self.mask = mask
+        self.dtype = col.dtype
+        self.shape = (int(mask.sum()),)
+        self._data = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, sel):
+        if self._data is None:
+            self._data = self.col[:][self.mask]
+        return self._data[sel]
+
+
+class HDFCatalogue:
+    '''
+    Catalogue stored in the 'photometry' group of an HDF5 file (either in
+    full or as a derived catalogue; see catalogue_view). If filters are
+    provided, only the rows passing them are returned when reading columns.
+    '''
+
+    def __init__(self, fname, mode='r', filters=None, group='photometry'):
+        import h5py
+        self.file = h5py.File(fname, mode)
+        self.cat = catalogue_view(self.file[group])
+        self.filters = filters
+        self._mask = None
+        self._filtered = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self.cat, DerivedCatalogue):
+            self.cat.close()
+        self.file.close()
+
+    @property
+    def mask(self):
+        if self._mask is None:
+            self._mask = filter_mask(self.cat, self.filters)
+        return self._mask
+
+    def __getitem__(self, key):
+        if self.filters is None:
+            return self.cat[key]
+        if key not in self._filtered:
+            self._filtered[key] = FilteredColumn(self.cat[key], self.mask)
+        return self._filtered[key]
+
+    def __contains__(self, key):
+        return key in self.cat
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(self.cat.keys())
+
+    @property
+    def attrs(self):
+        return self.cat.attrs
+
+    def _check_writable(self):
+        if self.filters is not None:
+            raise ValueError('Cannot write to a catalogue opened with '
+                             'filters.')
+
+    def create_dataset(self, *args, **kwargs):
+        self._check_writable()
+        return self.cat.create_dataset(*args, **kwargs)
+
+    def require_dataset(self, *args, **kwargs):
+        self._check_writable()
+        return self.cat.require_dataset(*args, **kwargs)
+
+    def __delitem__(self, key):
+        self._check_writable()
+        del self.cat[key]
+
+
+class ParquetColumn:
+    '''
+    Lazy view of a column in a Parquet catalogue. Data are only read from the
+    file when the column is indexed (e.g. col[:]).
+    '''
+
+    def __init__(self, cat, name):
+        self.cat = cat
+        self.name = name
+        self.dtype = cat.dtypes[name]
+
+    @property
+    def shape(self):
+        return (self.cat.nrows,)
+
+    def __len__(self):
+        return self.cat.nrows
+
+    def __getitem__(self, sel):
+        # Only read the row groups spanned by contiguous slices
+        if isinstance(sel, slice) and sel.step in [None, 1]:
+            start, stop, _ = sel.indices(len(self))
+            if (start, stop) != (0, len(self)):
+                return self.cat.read_rows(self.name, start, stop)
+        return self.cat.read_column(self.name)[sel]
+
+
+class ParquetCatalogue:
+    '''
+    Catalogue stored in a Parquet file, with the same interface as the HDF5
+    catalogues (i.e. columns are read as cat['col'][:]). The file is
+    memory-mapped, so numeric columns without missing values are read without
+    copying. If filters are provided, only the rows passing them are read,
+    and row groups in which no rows can pass (according to the statistics
+    stored for each row group) are skipped entirely.
+
+    The Parquet file itself is never rewritten. Columns added or modified
+    with create_dataset or require_dataset are held in memory and, when the
+    catalogue is closed, each is written to its own Parquet file (with the
+    same row groups) in a sidecar directory named <fname>.columns. That
+    directory also holds any changed attributes and the names of deleted
+    columns (in attrs.json). Columns in the sidecar take precedence over
+    those in the main file.
+    '''
+
+    def __init__(self, fname, mode='r', filters=None):
+        import os
+        import json
+        import pyarrow.parquet as pq
+        self.fname = fname
+        self.mode = mode
+        self.filters = filters
+        self.sidecar = f'{fname}.columns'
+        self.file = pq.ParquetFile(fname, memory_map=True)
+        # File from which each column is read
+        self.files = {}
+        self.dtypes = {}
+        self._add_columns(self.file)
+        schema = self.file.schema_arrow
+        self.attrs = {k.decode(): v.decode()
+                      for k, v in (schema.metadata or {}).items()}
+        self.deleted = []
+        meta_file = f'{self.sidecar}/attrs.json'
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            self.attrs.update(meta['attrs'])
+            self.deleted = meta['deleted']
+            for key in self.deleted:
+                self.dtypes.pop(key, None)
+                self.files.pop(key, None)
+            for name in meta['columns']:
+                self._add_columns(pq.ParquetFile(
+                    f'{self.sidecar}/{name}.parquet', memory_map=True))
+        self._attrs_written = dict(self.attrs)
+        self._deleted_written = list(self.deleted)
+        self.new_cols = {}
+        self._nrows = None
+        self._mask = None
+        # Columns read with filters applied
+        self._filtered = {}
+
+    def _add_columns(self, pfile):
+        '''
+        Registers the columns in an open Parquet file, restoring the numpy
+        dtypes recorded when the file was written.
+        '''
+        import numpy as np
+        for field in pfile.schema_arrow:
+            md = field.metadata or {}
+            if b'dtype' in md:
+                self.dtypes[field.name] = np.dtype(md[b'dtype'].decode())
+            else:
+                self.dtypes[field.name] = np.dtype(
+                    field.type.to_pandas_dtype())
+            self.files[field.name] = pfile
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def nrows(self):
+        if self._nrows is None:
+            if self.filters is None:
+                self._nrows = self.file.metadata.num_rows
+            else:
+                self._nrows = len(self.read_column(next(iter(self.dtypes))))
+        return self._nrows
+
+    @property
+    def mask(self):
+        '''
+        Boolean array identifying the rows that pass the filters (only used
+        if a filter refers to a column in the sidecar directory, in which
+        case the filters cannot be applied by the Parquet reader).
+        '''
+        if self._mask is None:
+            cols = {c for conj in self._filter_conjs() for c, _, _ in conj}
+            self._mask = filter_mask({c: self._read_all(c) for c in cols},
+                                     self.filters)
+        return self._mask
+
+    def _filter_conjs(self):
+        if isinstance(self.filters[0], tuple):
+            return [self.filters]
+        return self.filters
+
+    def _pushdown(self):
+        '''
+        Whether the filters can be applied by the Parquet reader, i.e. all of
+        the columns they refer to are in the main file.
+        '''
+        return all(self.files.get(c) is self.file
+                   for conj in self._filter_conjs() for c, _, _ in conj)
+
+    def _read_all(self, name):
+        '''
+        Reads every row of a column from the file containing it.
+        '''
+        col = self.files[name].read(columns=[name]).column(name)
+        return self._to_numpy(col, name)
+
+    def read_column(self, name):
+        '''
+        Reads a column from the file (applying any filters) and returns it as
+        a numpy array. Filtered columns are only read once.
+        '''
+        import pyarrow.parquet as pq
+
+        if name in self.new_cols:
+            return self.new_cols[name]
+        if self.filters is None:
+            return self._read_all(name)
+        if name not in self._filtered:
+            if (self.files[name] is self.file) and self._pushdown():
+                col = pq.read_table(self.fname, columns=[name],
+                                    filters=self.filters,
+                                    memory_map=True).column(name)
+                self._filtered[name] = self._to_numpy(col, name)
+            else:
+                self._filtered[name] = self._read_all(name)[self.mask]
+        return self._filtered[name]
+
+    def read_rows(self, name, start, stop):
+        '''
+        Reads a contiguous range of rows from a column, only decoding the row
+        groups that contain them (if no filters are applied).
+        '''
+        import numpy as np
+
+        if (name in self.new_cols) or (self.filters is not None):
+            return self.read_column(name)[start:stop]
+        pfile = self.files[name]
+        md = pfile.metadata
+        bounds = np.cumsum([0] + [md.row_group(i).num_rows
+                                  for i in range(md.num_row_groups)])
+        rgs = [i for i in range(md.num_row_groups)
+               if bounds[i] < stop and bounds[i+1] > start]
+        if len(rgs) == 0:
+            return np.zeros(0, dtype=self.dtypes[name])
+        col = pfile.read_row_groups(rgs, columns=[name]).column(name)
+        i0 = bounds[rgs[0]]
+        return self._to_numpy(col, name)[start-i0:stop-i0]
+
+    def _to_numpy(self, col, name):
+        import numpy as np
+        if col.num_chunks == 1:
+            col = col.chunk(0)
+        else:
+            col = col.combine_chunks()
+        data = col.to_numpy(zero_copy_only=False)
+        return np.asarray(data, dtype=self.dtypes[name])
+
+    def __getitem__(self, key):
+        if key in self.new_cols:
+            return self.new_cols[key]
+        if key not in self.dtypes:
+            raise KeyError(f'Column {key} not found in {self.fname}.')
+        return ParquetColumn(self, key)
+
+    def __contains__(self, key):
+        return (key in self.dtypes) or (key in self.new_cols)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(self.dtypes) + [k for k in self.new_cols
+                                    if k not in self.dtypes]
+
+    def _check_writable(self):
+        if self.mode == 'r':
+            raise ValueError(f'{self.fname} was opened in read-only mode.')
+        if self.filters is not None:
+            raise ValueError('Cannot write to a catalogue opened with '
+                             'filters.')
+
+    def create_dataset(self, name, shape=None, dtype=None, data=None,
+                       **kwargs):
+        import numpy as np
+        self._check_writable()
+        if name in self:
+            raise ValueError(f'Column {name} already exists.')
+        if data is not None:
+            data = np.array(data, dtype=dtype)
+        else:
+            data = np.zeros(shape, dtype=dtype)
+        self.new_cols[name] = data
+        return data
+
+    def require_dataset(self, name, shape, dtype, **kwargs):
+        import numpy as np
+        self._check_writable()
+        if name not in self.new_cols:
+            if name in self.dtypes:
+                data = np.array(self.read_column(name), dtype=dtype)
+            else:
+                data = np.zeros(shape, dtype=dtype)
+            self.new_cols[name] = data
+        if self.new_cols[name].shape != tuple(shape):
+            raise TypeError(f'Shapes do not match for column {name}.')
+        return self.new_cols[name]
+
+    def __delitem__(self, key):
+        self._check_writable()
+        if key not in self:
+            raise KeyError(f'Column {key} not found in {self.fname}.')
+        self.new_cols.pop(key, None)
+        if key in self.dtypes:
+            del self.dtypes[key]
+            del self.files[key]
+            self.deleted.append(key)
+
+    def close(self):
+        '''
+        Writes any new or modified columns to the sidecar directory (along
+        with any changed attributes and the names of deleted columns) and
+        closes the catalogue.
+        '''
+        import os
+        import json
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        for pfile in set(self.files.values()) | {self.file}:
+            pfile.close()
+        if (self.mode == 'r') or ((len(self.new_cols) == 0)
+                                  and (self.deleted == self._deleted_written)
+                                  and (self.attrs == self._attrs_written)):
+            return
+        os.makedirs(self.sidecar, exist_ok=True)
+        # Keep the row groups the same size as in the main file
+        meta = self.file.metadata
+        row_group_size = None
+        if meta.num_row_groups > 0:
+            row_group_size = max(meta.row_group(0).num_rows, 1)
+        for name, data in self.new_cols.items():
+            field = pa.field(name, pa.from_numpy_dtype(data.dtype),
+                             metadata={'dtype': data.dtype.str})
+            table = pa.Table.from_arrays([pa.array(data)],
+                                         schema=pa.schema([field]))
+            fname = f'{self.sidecar}/{name}.parquet'
+            pq.write_table(table, f'{fname}.tmp',
+                           row_group_size=row_group_size)
+            os.replace(f'{fname}.tmp', fname)
+        # Remove the sidecar files of deleted columns
+        columns = [k for k in self.keys()
+                   if (k in self.new_cols) or
+                   ((k in self.files) and (self.files[k] is not self.file))]
+        deleted = [k for k in self.deleted if k not in columns]
+        for key in deleted:
+            if os.path.exists(f'{self.sidecar}/{key}.parquet'):
+                os.remove(f'{self.sidecar}/{key}.parquet')
+        meta_file = f'{self.sidecar}/attrs.json'
+        with open(f'{meta_file}.tmp', 'w') as f:
+            json.dump({'attrs': self.attrs, 'deleted': deleted,
+                       'columns': columns}, f, indent=2)
+        os.replace(f'{meta_file}.tmp', meta_file)
+        self.new_cols = {}
+        self.deleted = deleted
+        self._deleted_written = list(deleted)
+        self._attrs_written = dict(self.attrs)
+
+
+def open_catalogue(fname, mode='r', filters=None):
+    '''
+    Opens a catalogue stored either in HDF5 or Parquet format (determined
+    from the file extension). The returned object can be used as a context
+    manager, and columns are read from it as cat['col'][:].
+
+    Parameters
+    ----------
+    fname: str
+        Path to the catalogue.
+
+    mode: str
+        Mode in which to open the file ('r' for read-only, 'a' to also allow
+        new columns to be added).
+
+    filters: list[tuple] or list[list[tuple]] or None
+        If provided, only rows passing these filters are read, e.g.
+        [('zphot', '>=', 0.3), ('zphot', '<', 1.5)] (see filter_mask). For
+        Parquet catalogues the filters are applied while reading.
+
+    Returns
+    -------
+    cat: HDFCatalogue or ParquetCatalogue
+        The opened catalogue.
+    '''
+    if fname.endswith(('.parquet', '.pq')):
+        return ParquetCatalogue(fname, mode=mode, filters=filters)
+    return HDFCatalogue(fname, mode=mode, filters=filters)
+
+
+def read_fingerprint_record(record_file):
+    '''
+    Reads a record of the fingerprints of the pipeline stages run in a
+    directory (see PipelineConfig.record_fingerprint).
+
+    Parameters
+    ----------
+    record_file: str
+        Path to the record (a JSON file).
+
+    Returns
+    -------
+    record: dict
+        Fingerprint and names of the settings of each stage, along with the
+        size, modification time and fingerprints of each output file (under
+        the key '_files'). Empty if the record does not exist.
+    '''
+    import os
+    import json
+
+    if not os.path.exists(record_file):
+        return {}
+    with open(record_file) as f:
+        return json.load(f)
+
+
+def write_fingerprint_record(record_file, record):
+    '''
+    Writes a record of fingerprints (see read_fingerprint_record). The record
+    is written to a temporary file which then replaces the old one, so that
+    an interrupted write cannot leave a corrupted record.
+
+    Parameters
+    ----------
+    record_file: str
+        Path to the record (a JSON file).
+
+    record: dict
+        The record to be written.
+    '''
+    import os
+    import json
+
+    with open(f'{record_file}.tmp', 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(f'{record_file}.tmp', record_file)
+
+
+def file_stat(fname):
+    '''
+    Returns the size and modification time (in ns) of a file, or None if it
+    does not exist.
+    '''
+    import os
+
+    if not os.path.exists(fname):
+        return None
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def file_identity(fname, record=None, exclude=None):
+    '''
+    Returns a summary identifying the version of an input file. If the file
+    is listed in the record of fingerprints as an output of earlier stages,
+    and is unchanged since they were run, this is the set of fingerprints of
+    those stages. Otherwise it is the size and modification time of the file,
+    so copying or touching such a file (e.g. a raw catalogue) registers as a
+    change, and the stages using it are run again.
+
+    Parameters
+    ----------
+    fname: str
+        Path to the file.
+
+    record: dict or None
+        Record of fingerprints (see read_fingerprint_record).
+
+    exclude: str or None
+        Name of a stage whose fingerprint should be ignored (e.g. that of a
+        stage which modifies the file in place).
+
+    Returns
+    -------
+    identity: list or None
+        Identity of the file, or None if it does not exist.
+    '''
+    import os
+
+    stat = file_stat(fname)
+    if stat is None:
+        return None
+    entry = (record or {}).get('_files', {}).get(os.path.abspath(fname))
+    if (entry is not None) and (entry['stat'] == stat):
+        fps = {k: v for k, v in entry['fingerprints'].items()
+               if k != exclude}
+        if len(fps) > 0:
+            return [fname, sorted(fps.items())]
+    return [fname] + stat
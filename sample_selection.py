@@ -1,48 +1,200 @@
 ############################################################################
 # - Identifies and flags galaxies in the cleaned catalogues as belonging to
 #   the desired samples for clustering analysis.
+# - Only samples whose definitions have changed since the last run are
+#   evaluated; the others are retrieved from the stored bitmask column.
 ############################################################################
 
 import sys
-import h5py
+import json
 import numpy as np
 from configuration import PipelineConfig as PC
-from output_utils import colour_string
+from output_utils import colour_string, open_catalogue
 
 # SETTINGS #
 config_file = sys.argv[1]
 cf = PC(config_file, stage='sampleSelection')
 
+
+###################
+#    FUNCTIONS    #
+###################
+
+def get_outliers(cat):
+    '''
+    Identifies galaxies likely to have secondary redshift solutions at high-z,
+    if told to remove them in the config file.
+
+    Parameters
+    ----------
+    cat: HDFCatalogue or ParquetCatalogue
+        Catalogue containing the photo-z uncertainties.
+
+    Returns
+    -------
+    outliers: numpy.array
+        Boolean array identifying the galaxies to be removed.
+    '''
+    if cf.remove_pz_outliers:
+        return ~((cat['pz_err95_max_dnnz'][:]
+                  - cat['pz_err95_min_dnnz'][:] < 2.7)
+                 * (cat['pz_err95_max_mizu'][:]
+                    - cat['pz_err95_min_mizu'][:] < 2.7))
+    return np.zeros(len(cat['ra']), dtype=bool)
+
+
+def load_unchanged_samples(cat, hashes):
+    '''
+    Retrieves the masks stored in the bitmask column on a previous run for
+    any samples whose definitions are unchanged, along with the photo-z
+    outliers if the setting for removing them is unchanged.
+
+    Parameters
+    ----------
+    cat: HDFCatalogue or ParquetCatalogue
+        Catalogue containing the results of the previous run.
+
+    hashes: dict[str]
+        Hash of the current definition of each sample.
+
+    Returns
+    -------
+    sample_masks: dict[numpy.array]
+        Masks for each sample whose definition is unchanged.
+
+    outliers: numpy.array or None
+        Boolean array identifying photo-z outliers, or None if they need to
+        be identified again.
+    '''
+    if (cf.sample_bitmask not in cat) or ('sample_hashes' not in cat.attrs):
+        return {}, None
+    prev = json.loads(cat.attrs['sample_hashes'])
+    prev_samples = previous_samples(cat)
+    bits = cat[cf.sample_bitmask][:]
+    # Decode the bitmask using the order of the samples in the previous run
+    prev_masks = cf.unpack_samples(bits, samples=prev_samples)
+    sample_masks = {s: prev_masks[s] for s, h in prev['samples']
+                    if hashes.get(s) == h}
+    outliers = None
+    if prev['outliers'] == cf.remove_pz_outliers:
+        outliers = cf.unpack_outliers(bits, nsamples=len(prev_samples))
+    return sample_masks, outliers
+
+
+def previous_samples(cat):
+    '''
+    Returns the names of the samples recorded alongside the bitmask column on
+    a previous run.
+
+    Parameters
+    ----------
+    cat: HDFCatalogue or ParquetCatalogue
+        Catalogue containing the results of the previous run.
+
+    Returns
+    -------
+    samples: list[str]
+        Names of the samples (empty if no record exists).
+    '''
+    if 'sample_hashes' not in cat.attrs:
+        return []
+    return [s for s, _ in json.loads(cat.attrs['sample_hashes'])['samples']]
+
+
+def write_column(cat, name, data):
+    '''
+    Writes an array to a column of the catalogue, replacing any existing
+    column of the same name with a different length or data type (e.g. if
+    the catalogue has since been remade with a different number of rows).
+
+    Parameters
+    ----------
+    cat: HDFCatalogue or ParquetCatalogue
+        Catalogue to which the column is written.
+
+    name: str
+        Name of the column.
+
+    data: numpy.array
+        Contents of the column.
+    '''
+    if (name in cat) and ((cat[name].shape != data.shape)
+                          or (cat[name].dtype != data.dtype)):
+        del cat[name]
+    d = cat.require_dataset(name, data.shape, dtype=data.dtype)
+    d[:] = data
+
+
 #######################################################
 #                  START OF SCRIPT                    #
 #######################################################
 
+# Hash of the definition of each sample (which also depends on whether
+# photo-z outliers are removed)
+hashes = cf.get_sample_hashes(extra=cf.remove_pz_outliers)
+# Record of the definitions, to be stored alongside the bitmask column
+sample_record = json.dumps({'samples': [[s, hashes[s]] for s in cf.samples],
+                            'outliers': cf.remove_pz_outliers})
+
 # Cycle through each of the fields
 for fd in cf.fields:
     print(colour_string(fd.upper(), 'orange'))
     # Output directory for this field
     OUT = cf.paths.out + fd
+    # The catalogue is modified in place and the counts written to a file
+    inputs = [f'{OUT}/{cf.cats.main}']
+    outputs = inputs + [f'{OUT}/{cf.sample_summary_file}']
+    # Skip this field if its settings and inputs are unchanged
+    if cf.outputs_unchanged(OUT, outputs, inputs):
+        print('Settings and inputs unchanged; skipping.')
+        continue
     # Load the fully cleaned galaxy catalogue for this field
-    with h5py.File(f'{OUT}/{cf.cats.main}', 'a') as cat:
-        gp = cat['photometry']
-        # Define masks for each subsample as defined in the config file
-        sample_masks = cf.get_samples(gp)
+    with open_catalogue(f'{OUT}/{cf.cats.main}', 'a') as gp:
+        # Retrieve the masks for samples defined as in the previous run
+        sample_masks, outliers = load_unchanged_samples(gp, hashes)
         # Remove galaxies with secondary solutions at high-z if told in config
-        if cf.remove_pz_outliers:
-            outlier_mask = ((gp['pz_err95_max_dnnz'][:]
-                             - gp['pz_err95_min_dnnz'][:] < 2.7)
-                            * (gp['pz_err95_max_mizu'][:]
-                               - gp['pz_err95_min_mizu'][:] < 2.7))
-        else:
-            outlier_mask = np.ones_like(gp['ra'][:], dtype=bool)
+        if outliers is None:
+            outliers = get_outliers(gp)
+
+        # Define masks for any new or modified samples
+        to_compute = [s for s in cf.samples if s not in sample_masks]
+        if len(to_compute) > 0:
+            print(f'Evaluating samples {", ".join(to_compute)}...')
+            new_masks = cf.get_samples(gp, samples=to_compute)
+            for key in to_compute:
+                sample_masks[key] = new_masks[key] * ~outliers
+
+        # Remove any flag columns from a previous run that would no longer
+        # match their samples: those of samples since removed, and those of
+        # re-evaluated samples if the flag columns are no longer written
+        stale = [s for s in previous_samples(gp) if s not in cf.samples]
+        if not cf.sample_flag_columns:
+            stale += to_compute
+        for key in stale:
+            if key in gp:
+                del gp[key]
 
         # Open the summary file to write outputs as they are determined
         with open(f'{OUT}/{cf.sample_summary_file}', 'w') as outfile:
             outfile.write('Sample\tCounts\n')
             # Cycle through the samples
-            for key in sample_masks:
-                sm = sample_masks[key] * outlier_mask
-                # Create a dataset for each of these masks
-                d = gp.require_dataset(key, sm.shape, dtype=bool)
-                d[:] = sm
+            for key in cf.samples:
+                sm = sample_masks[key].astype(bool)
+                # Create a dataset for each of these masks if told in config
+                if cf.sample_flag_columns and \
+                        ((key in to_compute) or (key not in gp)
+                         or (gp[key].shape != sm.shape)):
+                    write_column(gp, key, sm)
                 outfile.write(f'{key}\t{sm.sum()}\n')
+
+        # Store the membership of all samples in a single bitmask column
+        bits = cf.pack_samples(sample_masks, outliers=outliers)
+        if (cf.sample_bitmask not in gp) or \
+                (gp[cf.sample_bitmask].dtype != bits.dtype) or \
+                (not np.array_equal(gp[cf.sample_bitmask][:], bits)):
+            write_column(gp, cf.sample_bitmask, bits)
+        if gp.attrs.get('sample_hashes') != sample_record:
+            gp.attrs['sample_hashes'] = sample_record
+
+    # Record the settings and inputs used for this field
+    cf.record_fingerprint(OUT, outputs, inputs)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Make the pipeline modules and the utilities package importable
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'patch3_utils', 'src'))
+sys.path.insert(0, ROOT)
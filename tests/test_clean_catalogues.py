@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import runpy
+import shutil
+import sys
+import h5py
+import numpy as np
+import pytest
+import yaml
+from astropy.table import Table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINES = os.path.join(ROOT, 'pipelines')
+
+
+def _raw_catalogue(n, ra0, dec0, rng):
+    # Synthetic HSC-like catalogue containing every required column
+    with open(os.path.join(PIPELINES, 'required_cols.txt')) as f:
+        req = [c.strip() for c in f if not c.startswith('#')]
+    d = {}
+    for c in req:
+        if c.endswith('_isnull'):
+            d[c] = rng.random(n) < 0.01
+        elif 'flag' in c or 'mask_' in c or c == 'isprimary':
+            d[c] = rng.random(n) < (0.97 if c == 'isprimary' else 0.02)
+        else:
+            d[c] = rng.normal(1, 0.1, n)
+    d['ra'] = ra0 + rng.random(n) * 4
+    d['dec'] = dec0 + rng.random(n) * 4
+    for b in 'grizy':
+        d[f'{b}_cmodel_flux'] = rng.lognormal(6, 1, n)
+        d[f'{b}_cmodel_fluxerr'] = rng.lognormal(3, 0.5, n)
+        d[f'{b}_cmodel_mag'] = rng.normal(23.5, 1, n)
+        d[f'a_{b}'] = rng.random(n) * 0.1
+    d['i_extendedness_value'] = (rng.random(n) < 0.8).astype(float)
+    d['i_blendedness_abs'] = rng.random(n) * 0.6
+    d['g_cmodel_mag'][rng.random(n) < 0.01] = np.nan
+    return Table(d)
+
+
+def _run_cleaning(root, data, ncores, derived_cats, monkeypatch):
+    os.makedirs(root)
+    with open(os.path.join(PIPELINES, 'config_local.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['global']['paths'].update(data=f'{data}/', out=f'{root}/out/')
+    config['global']['fields'] = ['hectomap', 'cosmos']
+    config['cleanCats'].update(ncores=ncores, derived_cats=derived_cats,
+                               chunk_size=700)
+    for fname in config['global']['auxfiles'].values():
+        shutil.copy(os.path.join(PIPELINES, fname), root)
+    with open(f'{root}/config.yaml', 'w') as f:
+        yaml.safe_dump(config, f)
+    # Allow as many processes as requested on any machine
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: ncores + 1)
+    monkeypatch.setattr(sys, 'argv', ['clean_catalogues.py',
+                                      f'{root}/config.yaml'])
+    runpy.run_path(os.path.join(ROOT, 'clean_catalogues.py'))
+    return f'{root}/out', config
+
+
+def _datasets(fname):
+    data = {}
+    with h5py.File(fname, 'r') as hf:
+        hf.visititems(lambda name, obj: data.update({name: obj[:]})
+                      if isinstance(obj, h5py.Dataset) else None)
+    return data
+
+
+@pytest.mark.parametrize('derived_cats', [False, True])
+def test_parallel_cleaning_matches_serial(tmp_path, monkeypatch,
+                                          derived_cats):
+    rng = np.random.default_rng(1)
+    data = tmp_path / 'data'
+    data.mkdir()
+    suffix = '_shearcat_forced.fits'
+    _raw_catalogue(2000, 200, 42, rng).write(
+        data / f'PDR3_WIDE_HECTOMAP{suffix}')
+    # A field split into parts, whose results must be combined in order
+    for i, n in enumerate([1500, 10, 1200]):
+        _raw_catalogue(n, 149, 1, rng).write(
+            data / f'PDR3_WIDE_COSMOS_part{i+1:02d}{suffix}')
+
+    out_serial, config = _run_cleaning(tmp_path / 'serial', data, 1,
+                                       derived_cats, monkeypatch)
+    out_pool, _ = _run_cleaning(tmp_path / 'pool', data, 3, derived_cats,
+                                monkeypatch)
+    cats = config['global']['cats']
+    for fd in ['hectomap', 'cosmos']:
+        for cat in [cats['basic'], cats['main'], cats['stars']]:
+            serial = _datasets(f'{out_serial}/{fd}/{cat}.hdf5')
+            pool = _datasets(f'{out_pool}/{fd}/{cat}.hdf5')
+            assert sorted(serial) == sorted(pool)
+            assert len(serial) > 0
+            for name in serial:
+                np.testing.assert_array_equal(serial[name], pool[name],
+                                              err_msg=f'{fd}/{cat}/{name}')
+        # Counters and cutflow summed over the parts
+        for fname in [config['cleanCats']['clean_summary_file'],
+                      config['cleanCats']['cutflow_file']]:
+            with open(f'{out_serial}/{fd}/{fname}') as f:
+                serial = f.read()
+            with open(f'{out_pool}/{fd}/{fname}') as f:
+                assert f.read() == serial
+        # The intermediate catalogues of the parts are removed
+        assert not any(f.startswith('part')
+                       for f in os.listdir(f'{out_pool}/{fd}/{fd}'))
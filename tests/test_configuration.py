@@ -0,0 +1,182 @@
+import os
+import shutil
+from functools import reduce
+import numpy as np
+import pytest
+import yaml
+from configuration import PipelineConfig as PC
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'pipelines', 'config_local.yaml')
+
+
+@pytest.fixture
+def cf():
+    return PC(CONFIG, stage='sampleSelection')
+
+
+@pytest.fixture
+def cat():
+    rng = np.random.default_rng(4)
+    N = 1000
+    return {'pz_best_dnnz': rng.random(N) * 2.,
+            'ra': rng.random(N) * 360.,
+            'i_cmodel_mag': rng.normal(24., 1., N),
+            'flag': rng.random(N) < 0.2}
+
+
+def _eval_samples(cf, cat):
+    # Sample selection as implemented before the definitions were compiled
+    sample_masks = {}
+    for s in cf.samples:
+        samp = cf.samples[s]
+        for key in cf.key_cols:
+            samp = samp.replace(key, f'cat["{cf.key_cols[key]}"][:]')
+        samp = samp.split(';')
+        samp_mask = np.ones_like(cat[next(iter(cat.keys()))][:], dtype=bool)
+        for ex in samp:
+            samp_mask *= eval(ex)
+        sample_masks[s] = samp_mask
+    return sample_masks
+
+
+def _set_samples(cf, samples):
+    cf.config_dict['samples'] = samples
+    cf.config_dict['nsamples'] = len(samples)
+    cf._sample_code = None
+
+
+def test_compiled_samples_match_eval(cf, cat):
+    cf.config_dict['key_cols'] = {'zphot': 'pz_best_dnnz'}
+    _set_samples(cf, {
+        'bin0': '0.3 <= zphot ; zphot < 0.6',
+        'bright': 'cat["i_cmodel_mag"][:] < 24. ; zphot >= 1.',
+        'north': '(np.abs(cat["ra"][:] - 180.) < 90.) & ~cat["flag"][:]',
+        'all': 'zphot == zphot'
+    })
+    expected = _eval_samples(cf, cat)
+    for chunk_size in [None, 1, 333, 5000]:
+        masks = cf.get_samples(cat, chunk_size=chunk_size)
+        assert list(masks) == list(expected)
+        for s in expected:
+            np.testing.assert_array_equal(masks[s], expected[s])
+    masks = cf.get_samples(cat, samples=['north'])
+    assert list(masks) == ['north']
+    np.testing.assert_array_equal(masks['north'], expected['north'])
+    assert cf._sample_columns['bright'] == ['i_cmodel_mag', 'pz_best_dnnz']
+    assert cf._sample_columns['north'] == ['ra', 'flag']
+
+
+def test_pack_unpack_round_trip(cf):
+    rng = np.random.default_rng(5)
+    for nsamples, dtype in [(4, np.uint8), (7, np.uint8), (8, np.uint16),
+                            (20, np.uint32), (63, np.uint64)]:
+        _set_samples(cf, {f's{i}': '' for i in range(nsamples)})
+        masks = {s: rng.random(100) < 0.5 for s in cf.samples}
+        outliers = rng.random(100) < 0.1
+        bits = cf.pack_samples(masks, outliers=outliers)
+        assert bits.dtype == dtype
+        unpacked = cf.unpack_samples(bits)
+        assert list(unpacked) == list(masks)
+        for s in masks:
+            np.testing.assert_array_equal(unpacked[s], masks[s])
+        np.testing.assert_array_equal(cf.unpack_outliers(bits), outliers)
+        # Without outliers, the outlier bit is never set
+        bits = cf.pack_samples(masks)
+        assert not cf.unpack_outliers(bits).any()
+        # Decoding with the sample order of a previous run
+        order = list(cf.samples)
+        prev = cf.unpack_samples(bits, samples=order[::-1])
+        np.testing.assert_array_equal(prev[order[-1]], masks[order[0]])
+        np.testing.assert_array_equal(
+            cf.unpack_outliers(bits, nsamples=nsamples), False)
+    _set_samples(cf, {f's{i}': '' for i in range(64)})
+    with pytest.raises(ValueError):
+        cf.pack_samples({s: np.zeros(3, dtype=bool) for s in cf.samples})
+
+
+@pytest.mark.parametrize('combine_type', ['or', 'AND'])
+def test_combine_flags_matches_reduce(combine_type):
+    rng = np.random.default_rng(6)
+    N = 1000
+    flags = {f'f{i}': rng.random(N) < p
+             for i, p in enumerate([0.9, 0.5, 0.1, 0.95])}
+    # Blocks in which the result is determined by the first flag
+    flags['f0'][:300] = True
+    flags['f0'][300:600] = False
+    cols = list(flags)
+
+    def combine(x, y):
+        if combine_type == 'or':
+            return x + y
+        return x * y
+    expected = reduce(combine, [flags[c][:] for c in cols])
+    for chunk_size in [1, 7, 100, N, 2 * N]:
+        result = PC.combine_flags(flags, cols, combine_type=combine_type,
+                                  chunk_size=chunk_size)
+        np.testing.assert_array_equal(result, expected)
+    np.testing.assert_array_equal(
+        PC.combine_flags(flags, ['f2'], combine_type=combine_type),
+        flags['f2'])
+
+
+def test_combine_flags_invalid():
+    flags = {'f0': np.zeros(3, dtype=bool)}
+    with pytest.raises(TypeError):
+        PC.combine_flags(flags, ['f0'], combine_type='xor')
+    with pytest.raises(ValueError):
+        PC.combine_flags(flags, [])
+
+
+def test_fingerprint_record_leaves_outputs_untouched(cf, tmp_path):
+    cf.config_dict['skip_unchanged'] = True
+    inp, out = tmp_path / 'input.txt', tmp_path / 'output.hsp'
+    inp.write_text('a')
+    out.write_bytes(b'map')
+    inputs, outputs = [str(inp)], [str(out)]
+    assert not cf.outputs_unchanged(str(tmp_path), outputs, inputs)
+    cf.record_fingerprint(str(tmp_path), outputs, inputs)
+    assert out.read_bytes() == b'map'
+    assert cf.outputs_unchanged(str(tmp_path), outputs, inputs)
+    # Changing an output or an input invalidates the record
+    out.write_bytes(b'map2')
+    assert not cf.outputs_unchanged(str(tmp_path), outputs, inputs)
+    cf.record_fingerprint(str(tmp_path), outputs, inputs)
+    inp.write_text('bb')
+    assert not cf.outputs_unchanged(str(tmp_path), outputs, inputs)
+
+
+def _write_config(path, changes={}):
+    with open(CONFIG) as f:
+        config = yaml.safe_load(f)
+    config['global']['skip_unchanged'] = True
+    # Auxiliary files are found relative to the config file
+    for fname in config['global']['auxfiles'].values():
+        shutil.copy(os.path.join(os.path.dirname(CONFIG), fname),
+                    os.path.dirname(path))
+    for (section, key), value in changes.items():
+        config[section][key] = value
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return str(path)
+
+
+@pytest.mark.parametrize('section,key,value',
+                         [('global', 'depth_cut', 25.),
+                          ('cleanCats', 'log_blend_cut', -0.5),
+                          ('cleanCats', 'chunk_size', 100)])
+def test_fingerprint_tracks_settings_not_read(tmp_path, section, key, value):
+    # Settings read only by worker processes are never read by the parent
+    config = _write_config(tmp_path / 'config.yaml')
+    out = tmp_path / 'output.hdf5'
+    out.write_bytes(b'cat')
+    cf_clean = PC(config, stage='cleanCats')
+    cf_clean.track_settings('depth_cut')
+    cf_clean.record_fingerprint(str(tmp_path), [str(out)])
+    cf_same = PC(config, stage='cleanCats')
+    assert cf_same.outputs_unchanged(str(tmp_path), [str(out)])
+    changed = _write_config(tmp_path / 'changed.yaml',
+                            {(section, key): value})
+    cf_changed = PC(changed, stage='cleanCats')
+    cf_changed.track_settings('depth_cut')
+    assert not cf_changed.outputs_unchanged(str(tmp_path), [str(out)])
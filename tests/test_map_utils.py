@@ -0,0 +1,174 @@
+import healpy as hp
+import healsparse as hsp
+import numpy as np
+import pytest
+import map_utils as mu
+
+
+def _objects(N=20000, nside=64, seed=7):
+    rng = np.random.default_rng(seed)
+    # Objects clustered in a patch, so that chunks share many pixels
+    pix = rng.integers(0, 12 * nside ** 2 // 48, N)
+    quants = rng.normal(size=(N, 2))
+    return pix, quants
+
+
+@pytest.mark.parametrize('merge_size', [1, 50, 1000000])
+def test_pixel_statistics_chunks_match_direct(monkeypatch, merge_size):
+    monkeypatch.setattr(mu.PixelStatistics, 'merge_size', merge_size)
+    pix, quants = _objects()
+    stats = ['count', 'sum', 'mean', 'std', 'min', 'max']
+    acc = mu.PixelStatistics(['a', 'b'], stats)
+    for i0 in range(0, len(pix), 1500):
+        acc.add(pix[i0:i0+1500], quants[i0:i0+1500])
+    pix_u, inv = np.unique(pix, return_inverse=True)
+    np.testing.assert_array_equal(acc.pix, pix_u)
+    np.testing.assert_array_equal(acc.count, np.bincount(inv))
+    for j in range(2):
+        np.testing.assert_allclose(
+            acc.sum[:, j], np.bincount(inv, weights=quants[:, j]),
+            rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(
+            acc.sumsq[:, j], np.bincount(inv, weights=quants[:, j] ** 2),
+            rtol=1e-12)
+        mins = np.full(len(pix_u), np.inf)
+        np.minimum.at(mins, inv, quants[:, j])
+        maxs = np.full(len(pix_u), -np.inf)
+        np.maximum.at(maxs, inv, quants[:, j])
+        np.testing.assert_array_equal(acc.min[:, j], mins)
+        np.testing.assert_array_equal(acc.max[:, j], maxs)
+    # Chunks added after the totals have been read are still included
+    acc.add(pix[:10], quants[:10])
+    assert acc.count.sum() == len(pix) + 10
+
+
+@pytest.mark.parametrize('ncores', [1, 2])
+def test_occupied_pixels_match_ang2pix(ncores):
+    rng = np.random.default_rng(3)
+    cat = {'ra': 200 + 4 * rng.random(5000), 'dec': 42 + 4 * rng.random(5000)}
+    occupied = mu.occupiedPixels(lambda: cat, [64, 256], chunk_size=700,
+                                 ncores=ncores)
+    for nside in [64, 256]:
+        pix = hp.ang2pix(nside, cat['ra'], cat['dec'], nest=True,
+                         lonlat=True)
+        np.testing.assert_array_equal(occupied[nside], np.unique(pix))
+
+
+def _pixel_sets(nside_a=64, nside_b=64, seed=5):
+    rng = np.random.default_rng(seed)
+    # Overlapping random subsets of the first base pixel at each resolution
+    a = rng.choice(nside_a ** 2, nside_a ** 2 // 3, replace=False)
+    b = rng.choice(nside_b ** 2, nside_b ** 2 // 3, replace=False)
+    return a, b
+
+
+def _upgrade(pix, nside, nside_out):
+    # Reference conversion to a finer resolution using healpy
+    theta, phi = hp.pix2ang(nside_out, np.arange(12 * nside_out ** 2),
+                            nest=True)
+    parent = hp.ang2pix(nside, theta, phi, nest=True)
+    return np.where(np.isin(parent, pix))[0]
+
+
+@pytest.mark.parametrize('nside_a,nside_b', [(64, 64), (64, 16), (16, 64)])
+@pytest.mark.parametrize('as_map', [False, True])
+def test_pixel_set_operations_match_numpy(nside_a, nside_b, as_map):
+    a, b = _pixel_sets(nside_a, nside_b)
+    sa = mu.PixelSet(a, nside_a)
+    sb = mu.PixelSet(b, nside_b)
+    if as_map:
+        sb = hsp.HealSparseMap.make_empty(8, nside_b, dtype=np.float64)
+        sb[b] = 1.
+    nside = max(nside_a, nside_b)
+    ra = _upgrade(a, nside_a, nside)
+    rb = _upgrade(b, nside_b, nside)
+    for result, expected in [(sa | sb, np.union1d(ra, rb)),
+                             (sa & sb, np.intersect1d(ra, rb)),
+                             (sa - sb, np.setdiff1d(ra, rb))]:
+        assert result.nside == nside
+        np.testing.assert_array_equal(result.pix, expected)
+
+
+def test_pixel_set_contains_and_to_nside():
+    a, _ = _pixel_sets()
+    sa = mu.PixelSet(a[::-1], 64)
+    np.testing.assert_array_equal(sa.pix, np.sort(a))
+    # Same resolution, including pixels outside the occupied blocks
+    test = np.arange(12 * 64 ** 2)
+    np.testing.assert_array_equal(sa.contains(test), np.isin(test, a))
+    # Finer and coarser pixels
+    fine = _upgrade(a, 64, 256)
+    test = np.arange(12 * 256 ** 2)
+    np.testing.assert_array_equal(sa.contains(test, nside=256),
+                                  np.isin(test, fine))
+    coarse = np.unique(a >> 4)
+    test = np.arange(12 * 16 ** 2)
+    np.testing.assert_array_equal(sa.contains(test, nside=16),
+                                  np.isin(test, coarse))
+    np.testing.assert_array_equal(sa.to_nside(16).pix, coarse)
+    np.testing.assert_array_equal(sa.to_nside(256).pix, fine)
+    # Empty sets
+    empty = mu.PixelSet([], 64)
+    assert len(empty | sa) == len(sa)
+    assert len(sa & empty) == 0
+    assert not empty.contains(test, nside=16).any()
+
+
+def test_smooth_sparse_matches_healpy_mask():
+    # Binary depth-like map over a patch with random holes and a gap,
+    # smoothed and thresholded as in make_maps_from_catalogue.py
+    nside = 128
+    fwhm = np.radians(2.)
+    rng = np.random.default_rng(2)
+    ra, dec = hp.pix2ang(nside, np.arange(12 * nside ** 2), nest=True,
+                         lonlat=True)
+    foot = np.where((ra > 150) & (ra < 170) & (dec > -5) & (dec < 10))[0]
+    vals = (rng.random(len(foot)) < 0.9).astype(float)
+    vals[(ra[foot] > 158) & (ra[foot] < 160)] = 0.
+    full = np.zeros(12 * nside ** 2)
+    full[foot] = vals
+    ref = hp.smoothing(full, fwhm, nest=True)[foot]
+    smoothed = mu.smoothSparse(foot, vals, nside, fwhm)
+    np.testing.assert_allclose(smoothed, ref, atol=1e-5)
+    np.testing.assert_array_equal(smoothed < 0.7, ref < 0.7)
+    # Evaluating at a subset of the pixels gives the same values
+    sub = foot[::7]
+    np.testing.assert_allclose(
+        mu.smoothSparse(foot, vals, nside, fwhm, pix_out=sub),
+        smoothed[::7], rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('nside_out', [64, 16, 4])
+def test_degrade_pixels_matches_ud_grade(nside_out):
+    nside = 64
+    rng = np.random.default_rng(11)
+    pix = rng.choice(12 * nside ** 2, 10000, replace=False)
+    vals = rng.normal(size=(len(pix), 2))
+    npix_sub = (nside // nside_out) ** 2
+    for j in range(2):
+        full = np.zeros(12 * nside ** 2)
+        full[pix] = vals[:, j]
+        ref = hp.ud_grade(full, nside_out, order_in='NESTED',
+                          order_out='NESTED')
+        pix_out, mean = mu.degradePixels(pix, vals, nside, nside_out,
+                                         reduction='mean')
+        occupied = hp.ud_grade((full != 0).astype(float), nside_out,
+                               order_in='NESTED', order_out='NESTED')
+        np.testing.assert_array_equal(pix_out, np.nonzero(occupied)[0])
+        np.testing.assert_allclose(mean[:, j], ref[pix_out], atol=1e-12)
+        _, total = mu.degradePixels(pix, vals[:, j], nside, nside_out)
+        np.testing.assert_allclose(total, ref[pix_out] * npix_sub,
+                                   atol=1e-10)
+        # Extremes over the subpixels with values only
+        full[:] = np.nan
+        full[pix] = vals[:, j]
+        sub = full.reshape(-1, npix_sub)[pix_out]
+        for reduction, func in [('min', np.nanmin), ('max', np.nanmax)]:
+            _, ext = mu.degradePixels(pix, vals, nside, nside_out,
+                                      reduction=reduction)
+            np.testing.assert_array_equal(ext[:, j], func(sub, axis=1))
+
+
+def test_degrade_pixels_rejects_unknown_reduction():
+    with pytest.raises(ValueError):
+        mu.degradePixels([0, 1], [1., 2.], 4, 2, reduction='median')
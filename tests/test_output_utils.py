@@ -0,0 +1,113 @@
+import h5py
+import numpy as np
+import output_utils as ou
+
+
+def _write_cat(fname, **cols):
+    with h5py.File(fname, 'w') as hf:
+        for name, data in cols.items():
+            hf.create_dataset(f'photometry/{name}', data=data,
+                              maxshape=(None,))
+
+
+def test_merge_hdf_catalogues_matches_concatenation(tmp_path):
+    rng = np.random.default_rng(1)
+    parts = [rng.random(n) for n in [5, 0, 12, 7]]
+    files = []
+    for i, ra in enumerate(parts):
+        files.append(str(tmp_path / f'part{i}.hdf5'))
+        _write_cat(files[-1], ra=ra, id=np.arange(len(ra)) + 100 * i)
+    # Missing inputs are skipped
+    files.insert(2, str(tmp_path / 'missing.hdf5'))
+    out = str(tmp_path / 'merged.hdf5')
+    ou.merge_hdf_catalogues(files, out, block_size=3, layout='read')
+    with h5py.File(out, 'r') as hf:
+        np.testing.assert_array_equal(hf['photometry/ra'][:],
+                                      np.concatenate(parts))
+        np.testing.assert_array_equal(
+            hf['photometry/id'][:],
+            np.concatenate([np.arange(len(p)) + 100 * i
+                            for i, p in enumerate(parts)]))
+
+
+def test_merge_hdf_catalogues_offsets_derived_indices(tmp_path):
+    rng = np.random.default_rng(2)
+    lengths = [6, 0, 9, 4]
+    basic, derived, expected = [], [], []
+    for i, n in enumerate(lengths):
+        ra = rng.random(n)
+        sel = np.flatnonzero(rng.random(n) < 0.5)
+        basic.append(str(tmp_path / f'basic{i}.hdf5'))
+        derived.append(str(tmp_path / f'main{i}.hdf5'))
+        _write_cat(basic[-1], ra=ra)
+        _write_cat(derived[-1], row_index=sel)
+        expected.append(ra[sel])
+    offsets = np.cumsum([0] + lengths[:-1])
+    ou.merge_hdf_catalogues(basic, str(tmp_path / 'basic.hdf5'))
+    ou.merge_hdf_catalogues(derived, str(tmp_path / 'main.hdf5'),
+                            index_offsets=offsets, block_size=2)
+    with h5py.File(tmp_path / 'main.hdf5', 'a') as hf:
+        hf['photometry'].attrs['parent'] = 'basic.hdf5'
+    with ou.open_catalogue(str(tmp_path / 'main.hdf5')) as cat:
+        np.testing.assert_array_equal(cat['ra'][:], np.concatenate(expected))
+
+
+def _write_parquet(fname, nrows=1000, row_group_size=100):
+    rng = np.random.default_rng(3)
+    cols = {'zphot': rng.random(nrows) * 2.,
+            'ra': rng.random(nrows) * 360.}
+    ou.write_output_parquet(cols, fname, row_group_size=row_group_size)
+    return cols
+
+
+def test_parquet_new_columns_leave_main_file_untouched(tmp_path):
+    fname = str(tmp_path / 'cat.parquet')
+    cols = _write_parquet(fname)
+    with open(fname, 'rb') as f:
+        contents = f.read()
+    flags = cols['zphot'] > 1.
+    with ou.open_catalogue(fname, mode='a') as cat:
+        d = cat.require_dataset('flag', flags.shape, dtype=bool)
+        d[:] = flags
+        cat.attrs['note'] = 'x'
+    with open(fname, 'rb') as f:
+        assert f.read() == contents
+
+    with ou.open_catalogue(fname, mode='a') as cat:
+        assert cat.attrs['note'] == 'x'
+        np.testing.assert_array_equal(cat['flag'][:], flags)
+        np.testing.assert_array_equal(cat['flag'][250:420], flags[250:420])
+        # Modify a column stored in the main file and delete another
+        d = cat.require_dataset('zphot', flags.shape, dtype='f8')
+        d[:] = 0.
+        del cat['ra']
+    with ou.open_catalogue(fname) as cat:
+        assert sorted(cat.keys()) == ['flag', 'zphot']
+        assert np.all(cat['zphot'][:] == 0.)
+
+    # Rewriting the catalogue discards the columns added to the old one
+    _write_parquet(fname)
+    with ou.open_catalogue(fname) as cat:
+        assert sorted(cat.keys()) == ['ra', 'zphot']
+
+
+def test_filtered_reads_match_mask(tmp_path):
+    fname = str(tmp_path / 'cat.parquet')
+    cols = _write_parquet(fname)
+    with h5py.File(tmp_path / 'cat.hdf5', 'w') as hf:
+        for k, v in cols.items():
+            hf.create_dataset(f'photometry/{k}', data=v)
+    with ou.open_catalogue(fname, mode='a') as cat:
+        cat.create_dataset('flag', data=cols['ra'] > 180.)
+    filters = [('zphot', '>=', 0.3), ('zphot', '<', 1.5)]
+    sel = (cols['zphot'] >= 0.3) & (cols['zphot'] < 1.5)
+    for f in [fname, str(tmp_path / 'cat.hdf5')]:
+        with ou.open_catalogue(f, filters=filters) as cat:
+            assert len(cat['ra']) == sel.sum()
+            np.testing.assert_array_equal(cat['ra'][:], cols['ra'][sel])
+            np.testing.assert_array_equal(cat['ra'][10:20],
+                                          cols['ra'][sel][10:20])
+    # Filters referring to a column outside the main Parquet file
+    with ou.open_catalogue(fname, filters=[('flag', '==', True)]) as cat:
+        np.testing.assert_array_equal(cat['zphot'][:],
+                                      cols['zphot'][cols['ra'] > 180.])
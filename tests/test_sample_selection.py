@@ -0,0 +1,69 @@
+import os
+import runpy
+import shutil
+import sys
+import h5py
+import numpy as np
+import yaml
+from configuration import PipelineConfig as PC
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINES = os.path.join(ROOT, 'pipelines')
+
+
+def _run_selection(root, monkeypatch, samples=None, flag_columns=True):
+    with open(os.path.join(PIPELINES, 'config_local.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['global']['paths']['out'] = f'{root}/out/'
+    config['global']['fields'] = ['hectomap']
+    if samples is not None:
+        config['global']['samples'] = samples
+    config['sampleSelection']['sample_flag_columns'] = flag_columns
+    for fname in config['global']['auxfiles'].values():
+        shutil.copy(os.path.join(PIPELINES, fname), root)
+    with open(f'{root}/config.yaml', 'w') as f:
+        yaml.safe_dump(config, f)
+    monkeypatch.setattr(sys, 'argv', ['sample_selection.py',
+                                      f'{root}/config.yaml'])
+    runpy.run_path(os.path.join(ROOT, 'sample_selection.py'))
+    return PC(f'{root}/config.yaml', stage='sampleSelection')
+
+
+def test_flag_columns_follow_samples(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / 'out' / 'hectomap')
+    fname = tmp_path / 'out' / 'hectomap' / 'clean_catalogue.hdf5'
+    zphot = np.random.default_rng(6).random(500) * 2.
+    with h5py.File(fname, 'w') as hf:
+        gp = hf.create_group('photometry')
+        gp['ra'] = np.zeros(len(zphot))
+        gp['pz_best_dnnz'] = zphot
+        # Flag column left from a catalogue with a different number of rows
+        gp['bin1'] = np.ones(len(zphot) + 10, dtype=bool)
+
+    def check(cf, flag_columns):
+        with h5py.File(fname, 'r') as hf:
+            gp = hf['photometry']
+            masks = cf.unpack_samples(gp[cf.sample_bitmask][:])
+            for s, defn in cf.samples.items():
+                lo, hi = [float(x) for x in defn.split(' ')[::6]]
+                expected = (lo <= zphot) & (zphot < hi)
+                np.testing.assert_array_equal(masks[s], expected)
+                if s in flag_columns:
+                    np.testing.assert_array_equal(gp[s][:], expected)
+            return [s for s in gp if s.startswith('bin')]
+
+    cf = _run_selection(tmp_path, monkeypatch)
+    assert sorted(check(cf, cf.samples)) == sorted(cf.samples)
+
+    # Changing a sample and removing another without writing flag columns
+    # removes their columns, keeping those of the unchanged samples
+    samples = dict(cf.samples)
+    samples['bin1'] = '0.7 <= zphot ; zphot < 0.9'
+    del samples['bin3']
+    cf = _run_selection(tmp_path, monkeypatch, samples=samples,
+                        flag_columns=False)
+    assert sorted(check(cf, ['bin0', 'bin2'])) == ['bin0', 'bin2']
+
+    # Writing the flag columns again restores them with the new definitions
+    cf = _run_selection(tmp_path, monkeypatch, samples=samples)
+    assert sorted(check(cf, cf.samples)) == ['bin0', 'bin1', 'bin2']
@@ -6,7 +6,7 @@
 import pyccl as ccl
 import h5py
 import numpy as np
-from output_utils import colour_string
+from output_utils import colour_string, open_catalogue
 import cell_utils as cu
 import sys
 from configuration import PipelineConfig as PC
@@ -48,9 +48,17 @@ def compute_nofz(fd):
     else:
         fd = [fd]
 
+    # If told to, only read the galaxies in the specified range of zphot
+    # (skipping whole row groups of Parquet catalogues where possible)
+    filters = None
+    if cf.nofz_zphot_range is not None:
+        zmin, zmax = cf.nofz_zphot_range
+        filters = [(cf.key_cols.zphot, '>=', zmin),
+                   (cf.key_cols.zphot, '<', zmax)]
+
     for f in fd:
-        with h5py.File(cf.paths.out + f + '/' + cf.cats.main, 'r') as hf:
-            gr = hf['photometry']
+        with open_catalogue(cf.paths.out + f + '/' + cf.cats.main,
+                            filters=filters) as gr:
             z_best.append(gr[f'{cf.key_cols.zphot}'][:])
             z_mc.append(gr[f'{cf.key_cols.zphot_mc}'][:])
             sample_masks = cf.get_samples(gr)